@@ -0,0 +1,715 @@
+import heapq
+import numpy
+import torch
+import sys
+import os
+
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/..")
+
+from torch_function.KeyValueCacheQuantUtils import cache_quant, cache_dequant
+
+
+def page_token_index(pages: List[int], page_size: int, device: torch.device) -> torch.Tensor:
+    # cache slot of every token of pages, page by page
+    pages = torch.tensor(pages, dtype=torch.int64)
+    index = pages[:, None] * page_size + torch.arange(page_size, dtype=torch.int64)
+    return index.reshape(-1).to(device)
+
+
+class PagedCacheManager:
+    # fixed pool of kv cache pages for cache_mode == 1
+    # pages are handed out on demand from a free list and returned when a sequence finishes.
+    # a sequence reserves its worst case length on admission so that running sequences
+    # never starve each other of pages while decoding.
+    def __init__(self, num_pages: int, page_size: int):
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.free_pages = [i for i in range(num_pages - 1, -1, -1)]
+        self.page_tables: Dict[int, List[int]] = {}
+        self.reserved_pages: Dict[int, int] = {}
+        self.prefix_cache = None # set by PrefixCache, unreferenced cached pages are reclaimed from it
+
+
+    def num_available_pages(self) -> int:
+        available = len(self.free_pages)
+        if self.prefix_cache is not None:
+            available += self.prefix_cache.num_evictable_pages
+        return available
+
+
+    def pages_of(self, num_tokens: int) -> int:
+        return (num_tokens + self.page_size - 1) // self.page_size
+
+
+    def num_free_pages(self) -> int:
+        return len(self.free_pages)
+
+
+    def num_outstanding_pages(self) -> int:
+        # pages promised to running sequences but not yet taken from the free list
+        outstanding = 0
+        for seq_id, reserved in self.reserved_pages.items():
+            outstanding += max(0, reserved - len(self.page_tables[seq_id]))
+        return outstanding
+
+
+    def can_reserve(self, num_tokens: int, num_shared: int = 0) -> bool:
+        # num_shared: leading pages already held by the prefix cache
+        return self.pages_of(num_tokens) - num_shared <= self.num_available_pages() - self.num_outstanding_pages()
+
+
+    def reserve(self, seq_id: int, num_tokens: int, shared_pages: List[int] = []):
+        if seq_id in self.page_tables:
+            raise Exception("sequence {} is already allocated".format(seq_id))
+        if self.pages_of(num_tokens) > self.num_pages:
+            raise Exception("sequence of {} tokens does not fit in a cache of {} pages".format(
+                num_tokens, self.num_pages))
+        if not self.can_reserve(num_tokens, len(shared_pages)):
+            raise Exception("out of kv cache pages: need {}, {} available, {} outstanding".format(
+                self.pages_of(num_tokens) - len(shared_pages), self.num_available_pages(), self.num_outstanding_pages()))
+        self.page_tables[seq_id] = list(shared_pages)
+        self.reserved_pages[seq_id] = self.pages_of(num_tokens)
+
+
+    def allocate(self, seq_id: int, num_tokens: int) -> List[int]:
+        # grow the page table of seq_id until it covers num_tokens
+        page_table = self.page_tables[seq_id]
+        page_table.extend(self.take(self.pages_of(num_tokens) - len(page_table)))
+        return page_table
+
+
+    def take(self, num_pages: int) -> List[int]:
+        # pages off the free list, reclaiming unreferenced prefix cache pages when it runs short
+        if num_pages > len(self.free_pages) and self.prefix_cache is not None:
+            self.prefix_cache.evict(num_pages - len(self.free_pages))
+        if num_pages > len(self.free_pages):
+            raise Exception("out of kv cache pages: need {}, {} free".format(num_pages, len(self.free_pages)))
+        return [self.free_pages.pop() for _ in range(max(0, num_pages))]
+
+
+    def free(self, seq_id: int):
+        self.recycle(self.detach(seq_id))
+
+
+    def detach(self, seq_id: int) -> List[int]:
+        # drop the sequence and hand its pages to the caller instead of the free list
+        self.reserved_pages.pop(seq_id)
+        return self.page_tables.pop(seq_id)
+
+
+    def recycle(self, pages: List[int]):
+        self.free_pages.extend(reversed(pages))
+
+
+    def truncate(self, seq_id: int, num_tokens: int) -> List[int]:
+        # return the pages behind the first num_tokens tokens of seq_id to the free list
+        page_table = self.page_tables[seq_id]
+        freed = page_table[self.pages_of(num_tokens):]
+        del page_table[self.pages_of(num_tokens):]
+        self.recycle(freed)
+        return freed
+
+
+    def cache_starts(self, seq_id: int, max_pages: int) -> List[int]:
+        # page table in the cachestarts format of KeyValueCache: token offset of each page, -1 padded
+        page_table = self.page_tables[seq_id]
+        return [p * self.page_size for p in page_table] + [-1 for _ in range(len(page_table), max_pages)]
+
+
+class ContiguousCacheManager:
+    # fixed kv cache of num_tokens slots for cache_mode == 0 and the rings of cache_mode == 2
+    # every sequence owns one region of consecutive slots. free regions are kept sorted by offset
+    # and merged with their neighbours when a sequence finishes, so finished sequences leave
+    # room for new ones. compact() packs the live regions to the front when free space is fragmented.
+    def __init__(self, num_tokens: int):
+        self.num_tokens = num_tokens
+        self.free_regions: List[List[int]] = [[0, num_tokens]] if num_tokens > 0 else [] # [offset, length]
+        self.regions: Dict[int, Tuple[int, int]] = {}
+
+
+    def num_free_tokens(self) -> int:
+        return sum([length for _, length in self.free_regions])
+
+
+    def largest_free_region(self) -> int:
+        return max([length for _, length in self.free_regions], default=0)
+
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        return num_tokens <= self.largest_free_region()
+
+
+    def allocate(self, seq_id: int, num_tokens: int) -> int:
+        # best fit, large regions are left for long sequences. returns the offset of the region
+        if seq_id in self.regions:
+            raise Exception("sequence {} is already allocated".format(seq_id))
+        best = -1
+        for i, (_, length) in enumerate(self.free_regions):
+            if length >= num_tokens and (best < 0 or length < self.free_regions[best][1]):
+                best = i
+        if best < 0:
+            raise Exception("out of contiguous kv cache: need {} tokens, largest free region {}, {} free".format(
+                num_tokens, self.largest_free_region(), self.num_free_tokens()))
+        offset, length = self.free_regions[best]
+        if length == num_tokens:
+            del self.free_regions[best]
+        else:
+            self.free_regions[best] = [offset + num_tokens, length - num_tokens]
+        self.regions[seq_id] = (offset, num_tokens)
+        return offset
+
+
+    def free(self, seq_id: int):
+        offset, length = self.regions.pop(seq_id)
+        i = 0
+        while i < len(self.free_regions) and self.free_regions[i][0] < offset:
+            i += 1
+        self.free_regions.insert(i, [offset, length])
+        # coalesce with the following and the preceding region
+        if i + 1 < len(self.free_regions) and offset + length == self.free_regions[i + 1][0]:
+            self.free_regions[i][1] += self.free_regions.pop(i + 1)[1]
+        if i > 0 and self.free_regions[i - 1][0] + self.free_regions[i - 1][1] == offset:
+            self.free_regions[i - 1][1] += self.free_regions.pop(i)[1]
+
+
+    def compact(self) -> Dict[int, Tuple[int, int]]:
+        # move every live region down to the front of the cache, leaving a single free region.
+        # returns seq_id -> (old offset, new offset) of the moved regions, the caller moves their kv
+        # with move_cache_tokens and rewrites their cachestarts.
+        moves = {}
+        offset = 0
+        for seq_id, (old_offset, length) in sorted(self.regions.items(), key=lambda r: r[1][0]):
+            if old_offset != offset:
+                moves[seq_id] = (old_offset, offset)
+                self.regions[seq_id] = (offset, length)
+            offset += length
+        self.free_regions = [[offset, self.num_tokens - offset]] if offset < self.num_tokens else []
+        return moves
+
+
+def move_cache_tokens(kv_cache: torch.Tensor, kv_scale: torch.Tensor, cache_layout: int,
+                      src: torch.Tensor, dst: torch.Tensor):
+    # copy cache slots src to dst along the token axis in one gather and one scatter,
+    # so overlapping ranges are safe as long as no slot is a destination twice
+    token_dim = cache_layout # token axis of the cache shape equals the layout index
+    kv_cache.index_copy_(token_dim, dst, kv_cache.index_select(token_dim, src))
+    if kv_scale is not None and kv_scale.numel() > 0:
+        kv_scale.index_copy_(token_dim, dst, kv_scale.index_select(token_dim, src))
+
+
+class PrefixNode:
+    def __init__(self, parent: "PrefixNode" = None, block: Tuple[int, ...] = (), page: int = -1):
+        self.parent = parent
+        self.block = block # page_size token ids stored in page
+        self.page = page
+        self.children: Dict[Tuple[int, ...], PrefixNode] = {}
+        self.ref_count = 0 # running sequences reading this page
+        self.last_access = 0
+
+
+class PrefixCache:
+    # radix tree over page sized blocks of token ids. every node owns one full kv cache page,
+    # the path from the root spells the prefix the page was computed for.
+    # pages of finished sequences are inserted into the tree and reused by later sequences
+    # sharing the prefix. unreferenced pages stay cached until the page manager runs out
+    # of free pages, then the least recently used leaves are evicted.
+    def __init__(self, page_manager: PagedCacheManager):
+        self.page_manager = page_manager
+        self.page_size = page_manager.page_size
+        self.root = PrefixNode()
+        self.clock = 0
+        self.num_cached_pages = 0
+        self.num_evictable_pages = 0
+
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        self.evicted_pages = 0
+
+        page_manager.prefix_cache = self
+
+
+    def match(self, token_ids: List[int], max_tokens: int) -> List[PrefixNode]:
+        # longest chain of cached full blocks within the first max_tokens tokens
+        nodes = []
+        node = self.root
+        for i in range(max_tokens // self.page_size):
+            block = tuple(token_ids[i * self.page_size:(i + 1) * self.page_size])
+            node = node.children.get(block)
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+
+    def acquire(self, nodes: List[PrefixNode]):
+        self.clock += 1
+        for node in nodes:
+            if node.ref_count == 0:
+                self.num_evictable_pages -= 1
+            node.ref_count += 1
+            node.last_access = self.clock
+
+
+    def release(self, nodes: List[PrefixNode]):
+        for node in nodes:
+            node.ref_count -= 1
+            if node.ref_count == 0:
+                self.num_evictable_pages += 1
+
+
+    def record(self, num_cached_tokens: int, num_tokens: int):
+        self.hit_tokens += num_cached_tokens
+        self.miss_tokens += num_tokens - num_cached_tokens
+
+
+    def hit_rate(self) -> float:
+        total = self.hit_tokens + self.miss_tokens
+        return self.hit_tokens / total if total > 0 else 0.0
+
+
+    def insert(self, token_ids: List[int], page_table: List[int], shared_nodes: List[PrefixNode]):
+        # token_ids: tokens written to the pages of page_table, which starts with the pages of shared_nodes.
+        # full blocks not yet cached are adopted by the tree, every other page goes back to the free list.
+        self.clock += 1
+        recycled = []
+        node = self.root
+        num_blocks = len(token_ids) // self.page_size
+        for i, page in enumerate(page_table):
+            if i >= num_blocks:
+                recycled.append(page)
+                continue
+            if i < len(shared_nodes):
+                node = shared_nodes[i]
+                continue
+            block = tuple(token_ids[i * self.page_size:(i + 1) * self.page_size])
+            child = node.children.get(block)
+            if child is None:
+                child = PrefixNode(node, block, page)
+                node.children[block] = child
+                self.num_cached_pages += 1
+                self.num_evictable_pages += 1
+            else:
+                # computed concurrently by another sequence
+                recycled.append(page)
+            child.last_access = self.clock
+            node = child
+        self.release(shared_nodes)
+        self.page_manager.recycle(recycled)
+
+
+    def evict(self, num_pages: int) -> int:
+        leaves = []
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if len(node.children) == 0 and node.ref_count == 0 and node is not self.root:
+                leaves.append((node.last_access, id(node), node))
+        heapq.heapify(leaves)
+
+        evicted = 0
+        while evicted < num_pages and len(leaves) > 0:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.block]
+            self.page_manager.recycle([node.page])
+            self.num_cached_pages -= 1
+            self.num_evictable_pages -= 1
+            evicted += 1
+            if len(parent.children) == 0 and parent.ref_count == 0 and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+        self.evicted_pages += evicted
+        return evicted
+
+
+class CacheSwapper:
+    # pinned host memory tier for kv cache pages of preempted sequences.
+    # kv_cache and kv_scale pages are moved in one batched copy per direction per step.
+    def __init__(self, kv_cache: torch.Tensor, kv_scale: torch.Tensor,
+                 cache_layout: int, page_size: int, num_host_pages: int):
+        self.kv_cache = kv_cache
+        self.kv_scale = kv_scale if kv_scale is not None and kv_scale.numel() > 0 else None
+        self.token_dim = cache_layout # token axis of the cache shape equals the layout index
+        self.page_size = page_size
+        self.num_host_pages = num_host_pages
+
+        pin_memory = torch.cuda.is_available()
+        def host_like(X: torch.Tensor):
+            shape = list(X.shape)
+            shape[self.token_dim] = num_host_pages * page_size
+            return torch.empty(shape, dtype=X.dtype, device='cpu', pin_memory=pin_memory)
+        self.host_cache = host_like(kv_cache)
+        self.host_scale = host_like(self.kv_scale) if self.kv_scale is not None else None
+
+        self.free_host_pages = [i for i in range(num_host_pages - 1, -1, -1)]
+        self.host_page_tables: Dict[int, List[int]] = {}
+
+
+    def num_free_host_pages(self) -> int:
+        return len(self.free_host_pages)
+
+
+    def is_swapped(self, seq_id: int) -> bool:
+        return seq_id in self.host_page_tables
+
+
+    def token_index(self, pages: List[int], device: torch.device) -> torch.Tensor:
+        return page_token_index(pages, self.page_size, device)
+
+
+    def swap_out(self, device_page_tables: Dict[int, List[int]]):
+        # copy device pages of every sequence to host, the caller recycles the device pages afterwards
+        device_pages, host_pages = [], []
+        for seq_id, pages in device_page_tables.items():
+            if len(pages) > len(self.free_host_pages):
+                raise Exception("out of host swap pages: need {}, {} free".format(len(pages), len(self.free_host_pages)))
+            host_page_table = [self.free_host_pages.pop() for _ in pages]
+            self.host_page_tables[seq_id] = host_page_table
+            device_pages.extend(pages)
+            host_pages.extend(host_page_table)
+        if len(device_pages) == 0:
+            return
+
+        src = self.token_index(device_pages, self.kv_cache.device)
+        dst = self.token_index(host_pages, 'cpu')
+        self.host_cache.index_copy_(self.token_dim, dst, self.kv_cache.index_select(self.token_dim, src).cpu())
+        if self.kv_scale is not None:
+            self.host_scale.index_copy_(self.token_dim, dst, self.kv_scale.index_select(self.token_dim, src).cpu())
+
+
+    def swap_in(self, device_page_tables: Dict[int, List[int]]):
+        # restore host pages of every sequence into freshly allocated device pages
+        device_pages, host_pages = [], []
+        for seq_id, pages in device_page_tables.items():
+            host_page_table = self.host_page_tables.pop(seq_id)
+            assert len(pages) == len(host_page_table), "{} vs. {}".format(len(pages), len(host_page_table))
+            device_pages.extend(pages)
+            host_pages.extend(host_page_table)
+            self.free_host_pages.extend(reversed(host_page_table))
+        if len(device_pages) == 0:
+            return
+
+        src = self.token_index(host_pages, 'cpu')
+        dst = self.token_index(device_pages, self.kv_cache.device)
+        self.kv_cache.index_copy_(self.token_dim, dst,
+            self.host_cache.index_select(self.token_dim, src).to(self.kv_cache.device))
+        if self.kv_scale is not None:
+            self.kv_scale.index_copy_(self.token_dim, dst,
+                self.host_scale.index_select(self.token_dim, src).to(self.kv_scale.device))
+
+
+def retained_positions(num_tokens: int, num_retained: int, sink_tokens: int,
+                       heavy_hitter_tokens: int = 0, mass: torch.Tensor = None) -> List[int]:
+    # positions kept when a sequence of num_tokens is cut down to num_retained tokens: the first
+    # sink_tokens attention sinks, the heavy_hitter_tokens tokens in between with the highest
+    # accumulated attention mass ([num_tokens]) and the most recent tokens
+    if num_tokens <= num_retained:
+        return [i for i in range(num_tokens)]
+    num_recent = num_retained - sink_tokens - heavy_hitter_tokens
+    if num_recent <= 0:
+        raise Exception("{} retained tokens leave no room for recent tokens after {} sink and {} heavy hitter tokens".format(
+            num_retained, sink_tokens, heavy_hitter_tokens))
+    positions = [i for i in range(sink_tokens)]
+    recent_begin = num_tokens - num_recent
+    if heavy_hitter_tokens > 0:
+        hitters = torch.topk(mass[sink_tokens:recent_begin].float(), heavy_hitter_tokens).indices + sink_tokens
+        positions.extend(sorted(hitters.tolist()))
+    positions.extend([i for i in range(recent_begin, num_tokens)])
+    return positions
+
+
+class CacheCompactor:
+    # evicts tokens of a cache_mode 1 sequence in place: the retained tokens are moved to the front
+    # of its page table so that the pages behind them can be returned to the page manager.
+    # keys are cached after rotary embedding, a token moved from position p to c has its key rotated
+    # by c - p, so the compacted cache looks as if it had been computed at the new positions and
+    # the sequence simply continues at start_pos = number of retained tokens.
+    def __init__(self, kv_cache: torch.Tensor, kv_scale: torch.Tensor,
+                 cache_layout: int, page_size: int,
+                 quant_bit: int = 0, quant_group: int = 8, quant_zero_point: bool = False,
+                 with_rope: bool = True, rotary_dim: int = 0, rope_theta: float = 10000.0,
+                 position_scale: float = 1.0, attention_mass: torch.Tensor = None):
+        self.kv_cache = kv_cache
+        self.kv_scale = kv_scale if quant_bit > 0 else None
+        self.token_dim = cache_layout # token axis of the cache shape equals the layout index
+        self.page_size = page_size
+        self.quant_bit = quant_bit
+        self.quant_group = quant_group
+        self.quant_zero_point = quant_zero_point
+        self.with_rope = with_rope
+        self.rotary_dim = rotary_dim
+        self.rope_theta = rope_theta
+        self.position_scale = position_scale # linear rope scaling factor
+        self.attention_mass = attention_mass # [cache tokens], follows the tokens it belongs to
+
+
+    def token_slots(self, page_table: List[int], positions: torch.Tensor) -> torch.Tensor:
+        pages = torch.tensor(page_table, dtype=torch.int64, device=positions.device)
+        return pages[positions // self.page_size] * self.page_size + positions % self.page_size
+
+
+    def rotate(self, keys: torch.Tensor, delta: torch.Tensor) -> torch.Tensor:
+        # keys: [num_tokens, ..., head_dim] in float, rotated by delta[i] positions, same pairing as the rope op
+        dim = keys.shape[-1] if self.rotary_dim == 0 else self.rotary_dim
+        freqs = 1.0 / (self.rope_theta ** (torch.arange(0, dim, 2, dtype=torch.float, device=keys.device)[: (dim // 2)] / dim))
+        angle = torch.outer(delta.float() / self.position_scale, freqs)
+        angle = angle.view(angle.shape[0], *([1] * (keys.dim() - 2)), dim // 2)
+        cos, sin = angle.cos(), angle.sin()
+        X = keys[..., :dim].reshape(*keys.shape[:-1], dim // 2, 2)
+        X_a, X_b = X[..., 0], X[..., 1]
+        rotated = torch.stack([X_a * cos - X_b * sin, X_b * cos + X_a * sin], dim=-1).flatten(-2)
+        return torch.cat([rotated, keys[..., dim:]], dim=-1)
+
+
+    def compact(self, page_table: List[int], positions: List[int], num_tokens: int):
+        # positions: sorted retained positions of a sequence holding num_tokens tokens in page_table
+        device = self.kv_cache.device
+        src_pos = torch.tensor(positions, dtype=torch.int64, device=device)
+        dst_pos = torch.arange(len(positions), dtype=torch.int64, device=device)
+        src = self.token_slots(page_table, src_pos)
+        dst = self.token_slots(page_table, dst_pos)
+
+        # every layer, key and value of a token in one gather: [num_tokens, num_layers, 2, num_kv_heads, head_dim]
+        X = self.kv_cache.index_select(self.token_dim, src).movedim(self.token_dim, 0)
+        S = None
+        if self.kv_scale is not None:
+            S = self.kv_scale.index_select(self.token_dim, src.to(self.kv_scale.device)).movedim(self.token_dim, 0)
+
+        delta = dst_pos - src_pos
+        if self.with_rope and bool((delta != 0).any()):
+            if S is not None:
+                keys = cache_dequant(X[:, :, 0], S[:, :, 0], self.quant_bit, self.quant_group, self.quant_zero_point)
+                X[:, :, 0], S[:, :, 0] = cache_quant(self.rotate(keys.float(), delta).to(S.dtype),
+                    self.quant_bit, self.quant_group, self.quant_zero_point)
+            else:
+                X[:, :, 0] = self.rotate(X[:, :, 0].float(), delta).type_as(X)
+
+        self.kv_cache.index_copy_(self.token_dim, dst, X.movedim(0, self.token_dim))
+        if S is not None:
+            self.kv_scale.index_copy_(self.token_dim, dst.to(self.kv_scale.device), S.movedim(0, self.token_dim))
+        if self.attention_mass is not None:
+            mass = self.attention_mass[src.to(self.attention_mass.device)]
+            self.clear_mass(page_table, num_tokens)
+            self.attention_mass[dst.to(self.attention_mass.device)] = mass
+
+
+    def clear_mass(self, page_table: List[int], num_tokens: int):
+        # the slots are about to hold other tokens
+        if self.attention_mass is None or num_tokens == 0:
+            return
+        positions = torch.arange(num_tokens, dtype=torch.int64, device=self.attention_mass.device)
+        self.attention_mass[self.token_slots(page_table, positions)] = 0
+
+
+class Session:
+    def __init__(self, token_ids: List[int], pages: List[int]):
+        self.token_ids = token_ids # tokens whose kv is cached
+        self.pages = pages # device pages, empty while spilled
+        self.spilled = False
+        self.last_access = 0
+
+
+class SessionStore:
+    # kv cache of conversations kept alive between generate calls, so that the next turn
+    # only prefills its new tokens. when the page pool runs short, the least recently used
+    # idle sessions are spilled to memory mapped files under spill_dir and mapped back on
+    # their next turn, or dropped when spill_dir is None.
+    def __init__(self, page_manager: PagedCacheManager, kv_cache: torch.Tensor, kv_scale: torch.Tensor,
+                 cache_layout: int, spill_dir: str = None):
+        self.page_manager = page_manager
+        self.page_size = page_manager.page_size
+        self.kv_cache = kv_cache
+        self.kv_scale = kv_scale if kv_scale is not None and kv_scale.numel() > 0 else None
+        self.token_dim = cache_layout # token axis of the cache shape equals the layout index
+        self.spill_dir = spill_dir
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+        self.sessions: Dict[object, Session] = {}
+        self.clock = 0
+
+
+    def spill_path(self, session_id, name: str) -> str:
+        return os.path.join(self.spill_dir, "session_{}.{}".format(session_id, name))
+
+
+    def num_resident_pages(self) -> int:
+        return sum([len(s.pages) for s in self.sessions.values()])
+
+
+    def save(self, session_id, token_ids: List[int], pages: List[int]):
+        # pages: page table of a finished sequence, its first len(token_ids) tokens are kept
+        if session_id in self.sessions:
+            self.discard(session_id)
+        num_pages = self.page_manager.pages_of(len(token_ids))
+        self.page_manager.recycle(pages[num_pages:])
+        self.clock += 1
+        session = Session(token_ids, pages[:num_pages])
+        session.last_access = self.clock
+        self.sessions[session_id] = session
+
+
+    def acquire(self, session_id, token_ids: List[int]) -> Tuple[List[int], int]:
+        # hand the cached pages and the number of cached tokens of session_id to a sequence whose
+        # prompt is token_ids, the session leaves the store until the sequence is saved again
+        if session_id not in self.sessions:
+            return [], 0
+        session = self.sessions[session_id]
+        num_tokens = len(session.token_ids)
+        # the last prompt token is always prefilled to produce the first logits
+        if num_tokens >= len(token_ids) or token_ids[:num_tokens] != session.token_ids:
+            self.discard(session_id)
+            return [], 0
+
+        if session.spilled:
+            num_pages = self.page_manager.pages_of(num_tokens)
+            while not self.page_manager.can_reserve(num_pages * self.page_size) and self.spill_lru(session_id):
+                pass
+            if not self.page_manager.can_reserve(num_pages * self.page_size):
+                self.discard(session_id)
+                return [], 0
+            self.load(session_id, self.page_manager.take(num_pages))
+
+        self.sessions.pop(session_id)
+        return session.pages, num_tokens
+
+
+    def spill_lru(self, exclude=None) -> bool:
+        # spill, or drop without spill_dir, the least recently used resident session
+        resident = [(s.last_access, i) for i, s in self.sessions.items()
+                    if not s.spilled and len(s.pages) > 0 and i != exclude]
+        if len(resident) == 0:
+            return False
+        _, session_id = min(resident, key=lambda r: r[0])
+        if self.spill_dir is None:
+            self.discard(session_id)
+        else:
+            self.spill(session_id)
+        return True
+
+
+    def spill(self, session_id):
+        session = self.sessions[session_id]
+        index = page_token_index(session.pages, self.page_size, self.kv_cache.device)
+        for name, X in (("kv", self.kv_cache), ("scale", self.kv_scale)):
+            if X is None:
+                continue
+            data = X.index_select(self.token_dim, index.to(X.device)).cpu().numpy()
+            mapped = numpy.memmap(self.spill_path(session_id, name), dtype=data.dtype, mode="w+", shape=data.shape)
+            mapped[:] = data
+            mapped.flush()
+            del mapped
+        self.page_manager.recycle(session.pages)
+        session.pages = []
+        session.spilled = True
+
+
+    def load(self, session_id, pages: List[int]):
+        session = self.sessions[session_id]
+        index = page_token_index(pages, self.page_size, self.kv_cache.device)
+        for name, X in (("kv", self.kv_cache), ("scale", self.kv_scale)):
+            if X is None:
+                continue
+            shape = list(X.shape)
+            shape[self.token_dim] = index.numel()
+            dtype = torch.empty(0, dtype=X.dtype).numpy().dtype
+            mapped = numpy.memmap(self.spill_path(session_id, name), dtype=dtype, mode="c", shape=tuple(shape))
+            X.index_copy_(self.token_dim, index.to(X.device), torch.from_numpy(mapped).to(X.device))
+            del mapped
+            os.remove(self.spill_path(session_id, name))
+        session.pages = pages
+        session.spilled = False
+
+
+    def discard(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        if session.spilled:
+            for name, X in (("kv", self.kv_cache), ("scale", self.kv_scale)):
+                if X is not None and os.path.exists(self.spill_path(session_id, name)):
+                    os.remove(self.spill_path(session_id, name))
+        else:
+            self.page_manager.recycle(session.pages)
+
+
+if __name__ == "__main__":
+    # device free checks of the allocator invariants, run with python ModelCache.py
+    import tempfile
+
+    # paged manager: reservations count against the pool until their pages are taken
+    pm = PagedCacheManager(8, 4)
+    pm.reserve(0, 10)
+    assert pm.num_outstanding_pages() == 3 and not pm.can_reserve(24)
+    assert pm.allocate(0, 5) == [0, 1] and pm.num_outstanding_pages() == 1
+    assert pm.truncate(0, 4) == [1] and pm.page_tables[0] == [0]
+    pm.free(0)
+    assert pm.num_free_pages() == 8 and pm.num_outstanding_pages() == 0
+
+    # contiguous manager: freed regions coalesce with both neighbours
+    cm = ContiguousCacheManager(12)
+    assert [cm.allocate(i, 4) for i in range(3)] == [0, 4, 8]
+    cm.free(0)
+    cm.free(2)
+    cm.free(1)
+    assert cm.free_regions == [[0, 12]]
+
+    # prefix cache: duplicate blocks are recycled, only unreferenced leaves are evicted
+    pm = PagedCacheManager(8, 4)
+    pc = PrefixCache(pm)
+    tokens = [i for i in range(12)]
+    for seq_id in range(2):
+        pm.reserve(seq_id, 12)
+        pm.allocate(seq_id, 12)
+        pc.insert(tokens, pm.detach(seq_id), [])
+    assert pc.num_cached_pages == 3 and pm.num_free_pages() == 5
+    nodes = pc.match(tokens, 8)
+    pc.acquire(nodes)
+    assert len(nodes) == 2 and pc.num_evictable_pages == 1 and pm.num_available_pages() == 6
+    taken = pm.take(6)
+    assert pc.num_cached_pages == 2 and pc.evicted_pages == 1 and pc.match(tokens, 12) == nodes
+    try:
+        pm.take(1)
+        raise AssertionError("referenced prefix pages were evicted")
+    except Exception as e:
+        assert "out of kv cache pages" in str(e), e
+    pc.release(nodes)
+    pm.recycle(taken)
+    assert pc.num_evictable_pages == 2 and pm.num_available_pages() == 8
+
+    # swapper: pages swapped out and back in to other device pages keep their kv and scale
+    kv_cache = torch.arange(32 * 4, dtype=torch.float32).view(32, 1, 2, 1, 2)
+    kv_scale = -kv_cache[..., :1].clone()
+    kv_origin, scale_origin = kv_cache.clone(), kv_scale.clone()
+    swapper = CacheSwapper(kv_cache, kv_scale, 0, 4, 4)
+    swapper.swap_out({0: [1, 3]})
+    assert swapper.is_swapped(0) and swapper.num_free_host_pages() == 2
+    kv_cache.zero_()
+    kv_scale.zero_()
+    swapper.swap_in({0: [5, 6]})
+    assert not swapper.is_swapped(0) and swapper.num_free_host_pages() == 4
+    assert torch.equal(kv_cache[20:28], torch.cat([kv_origin[4:8], kv_origin[12:16]]))
+    assert torch.equal(kv_scale[20:28], torch.cat([scale_origin[4:8], scale_origin[12:16]]))
+
+    # session store: a spilled session is mapped back into new pages, a diverged prompt drops it
+    with tempfile.TemporaryDirectory() as spill_dir:
+        pm = PagedCacheManager(4, 4)
+        kv_cache = torch.arange(16 * 4, dtype=torch.float32).view(16, 1, 2, 1, 2)
+        kv_origin = kv_cache.clone()
+        store = SessionStore(pm, kv_cache, None, 0, spill_dir)
+        pm.reserve(0, 8)
+        pages = list(pm.allocate(0, 8))
+        store.save("a", [i for i in range(6)], pm.detach(0))
+        assert pm.num_free_pages() == 2 and store.num_resident_pages() == 2
+        assert store.spill_lru() and pm.num_free_pages() == 4 and store.sessions["a"].spilled
+        kv_cache.zero_()
+        new_pages, num_tokens = store.acquire("a", [i for i in range(8)])
+        assert num_tokens == 6 and len(new_pages) == 2 and "a" not in store.sessions
+        assert torch.equal(kv_cache[page_token_index(new_pages, 4, 'cpu')], kv_origin[page_token_index(pages, 4, 'cpu')])
+        store.save("a", [i for i in range(6)], new_pages)
+        assert store.acquire("a", [7 for _ in range(8)]) == ([], 0)
+        assert pm.num_free_pages() == 4 and len(os.listdir(spill_dir)) == 0
+
+    print("ModelCache checks passed")
@@ -14,11 +14,12 @@ class ModelParams:
     vocab_size: int = -1
     norm_eps: float = 1e-5
 
-    cache_quant_bit: int = 8
+    cache_quant_bit: int = 8 # 0, 4 or 8
     cache_quant_group: int = 8
+    cache_quant_zero_point: bool = False # asymmetric quantization with a zero point per group
 
     cache_layout: int = 0
-    cache_mode: int = 0 # only affected when dynamic_batching == True
+    cache_mode: int = 0 # only affected when dynamic_batching == True, 2 for a ring buffer of sliding_window tokens
     page_size: int = 128  # only affected when cache_mode == 1
 
     dynamic_batching: bool = True
@@ -31,4 +32,5 @@ class ModelParams:
 
     num_experts: int = 1
     num_experts_per_token: int = 1
-    sliding_window: int = 0
+    expert_parallel: bool = False # every rank owns num_experts / world_size whole experts instead of a slice of every expert
+    sliding_window: int = 0 # attend to the last sliding_window tokens only, 0 for the full history
@@ -0,0 +1,202 @@
+import sys
+import os
+
+from typing import Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/..")
+
+from ModelParams import ModelParams
+from torch_function.KeyValueCacheQuantUtils import cache_quant_dims
+
+
+class CachePlanner:
+    # memory plan of one tensor parallel rank: weights, step activations and the kv cache filling the rest.
+    # all sizes are bytes per rank. the pipelines size their kv cache with the same numbers so that a
+    # deployment which does not fit fails before the first batch instead of running out of memory in it.
+    def __init__(self, params: ModelParams, world_size: int, memory_budget: int,
+                 fused_qkv: bool = True,
+                 fused_kvcache: bool = True,
+                 fused_ffn_glu: bool = True,
+                 friendly_gqa: bool = False,
+                 attn_wqkv_bias_term: bool = False,
+                 attn_wo_bias_term: bool = False,
+                 ffn_linear_bias_term: bool = False,
+                 max_batch_tokens: int = 4096,
+                 max_kv_tokens: int = 0,
+                 dtype_bytes: int = 2):
+        # max_batch_tokens: tokens of one forward step, max_kv_tokens: kv tokens attended in one step,
+        # both bound the activation workspace. 0 for max_kv_tokens takes max_position_embeddings.
+        self.params = params
+        self.world_size = world_size
+        self.memory_budget = memory_budget
+        self.fused_qkv = fused_qkv
+        self.fused_kvcache = fused_kvcache
+        self.fused_ffn_glu = fused_ffn_glu
+        self.friendly_gqa = friendly_gqa
+        self.attn_wqkv_bias_term = attn_wqkv_bias_term
+        self.attn_wo_bias_term = attn_wo_bias_term
+        self.ffn_linear_bias_term = ffn_linear_bias_term
+        self.max_batch_tokens = max_batch_tokens
+        self.max_kv_tokens = max_kv_tokens if max_kv_tokens > 0 else params.max_position_embeddings
+        self.dtype_bytes = dtype_bytes
+
+        num_kv_heads = params.num_heads if params.num_kv_heads is None else params.num_kv_heads
+        if params.num_heads % world_size != 0 or num_kv_heads % world_size != 0:
+            raise Exception("{} heads and {} kv heads are not divisible by world size {}".format(
+                params.num_heads, num_kv_heads, world_size))
+        if params.intermediate_dim % world_size != 0 or params.hidden_dim % world_size != 0:
+            raise Exception("hidden_dim {} and intermediate_dim {} are not divisible by world size {}".format(
+                params.hidden_dim, params.intermediate_dim, world_size))
+        self.head_dim = params.head_dim if params.head_dim is not None else params.hidden_dim // params.num_heads
+        self.num_local_heads = params.num_heads // world_size
+        self.num_local_kv_heads = num_kv_heads // world_size
+        self.local_imm_dim = params.intermediate_dim // world_size
+
+
+    def weight_bytes(self) -> int:
+        # same shapes as the Parallel*Linear and ParallelEmbedding modules of one rank
+        p = self.params
+        local_q_dim = self.num_local_heads * self.head_dim
+        local_kv_dim = self.num_local_kv_heads * self.head_dim
+
+        attn = (local_q_dim + 2 * local_kv_dim) * p.hidden_dim + local_q_dim * p.hidden_dim
+        if self.attn_wqkv_bias_term:
+            attn += local_q_dim + 2 * local_kv_dim
+        if self.attn_wo_bias_term:
+            attn += p.hidden_dim
+
+        ffn = 3 * self.local_imm_dim * p.hidden_dim
+        if self.ffn_linear_bias_term:
+            ffn += 2 * self.local_imm_dim + p.hidden_dim
+        if p.num_experts > 1:
+            # experts are split like the dense ffn, the router is replicated
+            ffn = ffn * p.num_experts + p.hidden_dim * p.num_experts
+
+        norms = 2 * p.hidden_dim
+        layer = attn + ffn + norms
+
+        embedding = p.vocab_size * p.hidden_dim // self.world_size
+        output = p.vocab_size // self.world_size * p.hidden_dim
+        return (p.num_layers * layer + embedding + output + p.hidden_dim) * self.dtype_bytes
+
+
+    def activation_bytes(self) -> int:
+        # peak workspace of one step, the largest intermediates of a layer plus the logits
+        p = self.params
+        T = self.max_batch_tokens
+        local_q_dim = self.num_local_heads * self.head_dim
+        local_kv_dim = self.num_local_kv_heads * self.head_dim
+
+        hidden = 4 * T * p.hidden_dim # residual, norm output, attention and ffn output
+        qkv = T * (local_q_dim + 2 * local_kv_dim) * (1 if self.fused_qkv else 2) # unfused projections are concatenated
+        ffn = T * self.local_imm_dim * (2 if self.fused_ffn_glu else 3)
+        kv = 0
+        if not self.fused_kvcache:
+            # the unfused cache op hands dequantized key and value of every attended token to attention
+            kv_dim = local_kv_dim if self.friendly_gqa else local_q_dim
+            kv = 2 * self.max_kv_tokens * kv_dim
+        logits = T * p.vocab_size
+        return (hidden + max(qkv + kv, ffn) + logits) * self.dtype_bytes
+
+
+    def kv_bytes_per_token(self, quant_bit: int = None, quant_group: int = None, quant_zero_point: bool = None) -> int:
+        # cache and scale bytes of one token over all layers, defaults to the settings of params
+        p = self.params
+        quant_bit = p.cache_quant_bit if quant_bit is None else quant_bit
+        quant_group = p.cache_quant_group if quant_group is None else quant_group
+        quant_zero_point = p.cache_quant_zero_point if quant_zero_point is None else quant_zero_point
+
+        cache_dim, scale_dim = cache_quant_dims(self.head_dim, quant_bit, quant_group, quant_zero_point)
+        cache_elem_bytes = 1 if quant_bit > 0 else self.dtype_bytes
+        per_head = cache_dim * cache_elem_bytes + scale_dim * 2 # scales are float16
+        return p.num_layers * 2 * self.num_local_kv_heads * per_head
+
+
+    def kv_bytes_table(self) -> Dict[Tuple[int, int, bool], int]:
+        # (cache_layout, quant_bit, quant_zero_point) -> bytes per token. layouts only permute the
+        # cache shape, they are listed so that every deployable setting can be looked up
+        table = {}
+        for layout in range(4):
+            for quant_bit in [0, 8, 4]:
+                for zero_point in ([False] if quant_bit == 0 else [False, True]):
+                    table[(layout, quant_bit, zero_point)] = self.kv_bytes_per_token(quant_bit, None, zero_point)
+        return table
+
+
+    def max_cache_tokens(self) -> int:
+        # kv cache slots that fit in the budget left by weights and activations
+        free = self.memory_budget - self.weight_bytes() - self.activation_bytes()
+        if free <= 0:
+            raise Exception("memory budget of {} bytes does not hold {} bytes of weights and {} bytes of activations".format(
+                self.memory_budget, self.weight_bytes(), self.activation_bytes()))
+        return free // self.kv_bytes_per_token()
+
+
+    def max_cache_pages(self, page_size: int = None) -> int:
+        page_size = self.params.page_size if page_size is None else page_size
+        return self.max_cache_tokens() // page_size
+
+
+    def best_page_size(self, mean_seq_len: int, candidates: List[int] = [16, 32, 64, 128, 256],
+                       max_waste: float = 1.0 / 16) -> int:
+        # largest page whose half page lost at the tail of an average sequence stays under max_waste of it.
+        # large pages mean short page tables and whole attention tiles, small pages less fragmentation
+        best = min(candidates)
+        for page_size in sorted(candidates):
+            if page_size / 2 <= max_waste * mean_seq_len:
+                best = page_size
+        return best
+
+
+    def check(self, num_tokens: int):
+        # fail fast when a kv cache of num_tokens slots would not fit
+        if num_tokens > self.max_cache_tokens():
+            raise Exception("kv cache of {} tokens needs {} bytes, only {} tokens fit in the memory budget of {} bytes".format(
+                num_tokens, num_tokens * self.kv_bytes_per_token(), self.max_cache_tokens(), self.memory_budget))
+
+
+    def report(self) -> str:
+        p = self.params
+        lines = []
+        lines.append("world size: {}, memory budget per rank: {:.2f} GiB".format(self.world_size, self.memory_budget / 2**30))
+        lines.append("weights per rank: {:.2f} GiB".format(self.weight_bytes() / 2**30))
+        lines.append("activations per rank: {:.2f} GiB for {} tokens per step".format(
+            self.activation_bytes() / 2**30, self.max_batch_tokens))
+        for (layout, quant_bit, zero_point), nbytes in self.kv_bytes_table().items():
+            lines.append("kv bytes per token, layout {} quant_bit {} zero_point {}: {}".format(
+                layout, quant_bit, zero_point, nbytes))
+        tokens = self.max_cache_tokens()
+        lines.append("max tokens in flight: {} ({} pages of {} tokens)".format(tokens, tokens // p.page_size, p.page_size))
+        lines.append("best page_size for {} token sequences: {}".format(
+            self.max_kv_tokens, self.best_page_size(self.max_kv_tokens)))
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser('kv cache capacity planner')
+    parser.add_argument('--params', type=str, required=True, help='opmx params.json of the model')
+    parser.add_argument('--world_size', type=int, default=1)
+    parser.add_argument('--memory_budget_gib', type=float, required=True, help='device memory per rank')
+    parser.add_argument('--max_batch_tokens', type=int, default=4096)
+    parser.add_argument('--max_kv_tokens', type=int, default=0)
+    parser.add_argument('--cache_quant_bit', type=int, default=None)
+    parser.add_argument('--cache_quant_zero_point', action='store_true')
+    parser.add_argument('--page_size', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.params, "r") as f:
+        params = json.loads(f.read())
+    params = ModelParams(**params)
+    if args.cache_quant_bit is not None:
+        params.cache_quant_bit = args.cache_quant_bit
+    if args.cache_quant_zero_point:
+        params.cache_quant_zero_point = args.cache_quant_zero_point
+    if args.page_size is not None:
+        params.page_size = args.page_size
+
+    planner = CachePlanner(params, args.world_size, int(args.memory_budget_gib * 2**30),
+                           max_batch_tokens=args.max_batch_tokens, max_kv_tokens=args.max_kv_tokens)
+    print(planner.report())
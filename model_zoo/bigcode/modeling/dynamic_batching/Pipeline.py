@@ -9,6 +9,7 @@ from .Model import Transformer, TensorDumper
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../..")
 
 from ModelUtils import __Tokenizer__, __TextGenerator__
+from torch_function.dynamic_batching.MultiHeadAttention import causal_attn_mask
 
 
 class BatchState:
@@ -153,22 +154,10 @@ class LLaMA(__TextGenerator__):
             start_pos = torch.tensor([s.start_pos for s in batch_states], dtype=torch.int64).cuda()
             token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
 
-            # generate attention mask [sum(seqlens), pad(sum(kvlens), 16)]
+            # packed [seqlen, kvlen] causal block per sequence, see causal_attn_mask
             attn_mask = torch.empty(0, dtype=torch.float16)
             if self.model.params.auto_causal == False and decoding_batches < current_batches:
-                attn_mask = torch.zeros((seqstarts[-1], (kvstarts[-1] + 15) // 16 * 16), dtype=torch.float16).cuda()
-                for b in range(decoding_batches, current_batches):
-                    seqbeg = seqstarts[b]
-                    seqend = seqstarts[b+1]
-                    kvbeg = kvstarts[b]
-                    kvend = kvstarts[b+1]
-
-                    attn_mask[seqbeg:seqend, kvbeg:kvend] = (
-                        torch.triu(
-                            torch.full_like(attn_mask[seqbeg:seqend, kvbeg:kvend], float("-inf")),
-                            diagonal=1
-                        )
-                    )
+                attn_mask = causal_attn_mask(seqstarts, kvstarts, torch.float16).cuda()
 
             seqstarts = seqstarts.cuda()
             kvstarts = kvstarts.cuda()
@@ -35,6 +35,8 @@ def load(
     ffn_linear_bias_term: bool,
     load_to_cpu: bool,
     rotary_dim: int = 0,
+    cache_quant_bit: int = 8, # 4 or 8, only affected when quantized_cache == True
+    cache_quant_zero_point: bool = False, # asymmetric kv cache quantization
     dump_tensor_path: str = None,
     dump_steps: List[int] = []
 ) -> __TextGenerator__:
@@ -73,8 +75,9 @@ def load(
     model_params.cache_layout = cache_layout
     model_params.cache_mode = cache_mode
     if quantized_cache:
-        model_params.cache_quant_bit = 8
+        model_params.cache_quant_bit = cache_quant_bit
         model_params.cache_quant_group = 8
+        model_params.cache_quant_zero_point = cache_quant_zero_point
     else:
         model_params.cache_quant_bit = 0
         model_params.cache_quant_group = 0
@@ -136,6 +139,8 @@ def random(
     ffn_linear_bias_term: bool,
     load_to_cpu: bool,
     rotary_dim: int = 0,
+    cache_quant_bit: int = 8, # 4 or 8, only affected when quantized_cache == True
+    cache_quant_zero_point: bool = False, # asymmetric kv cache quantization
     dump_tensor_path: str = None,
     dump_steps: List[int] = []
 ) -> __TextGenerator__:
@@ -166,8 +171,9 @@ def random(
     model_params.cache_layout = cache_layout
     model_params.cache_mode = cache_mode
     if quantized_cache:
-        model_params.cache_quant_bit = 8
+        model_params.cache_quant_bit = cache_quant_bit
         model_params.cache_quant_group = 8
+        model_params.cache_quant_zero_point = cache_quant_zero_point
     else:
         model_params.cache_quant_bit = 0
         model_params.cache_quant_group = 0
@@ -46,9 +46,11 @@ class Attention(nn.Module):
         self.layer_id = layer_id
         self.cache_quant_bit = args.cache_quant_bit
         self.cache_quant_group = args.cache_quant_group
+        self.cache_quant_zero_point = args.cache_quant_zero_point
         self.cache_layout = args.cache_layout
         self.cache_mode = args.cache_mode
         self.page_size = args.page_size
+        self.sliding_window = args.sliding_window or 0 # null in some huggingface configs
 
         self.friendly_gqa = friendly_gqa
         self.fused_qkv = fused_qkv
@@ -88,7 +90,8 @@ class Attention(nn.Module):
                 seqstarts: torch.Tensor, kvstarts: torch.Tensor, cachestarts: torch.Tensor,
                 decoding_batches: torch.Tensor, start_pos: torch.Tensor,
                 max_seqlen: torch.Tensor, max_kvlen: torch.Tensor,
-                kv_cache: torch.Tensor, kv_scale: torch.Tensor = None):
+                kv_cache: torch.Tensor, kv_scale: torch.Tensor = None,
+                metadata: Optional[OPMX.dynamic_batching.BatchMetadata] = None):
         expanded_shape = (0, -1, self.head_dim)
         if self.fused_qkv:
             xqkv = self.wqkv(x)
@@ -105,14 +108,39 @@ class Attention(nn.Module):
         # TensorDumper.dump(xk, "layer{}_reshaped_xk".format(self.layer_id))
         # TensorDumper.dump(xv, "layer{}_reshaped_xv".format(self.layer_id))
 
-        if self.with_rope:
+        # rope and the cache write in one op, eager only: exported graphs keep the separate ops
+        fused_prologue = (self.fused_qkv and self.fused_kvcache and self.with_rope
+                          and self.cache_mode != 2 and not torch.onnx.is_in_onnx_export())
+        if fused_prologue:
+            xq = OPMX.dynamic_batching.rotary_key_value_cache(
+                                            xqkv, seqstarts, cachestarts,
+                                            start_pos, max_seqlen,
+                                            kv_cache, kv_scale,
+                                            num_heads=self.num_local_heads,
+                                            num_kv_heads=self.num_local_kv_heads,
+                                            rotary_dim=self.rotary_dim,
+                                            theta=self.rope_theta,
+                                            max_position_embeddings=self.max_position_embeddings,
+                                            scaling_type=self.rope_scaling_type,
+                                            scaling_factor=self.rope_scaling_factor,
+                                            num_layer=self.num_layers,
+                                            layer_idx=self.layer_id,
+                                            quant_bit=self.cache_quant_bit,
+                                            quant_group=self.cache_quant_group,
+                                            cache_mode=self.cache_mode,
+                                            cache_layout=self.cache_layout,
+                                            page_size=self.page_size,
+                                            quant_zero_point=self.cache_quant_zero_point,
+                                            metadata=metadata)
+        elif self.with_rope:
             xq, xk = OPMX.dynamic_batching.rotary_position_embedding(
                                             xq, xk, seqstarts,
                                             start_pos, max_seqlen,
                                             rotary_dim=self.rotary_dim,
                                             max_position_embeddings=self.max_position_embeddings,
                                             theta=self.rope_theta, scaling_type=self.rope_scaling_type,
-                                            scaling_factor=self.rope_scaling_factor)
+                                            scaling_factor=self.rope_scaling_factor,
+                                            metadata=metadata)
             # TensorDumper.dump(xq, "layer{}_rotary_position_embedding_out_xq".format(self.layer_id))
             # TensorDumper.dump(xk, "layer{}_rotary_position_embedding_out_xk".format(self.layer_id))
 
@@ -133,9 +161,13 @@ class Attention(nn.Module):
                 layer_idx=self.layer_id,
                 quant_bit=self.cache_quant_bit,
                 quant_group=self.cache_quant_group,
+                quant_zero_point=self.cache_quant_zero_point,
                 cache_mode=self.cache_mode,
                 cache_layout=self.cache_layout,
-                page_size=self.page_size)
+                page_size=self.page_size,
+                sliding_window=self.sliding_window,
+                metadata=metadata,
+                kv_stored=fused_prologue)
         else:
             keys, values = OPMX.dynamic_batching.key_value_cache(
                                             xk, xv, seqstarts, kvstarts,
@@ -146,10 +178,13 @@ class Attention(nn.Module):
                                             layer_idx=self.layer_id,
                                             quant_bit=self.cache_quant_bit,
                                             quant_group=self.cache_quant_group,
+                                            quant_zero_point=self.cache_quant_zero_point,
                                             num_repeat=self.num_local_kv_repeats if self.friendly_gqa else 1,
                                             cache_mode=self.cache_mode,
                                             cache_layout=self.cache_layout,
-                                            page_size=self.page_size)
+                                            page_size=self.page_size,
+                                            sliding_window=self.sliding_window,
+                                            metadata=metadata)
             # TensorDumper.dump(kv_cache, "layer{}_modified_kv_cache".format(self.layer_id))
             # TensorDumper.dump(kv_scale, "layer{}_modified_kv_scale".format(self.layer_id))
             # TensorDumper.dump(keys, "layer{}_key_value_cache_out_keys".format(self.layer_id))
@@ -164,7 +199,9 @@ class Attention(nn.Module):
                                             head_dim=self.head_dim,
                                             is_causal=self.auto_causal,
                                             is_alibi=self.with_alibi and self.fused_alibi,
-                                            num_kv_heads=0 if self.friendly_gqa else self.num_local_kv_heads)
+                                            num_kv_heads=0 if self.friendly_gqa else self.num_local_kv_heads,
+                                            sliding_window=self.sliding_window,
+                                            metadata=metadata)
         attn = OPMX.reshape(attn, (0, -1))
         # TensorDumper.dump(attn, "layer{}_multi_head_attention_out".format(self.layer_id))
 
@@ -263,14 +300,15 @@ class TransformerBlock(nn.Module):
                 seqstarts: torch.Tensor, kvstarts: torch.Tensor, cachestarts: torch.Tensor,
                 decoding_batches: torch.Tensor, start_pos: torch.Tensor,
                 max_seqlen: torch.Tensor, max_kvlen: torch.Tensor,
-                kv_cache: torch.Tensor, kv_sacle: torch.Tensor = None):
+                kv_cache: torch.Tensor, kv_sacle: torch.Tensor = None,
+                metadata: Optional[OPMX.dynamic_batching.BatchMetadata] = None):
         norm, x = self.attention_norm(x, skip)
         # TensorDumper.dump(norm, "layer{}_attention_norm_out".format(self.layer_id))
         # TensorDumper.dump(x, "layer{}_attention_norm_skip_out".format(self.layer_id))
         attn = self.attention.forward(norm, attn_mask, seqstarts, kvstarts,
                                       cachestarts, decoding_batches,
                                       start_pos, max_seqlen, max_kvlen,
-                                      kv_cache, kv_sacle)
+                                      kv_cache, kv_sacle, metadata)
         norm, h = self.ffn_norm(x, attn)
         # TensorDumper.dump(norm, "layer{}_ffn_norm_out".format(self.layer_id))
         # TensorDumper.dump(h, "layer{}_ffn_norm_skip_out".format(self.layer_id))
@@ -342,7 +380,8 @@ class Transformer(nn.Module):
                 seqstarts: torch.Tensor, kvstarts: torch.Tensor,
                 cachestarts: torch.Tensor, decoding_batches: torch.Tensor,
                 start_pos: torch.Tensor, max_seqlen: torch.Tensor,  max_kvlen: torch.Tensor,
-                kv_cache: torch.Tensor, kv_scale: torch.Tensor = None):
+                kv_cache: torch.Tensor, kv_scale: torch.Tensor = None,
+                attention_mass: Optional[torch.Tensor] = None):
         h = self.tok_embeddings(tokens)
         # TensorDumper.dump(h, "emb_out")
 
@@ -368,11 +407,19 @@ class Transformer(nn.Module):
             attn_mask = OPMX.dynamic_batching.alibi_mask(seqstarts, kvstarts, attn_mask, self.params.num_heads, h.dtype)
             # TensorDumper.dump(attn_mask, "alibi_mask")
 
+        # indices every layer would derive again from the batch layout, onnx export keeps the plain inputs
+        metadata = None
+        if not torch.onnx.is_in_onnx_export():
+            metadata = OPMX.dynamic_batching.BatchMetadata(
+                seqstarts, kvstarts, cachestarts, start_pos, decoding_batches,
+                self.params.cache_mode, self.params.page_size, self.params.sliding_window or 0, kv_cache.device,
+                attention_mass)
+
         norm = None
         for layer in self.layers:
             h, norm = layer(h, norm, attn_mask, seqstarts, kvstarts, cachestarts,
                             decoding_batches, start_pos, max_seqlen, max_kvlen,
-                            kv_cache, _kv_scale)
+                            kv_cache, _kv_scale, metadata)
 
         h, norm = self.norm(h, norm)
         # TensorDumper.dump(h, "last_rms_norm")
@@ -390,7 +437,8 @@ class Transformer(nn.Module):
                       seqstarts: torch.Tensor, kvstarts: torch.Tensor,
                       cachestarts: torch.Tensor, decoding_batches: torch.Tensor,
                       start_pos: torch.Tensor, max_seqlen: torch.Tensor,  max_kvlen: torch.Tensor,
-                      kv_cache: torch.Tensor, kv_scale: torch.Tensor = None):
+                      kv_cache: torch.Tensor, kv_scale: torch.Tensor = None,
+                      attention_mass: Optional[torch.Tensor] = None):
         h = self.tok_embeddings(tokens)
         # TensorDumper.dump(h, "emb_out")
 
@@ -416,11 +464,19 @@ class Transformer(nn.Module):
             attn_mask = OPMX.dynamic_batching.alibi_mask(seqstarts, kvstarts, attn_mask, self.params.num_heads, h.dtype)
             # TensorDumper.dump(attn_mask, "alibi_mask")
 
+        # indices every layer would derive again from the batch layout, onnx export keeps the plain inputs
+        metadata = None
+        if not torch.onnx.is_in_onnx_export():
+            metadata = OPMX.dynamic_batching.BatchMetadata(
+                seqstarts, kvstarts, cachestarts, start_pos, decoding_batches,
+                self.params.cache_mode, self.params.page_size, self.params.sliding_window or 0, kv_cache.device,
+                attention_mass)
+
         norm = None
         for layer in self.layers:
             h, norm = layer(h, norm, attn_mask, seqstarts, kvstarts, cachestarts,
                             decoding_batches, start_pos, max_seqlen, max_kvlen,
-                            kv_cache, _kv_scale)
+                            kv_cache, _kv_scale, metadata)
 
         h, norm = self.norm(h, norm)
         # TensorDumper.dump(h, "last_rms_norm")
@@ -9,6 +9,10 @@ from .Model import Transformer, TensorDumper
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../..")
 
 from ModelUtils import __Tokenizer__, __TextGenerator__
+from torch_function.dynamic_batching.MultiHeadAttention import causal_attn_mask
+from torch_function.KeyValueCacheQuantUtils import cache_quant_dims
+from ModelPlanner import CachePlanner
+from ModelCache import PagedCacheManager, ContiguousCacheManager, PrefixCache, CacheSwapper, CacheCompactor, SessionStore, retained_positions, move_cache_tokens
 
 
 class BatchState:
@@ -19,12 +23,46 @@ class BatchState:
         self.cache_starts = 0
         self.output_tokens = []
         self.is_decoding = False
+        self.shared_nodes = [] # prefix cache pages read by this sequence
 
 
 class LLaMA(__TextGenerator__):
     def __init__(self, model: Transformer):
         self.model = model
         self.context_chunking = False
+        self.chunk_size = 4 # prompt tokens prefilled per step when context_chunking
+        self.cache_pages = 0 # size of the kv cache page pool when cache_mode == 1, 0 to fit all prompts at once
+        self.cache_tokens = 0 # size of the contiguous kv cache when cache_mode == 0 or 2, 0 to fit all prompts at once
+        self.cache_compaction = False # pack running sequences to the front of the contiguous kv cache when it is fragmented
+        self.memory_budget = 0 # device bytes per rank for weights, activations and kv cache, 0 to skip capacity planning
+        self.prefix_caching = False # reuse kv pages of shared prompt prefixes, needs cache_mode == 1 and cache_pages > 0
+        self.preemption = False # over-subscribe the page pool and preempt the latest sequences when it runs out
+        self.cache_swap_pages = 0 # pinned host pages holding preempted sequences, 0 to recompute them on resume
+        self.kv_budget = 0 # evict to keep the kv of a sequence within kv_budget tokens, needs cache_mode == 1, 0 to keep all
+        self.sink_tokens = 4 # leading tokens never evicted, they absorb the attention of streaming sessions
+        self.heavy_hitter_tokens = 0 # tokens kept by accumulated attention mass besides sinks and recent ones, needs fused_kvcache
+        self.session_spill_dir = None # idle sessions are spilled to memory mapped files here, None to drop them
+
+        # kv cache kept alive between generate calls when prefix caching or running sessions
+        self.kv_cache = None
+        self.kv_scale = None
+        self.page_manager = None
+        self.prefix_cache = None
+        self.swapper = None
+        self.session_store = None
+
+
+    def end_session(self, session_id):
+        # release the kv of a conversation that will not continue
+        if self.session_store is not None:
+            self.session_store.discard(session_id)
+
+
+    def spill_sessions(self):
+        # move the kv of every idle session out of the page pool
+        if self.session_store is not None:
+            while self.session_store.spill_lru():
+                pass
 
 
     def generate(
@@ -36,7 +74,10 @@ class LLaMA(__TextGenerator__):
         temperature: float,
         top_k: int,
         top_p: float,
+        session_ids: List = None,
     ) -> List[List[int]]:
+        # session_ids: one conversation id or None per prompt. a prompt continuing a session repeats
+        # the whole conversation, the part whose kv is still cached from the last turn is not prefilled again.
         def sample_top_p(probs, p):
             probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
             probs_sum = torch.cumsum(probs_sort, dim=-1)
@@ -53,17 +94,6 @@ class LLaMA(__TextGenerator__):
             return (seqlen + page_size - 1) // page_size * page_size
 
 
-        def gen_page_list(start, seqlen, max_len):
-            page_size = self.model.params.page_size
-            start_page = round_up_to_page(start) // page_size
-            max_page_count = round_up_to_page(max_len) // page_size
-            eff_page_count = round_up_to_page(seqlen) // page_size
-            page_list = [i * page_size for i in range(start_page, start_page + eff_page_count)]
-            if eff_page_count < max_page_count:
-                page_list = page_list + [-1 for i in range(eff_page_count, max_page_count)]
-            return page_list
-
-
         unprocessed_prompt_tokens_ids = []
         total_cache_len = 0
         for i, p in enumerate(prompts_ids):
@@ -72,6 +102,57 @@ class LLaMA(__TextGenerator__):
                 total_cache_len += len(p) + max_gen_len
             if self.model.params.cache_mode == 1:
                 total_cache_len += round_up_to_page(len(p) + max_gen_len)
+            if self.model.params.cache_mode == 2:
+                # ring buffer, the cache of a sequence never outgrows its window
+                total_cache_len += self.model.params.sliding_window
+        if self.model.params.cache_mode != 1 and self.cache_tokens > 0:
+            total_cache_len = self.cache_tokens
+        if self.model.params.cache_mode == 1 and self.cache_pages > 0:
+            total_cache_len = self.cache_pages * self.model.params.page_size
+
+        if session_ids is not None and len(session_ids) != len(prompts_ids):
+            raise Exception("{} session ids for {} prompts".format(len(session_ids), len(prompts_ids)))
+        if session_ids is not None and (self.prefix_caching or self.kv_budget > 0):
+            raise Exception("sessions can not be combined with prefix caching or kv_budget")
+        persistent = self.prefix_caching or session_ids is not None
+
+        if self.memory_budget > 0:
+            # a configured cache must fit next to weights and activations, an unconfigured one is
+            # shrunk to what fits and admission waits for running sequences instead of running out of memory
+            planner = CachePlanner(self.model.params, torch.distributed.get_world_size(group=self.model.proc_group),
+                                   self.memory_budget, self.model.fused_qkv, self.model.fused_kvcache,
+                                   self.model.fused_ffn_glu, self.model.layers[0].attention.friendly_gqa,
+                                   max_batch_tokens=sum([min(len(p), self.chunk_size) if self.context_chunking else len(p) for p in prompts_ids]),
+                                   max_kv_tokens=total_cache_len)
+            configured = self.cache_pages > 0 if self.model.params.cache_mode == 1 else self.cache_tokens > 0
+            if configured:
+                planner.check(total_cache_len)
+            else:
+                max_cache_len = planner.max_cache_tokens()
+                if self.model.params.cache_mode == 1:
+                    max_cache_len = max_cache_len // self.model.params.page_size * self.model.params.page_size
+                total_cache_len = min(total_cache_len, max_cache_len)
+
+        page_manager = None
+        prefix_cache = None
+        if self.model.params.cache_mode == 1:
+            if persistent:
+                if self.cache_pages <= 0:
+                    raise Exception("prefix caching and sessions need a fixed size page pool, set cache_pages")
+                if self.page_manager is None:
+                    self.page_manager = PagedCacheManager(self.cache_pages, self.model.params.page_size)
+                    if self.prefix_caching:
+                        self.prefix_cache = PrefixCache(self.page_manager)
+                page_manager = self.page_manager
+                prefix_cache = self.prefix_cache
+            else:
+                page_manager = PagedCacheManager(total_cache_len // self.model.params.page_size, self.model.params.page_size)
+        elif persistent or self.preemption:
+            raise Exception("prefix caching, sessions and preemption need cache_mode == 1")
+
+        region_manager = None
+        if self.model.params.cache_mode == 0 or self.model.params.cache_mode == 2:
+            region_manager = ContiguousCacheManager(total_cache_len)
 
         head_dim = self.model.params.head_dim if self.model.params.head_dim is not None else self.model.params.hidden_dim // self.model.params.num_heads
         num_local_kv_heads = self.model.params.num_kv_heads // torch.distributed.get_world_size(group=self.model.proc_group)
@@ -88,45 +169,233 @@ class LLaMA(__TextGenerator__):
         else:
             raise Exception("unsupported cache_layout: {}".format(self.model.params.cache_layout))
 
-        if self.model.params.cache_quant_bit == 8:
-            scale_head_dim = head_dim // self.model.params.cache_quant_group
-            kv_cache = torch.zeros(cache_prefix_shape + (head_dim,), dtype=torch.int8).cuda()
-            kv_scale = torch.zeros(cache_prefix_shape + (scale_head_dim,), dtype=torch.float16).cuda()
+        if persistent and self.kv_cache is not None:
+            kv_cache, kv_scale = self.kv_cache, self.kv_scale
+        elif self.model.params.cache_quant_bit > 0:
+            cache_dim, scale_dim = cache_quant_dims(head_dim, self.model.params.cache_quant_bit,
+                self.model.params.cache_quant_group, self.model.params.cache_quant_zero_point)
+            kv_cache = torch.zeros(cache_prefix_shape + (cache_dim,), dtype=torch.int8).cuda()
+            kv_scale = torch.zeros(cache_prefix_shape + (scale_dim,), dtype=torch.float16).cuda()
         else:
             kv_cache = torch.zeros(cache_prefix_shape + (head_dim,), dtype=torch.float16).cuda()
             kv_scale = torch.empty(0)
+        if persistent:
+            self.kv_cache, self.kv_scale = kv_cache, kv_scale
+
+        sessions = None
+        if session_ids is not None:
+            if self.session_store is None:
+                self.session_store = SessionStore(page_manager, kv_cache, kv_scale,
+                                                  self.model.params.cache_layout, self.session_spill_dir)
+            sessions = self.session_store
+
+        swapper = None
+        if self.preemption and self.cache_swap_pages > 0:
+            if self.swapper is None or self.swapper.kv_cache is not kv_cache:
+                self.swapper = CacheSwapper(kv_cache, kv_scale, self.model.params.cache_layout,
+                                            self.model.params.page_size, self.cache_swap_pages)
+            swapper = self.swapper
+
+        compactor = None
+        attention_mass = None
+        if self.kv_budget > 0:
+            page_size = self.model.params.page_size
+            if page_manager is None or self.prefix_caching or self.preemption:
+                raise Exception("kv_budget needs cache_mode == 1 without prefix caching and preemption")
+            if self.kv_budget - page_size <= self.sink_tokens + self.heavy_hitter_tokens:
+                raise Exception("kv_budget {} leaves no recent tokens after a page of {} and {} sink, {} heavy hitter tokens".format(
+                    self.kv_budget, page_size, self.sink_tokens, self.heavy_hitter_tokens))
+            if self.heavy_hitter_tokens > 0:
+                if not self.model.fused_kvcache:
+                    raise Exception("heavy hitter eviction needs fused_kvcache to collect attention mass")
+                attention_mass = torch.zeros(total_cache_len, dtype=torch.float32).cuda()
+            attention = self.model.layers[0].attention
+            compactor = CacheCompactor(kv_cache, kv_scale, self.model.params.cache_layout, page_size,
+                                       self.model.params.cache_quant_bit, self.model.params.cache_quant_group,
+                                       self.model.params.cache_quant_zero_point,
+                                       attention.with_rope, attention.rotary_dim, attention.rope_theta,
+                                       attention.rope_scaling_factor if attention.rope_scaling_type == 'linear' else 1.0,
+                                       attention_mass)
+
+        # running sequences only reserve their next token when over-subscribing
+        reserve_gen_len = 1 if self.preemption else max_gen_len
+
+
+        def reserve_len(input_len: int):
+            # a sequence under a kv budget never holds more than its prompt or the budget
+            if compactor is not None:
+                return min(input_len + reserve_gen_len, max(input_len, self.kv_budget))
+            return input_len + reserve_gen_len
+
+
+        def region_len(input_len: int):
+            if self.model.params.cache_mode == 2:
+                return self.model.params.sliding_window
+            return input_len + max_gen_len
+
+
+        def compact_regions():
+            # move the cached tokens of running sequences down and point them at their new regions
+            src, dst = [], []
+            moves = region_manager.compact()
+            for s in batch_states:
+                if s.tid not in moves:
+                    continue
+                old_offset, new_offset = moves[s.tid]
+                # slots in use: the whole prefix, or the filled part of the ring
+                num_tokens = s.start_pos if self.model.params.cache_mode == 0 else min(s.start_pos, self.model.params.sliding_window)
+                src.append(torch.arange(old_offset, old_offset + num_tokens, dtype=torch.int64))
+                dst.append(torch.arange(new_offset, new_offset + num_tokens, dtype=torch.int64))
+                s.cache_starts = new_offset
+            if len(src) > 0:
+                move_cache_tokens(kv_cache, kv_scale, self.model.params.cache_layout,
+                                  torch.cat(src).to(kv_cache.device), torch.cat(dst).to(kv_cache.device))
 
-        max_prompt_len = max([len(t) for t in unprocessed_prompt_tokens_ids])
-        max_cache_len = round_up_to_page(max_prompt_len + max_gen_len)
 
         batch_states = []
-        allocated_cache_len = 0
+        preempted_states = []
         processed_batches = 0
         TensorDumper.step = 0
         finished_tokens = [[] for _ in unprocessed_prompt_tokens_ids]
         while True:
+            # resume preempted sequences before admitting new ones
+            swap_in_tables = {}
+            while len(preempted_states) > 0:
+                s = preempted_states[0]
+                if not page_manager.can_reserve(s.start_pos + 1, len(s.shared_nodes)):
+                    if len(batch_states) == 0:
+                        raise Exception("kv cache of {} pages is too small to resume a sequence of {} tokens".format(
+                            page_manager.num_pages, s.start_pos + 1))
+                    break
+                page_manager.reserve(s.tid, s.start_pos + 1, [n.page for n in s.shared_nodes])
+                if swapper is not None and swapper.is_swapped(s.tid):
+                    swap_in_tables[s.tid] = page_manager.allocate(s.tid, s.start_pos)[len(s.shared_nodes):]
+                batch_states.append(preempted_states.pop(0))
+            if swapper is not None:
+                swapper.swap_in(swap_in_tables)
+
             # if len(unprocessed_prompt_tokens_ids) > 0:
-            while len(unprocessed_prompt_tokens_ids) > 0:
+            while len(preempted_states) == 0 and len(unprocessed_prompt_tokens_ids) > 0:
+                input_len = len(unprocessed_prompt_tokens_ids[0])
+                shared_nodes = []
+                if prefix_cache is not None:
+                    # the last prompt token is always prefilled to produce the first logits
+                    shared_nodes = prefix_cache.match(unprocessed_prompt_tokens_ids[0], input_len - 1)
+                    prefix_cache.acquire(shared_nodes)
+                session_id = None if sessions is None else session_ids[processed_batches]
+                session_pages, session_len = [], 0
+                if session_id is not None:
+                    session_pages, session_len = sessions.acquire(session_id, unprocessed_prompt_tokens_ids[0])
+                if sessions is not None:
+                    # idle sessions give way to running conversations
+                    while not page_manager.can_reserve(reserve_len(input_len), len(session_pages)) and sessions.spill_lru():
+                        pass
+                if page_manager is not None and not page_manager.can_reserve(reserve_len(input_len), len(shared_nodes) + len(session_pages)):
+                    if prefix_cache is not None:
+                        prefix_cache.release(shared_nodes)
+                    if session_len > 0:
+                        sessions.save(session_id, unprocessed_prompt_tokens_ids[0][:session_len], session_pages)
+                    if len(batch_states) == 0:
+                        raise Exception("kv cache of {} pages is too small for a sequence of {} tokens".format(
+                            page_manager.num_pages, reserve_len(input_len)))
+                    # wait for running sequences to return their pages
+                    break
+                if region_manager is not None and not region_manager.can_allocate(region_len(input_len)):
+                    if region_len(input_len) > total_cache_len:
+                        raise Exception("contiguous kv cache of {} tokens is too small for a sequence of {} tokens".format(
+                            total_cache_len, region_len(input_len)))
+                    if self.cache_compaction and region_manager.num_free_tokens() >= region_len(input_len):
+                        compact_regions()
+                    elif len(batch_states) == 0:
+                        raise Exception("contiguous kv cache of {} tokens has no region of {} tokens".format(
+                            total_cache_len, region_len(input_len)))
+                    else:
+                        # wait for running sequences to return their regions
+                        break
+
                 state = BatchState()
                 state.tid = processed_batches
 
                 state.input_tokens = unprocessed_prompt_tokens_ids.pop(0)
-                if self.context_chunking:
-                    state.input_tokens.reverse()
-                input_len = len(state.input_tokens)
 
-                if self.model.params.cache_mode == 0:
-                    state.cache_starts = allocated_cache_len
-                    allocated_cache_len += input_len + max_gen_len
+                if region_manager is not None:
+                    state.cache_starts = region_manager.allocate(state.tid, region_len(input_len))
                 if self.model.params.cache_mode == 1:
-                    # paged attetion. We must align cache len to page size to avoid overlap
-                    cache_len = round_up_to_page(input_len + max_gen_len)
-                    state.cache_starts = gen_page_list(allocated_cache_len, cache_len, max_cache_len)
-                    allocated_cache_len += cache_len
+                    # paged attetion. pages are taken from the pool on demand while the sequence grows
+                    page_manager.reserve(state.tid, reserve_len(input_len), [n.page for n in shared_nodes] + session_pages)
+                if prefix_cache is not None:
+                    # only the uncached suffix is prefilled
+                    state.shared_nodes = shared_nodes
+                    state.start_pos = len(shared_nodes) * self.model.params.page_size
+                    state.input_tokens = state.input_tokens[state.start_pos:]
+                    prefix_cache.record(state.start_pos, input_len)
+                if session_len > 0:
+                    # the conversation so far is cached, only the new turn is prefilled
+                    state.start_pos = session_len
+                    state.input_tokens = state.input_tokens[session_len:]
+
+                if self.context_chunking:
+                    state.input_tokens.reverse()
 
                 processed_batches += 1
                 batch_states.append(state)
 
+            if compactor is not None:
+                # sequences reaching the budget drop to a page below it, so compaction runs once per page of decoding
+                for s in batch_states:
+                    if not s.is_decoding or s.start_pos < self.kv_budget:
+                        continue
+                    page_table = page_manager.page_tables[s.tid]
+                    mass = None
+                    if attention_mass is not None:
+                        mass = attention_mass[compactor.token_slots(page_table, torch.arange(s.start_pos).cuda())]
+                    positions = retained_positions(s.start_pos, self.kv_budget - self.model.params.page_size,
+                                                   self.sink_tokens, self.heavy_hitter_tokens, mass)
+                    compactor.compact(page_table, positions, s.start_pos)
+                    page_manager.truncate(s.tid, len(positions))
+                    s.start_pos = len(positions)
+
+            if self.preemption:
+                # preempt the latest admitted sequences until the pages of this step fit in the pool
+                def step_len(s: BatchState):
+                    if s.is_decoding:
+                        return 1
+                    return len(s.input_tokens[-self.chunk_size:]) if self.context_chunking else len(s.input_tokens)
+
+
+                def needed_pages():
+                    return sum([max(0, page_manager.pages_of(s.start_pos + step_len(s)) - len(page_manager.page_tables[s.tid]))
+                                for s in batch_states])
+
+
+                swap_out_tables = {}
+                released_pages = []
+                while needed_pages() > page_manager.num_available_pages() + len(released_pages):
+                    if len(batch_states) == 1:
+                        raise Exception("kv cache of {} pages is too small for a single sequence".format(page_manager.num_pages))
+                    victim = max(batch_states, key=lambda s: s.tid)
+                    batch_states.remove(victim)
+                    owned_pages = page_manager.detach(victim.tid)[len(victim.shared_nodes):]
+                    swapping_pages = sum([len(t) for t in swap_out_tables.values()])
+                    if swapper is not None and len(owned_pages) <= swapper.num_free_host_pages() - swapping_pages:
+                        swap_out_tables[victim.tid] = owned_pages
+                    else:
+                        # no room on host, drop the kv and prefill the whole history again on resume
+                        victim.start_pos = len(victim.shared_nodes) * self.model.params.page_size
+                        victim.input_tokens = (prompts_ids[victim.tid] + victim.output_tokens)[victim.start_pos:]
+                        if self.context_chunking:
+                            victim.input_tokens.reverse()
+                        victim.is_decoding = False
+                    released_pages.extend(owned_pages)
+                    preempted_states.append(victim)
+                preempted_states.sort(key=lambda s: s.tid)
+                if swapper is not None:
+                    swapper.swap_out(swap_out_tables)
+                page_manager.recycle(released_pages)
+
+            # decoding sequences must lead the batch, see decoding_batches
+            batch_states.sort(key=lambda s: 0 if s.is_decoding else 1)
+
             current_batches = len(batch_states)
             decoding_batches = sum([1 if s.is_decoding else 0 for s in batch_states])
             seqstarts = torch.zeros(current_batches + 1, dtype=torch.int64)
@@ -137,14 +406,24 @@ class LLaMA(__TextGenerator__):
             # context chunking only take 4 token at once
             if self.context_chunking:
                 for b, s in enumerate(batch_states):
-                    seqlens.append(len(s.input_tokens[-4:]) if not s.is_decoding else 1)
-                    token_ids.extend(s.input_tokens[-4:][::-1] if not s.is_decoding else [s.output_tokens[-1]])
+                    seqlens.append(len(s.input_tokens[-self.chunk_size:]) if not s.is_decoding else 1)
+                    token_ids.extend(s.input_tokens[-self.chunk_size:][::-1] if not s.is_decoding else [s.output_tokens[-1]])
             else:
                 for b, s in enumerate(batch_states):
                     seqlens.append(len(s.input_tokens) if not s.is_decoding else 1)
                     token_ids.extend(s.input_tokens if not s.is_decoding else [s.output_tokens[-1]])
 
-            kvlens = [s.start_pos + l for (s, l) in zip(batch_states, seqlens)]
+            if self.model.params.cache_mode == 2:
+                # the ring holds the last sliding_window - 1 tokens the new ones can still see
+                kvlens = [min(s.start_pos, self.model.params.sliding_window - 1) + l for (s, l) in zip(batch_states, seqlens)]
+            else:
+                kvlens = [s.start_pos + l for (s, l) in zip(batch_states, seqlens)]
+            if page_manager is not None:
+                for s, kvlen in zip(batch_states, kvlens):
+                    page_manager.allocate(s.tid, kvlen)
+                max_pages = max([len(page_manager.page_tables[s.tid]) for s in batch_states])
+                for s in batch_states:
+                    s.cache_starts = page_manager.cache_starts(s.tid, max_pages)
             seqstarts[1:] = torch.tensor(seqlens, dtype=torch.int64)
             kvstarts[1:] = torch.tensor(kvlens, dtype=torch.int64)
             seqstarts = seqstarts.cumsum(0)
@@ -153,22 +432,10 @@ class LLaMA(__TextGenerator__):
             start_pos = torch.tensor([s.start_pos for s in batch_states], dtype=torch.int64).cuda()
             token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
 
-            # generate attention mask [sum(seqlens), pad(sum(kvlens), 16)]
+            # packed [seqlen, kvlen] causal block per sequence, see causal_attn_mask
             attn_mask = torch.empty(0, dtype=torch.float16)
             if self.model.params.auto_causal == False and decoding_batches < current_batches:
-                attn_mask = torch.zeros((seqstarts[-1], (kvstarts[-1] + 15) // 16 * 16), dtype=torch.float16).cuda()
-                for b in range(decoding_batches, current_batches):
-                    seqbeg = seqstarts[b]
-                    seqend = seqstarts[b+1]
-                    kvbeg = kvstarts[b]
-                    kvend = kvstarts[b+1]
-
-                    attn_mask[seqbeg:seqend, kvbeg:kvend] = (
-                        torch.triu(
-                            torch.full_like(attn_mask[seqbeg:seqend, kvbeg:kvend], float("-inf")),
-                            diagonal=1
-                        )
-                    )
+                attn_mask = causal_attn_mask(seqstarts, kvstarts, torch.float16).cuda()
 
             seqstarts = seqstarts.cuda()
             kvstarts = kvstarts.cuda()
@@ -179,7 +446,7 @@ class LLaMA(__TextGenerator__):
 
             logits = self.model.forward(token_ids, attn_mask, seqstarts, kvstarts,
                                         cachestarts, decoding_batches, start_pos,
-                                        max_seqlen, max_kvlen, kv_cache, kv_scale)
+                                        max_seqlen, max_kvlen, kv_cache, kv_scale, attention_mass)
             TensorDumper.step += 1
 
             if temperature > 0:
@@ -195,7 +462,7 @@ class LLaMA(__TextGenerator__):
             for b, s in enumerate(batch_states):
                 s.start_pos += seqlens[b]
                 if self.context_chunking:
-                    s.input_tokens = s.input_tokens[:-4]
+                    s.input_tokens = s.input_tokens[:-self.chunk_size]
                     s.is_decoding = len(s.input_tokens) == 0
                 else:
                     s.input_tokens = []
@@ -211,8 +478,22 @@ class LLaMA(__TextGenerator__):
             for b in removed_batch:
                 s = batch_states[b]
                 finished_tokens[s.tid] = s.output_tokens
+                if prefix_cache is not None:
+                    # tokens whose kv is in the cache: prompt and all output tokens but the last one
+                    cached_tokens = (prompts_ids[s.tid] + s.output_tokens)[:s.start_pos]
+                    prefix_cache.insert(cached_tokens, page_manager.detach(s.tid), s.shared_nodes)
+                elif sessions is not None and session_ids[s.tid] is not None:
+                    # keep the conversation for its next turn, the last output token is not in the cache yet
+                    cached_tokens = (prompts_ids[s.tid] + s.output_tokens)[:s.start_pos]
+                    sessions.save(session_ids[s.tid], cached_tokens, page_manager.detach(s.tid))
+                elif page_manager is not None:
+                    if compactor is not None:
+                        compactor.clear_mass(page_manager.page_tables[s.tid], s.start_pos)
+                    page_manager.free(s.tid)
+                elif region_manager is not None:
+                    region_manager.free(s.tid)
                 batch_states.pop(b)
-            if len(batch_states) == 0:
+            if len(batch_states) == 0 and len(unprocessed_prompt_tokens_ids) == 0 and len(preempted_states) == 0:
                 break
 
         response_ids = []
@@ -254,10 +535,11 @@ class LLaMA(__TextGenerator__):
         else:
             raise Exception("unsupported cache_layout: {}".format(self.model.params.cache_layout))
 
-        if self.model.params.cache_quant_bit == 8:
-            scale_head_dim = head_dim // self.model.params.cache_quant_group
-            kv_cache = torch.zeros(cache_prefix_shape + (head_dim,), dtype=torch.int8)
-            kv_scale = torch.zeros(cache_prefix_shape + (scale_head_dim,), dtype=torch.float16)
+        if self.model.params.cache_quant_bit > 0:
+            cache_dim, scale_dim = cache_quant_dims(head_dim, self.model.params.cache_quant_bit,
+                self.model.params.cache_quant_group, self.model.params.cache_quant_zero_point)
+            kv_cache = torch.zeros(cache_prefix_shape + (cache_dim,), dtype=torch.int8)
+            kv_scale = torch.zeros(cache_prefix_shape + (scale_dim,), dtype=torch.float16)
         else:
             kv_cache = torch.zeros(cache_prefix_shape + (head_dim,), dtype=torch.float16)
             kv_scale = torch.empty(0)
@@ -271,7 +553,7 @@ class LLaMA(__TextGenerator__):
         max_seqlen = torch.tensor([seqlen])
         attn_mask = torch.empty(0, dtype=torch.float16)
 
-        if self.model.params.cache_mode == 0:
+        if self.model.params.cache_mode == 0 or self.model.params.cache_mode == 2:
             cachestarts = torch.arange(0, total_len * bsz, total_len, dtype=torch.int64)
             cachestarts_axes = {
                 0:'batch'
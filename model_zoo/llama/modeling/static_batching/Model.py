@@ -46,6 +46,7 @@ class Attention(nn.Module):
         self.layer_id = layer_id
         self.cache_quant_bit = args.cache_quant_bit
         self.cache_quant_group = args.cache_quant_group
+        self.cache_quant_zero_point = args.cache_quant_zero_point
         self.cache_layout = args.cache_layout
 
         self.friendly_gqa = friendly_gqa
@@ -122,6 +123,7 @@ class Attention(nn.Module):
                 layer_idx=self.layer_id,
                 quant_bit=self.cache_quant_bit,
                 quant_group=self.cache_quant_group,
+                quant_zero_point=self.cache_quant_zero_point,
                 cache_layout=self.cache_layout)
         else:
             keys, values = OPMX.key_value_cache(xk, xv, start_pos,
@@ -130,6 +132,7 @@ class Attention(nn.Module):
                                             layer_idx=self.layer_id,
                                             quant_bit=self.cache_quant_bit,
                                             quant_group=self.cache_quant_group,
+                                            quant_zero_point=self.cache_quant_zero_point,
                                             num_repeat=self.num_local_kv_repeats if self.friendly_gqa else 1,
                                             cache_layout=self.cache_layout)
             # TensorDumper.dump(kv_cache, "layer{}_modified_kv_cache".format(self.layer_id))
@@ -9,6 +9,7 @@ from .Model import Transformer, TensorDumper
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../..")
 
 from ModelUtils import __TextGenerator__
+from torch_function.KeyValueCacheQuantUtils import cache_quant_dims
 
 
 class LLaMA(__TextGenerator__):
@@ -64,10 +65,11 @@ class LLaMA(__TextGenerator__):
         else:
             raise Exception("unsupported cache_layout: {}".format(self.model.params.cache_layout))
 
-        if self.model.params.cache_quant_bit == 8:
-            scale_head_dim = head_dim // self.model.params.cache_quant_group
-            kv_cache = torch.zeros(cache_shape_prefix + (head_dim,), dtype=torch.int8).cuda()
-            kv_scale = torch.zeros(cache_shape_prefix + (scale_head_dim,), dtype=torch.float16).cuda()
+        if self.model.params.cache_quant_bit > 0:
+            cache_dim, scale_dim = cache_quant_dims(head_dim, self.model.params.cache_quant_bit,
+                self.model.params.cache_quant_group, self.model.params.cache_quant_zero_point)
+            kv_cache = torch.zeros(cache_shape_prefix + (cache_dim,), dtype=torch.int8).cuda()
+            kv_scale = torch.zeros(cache_shape_prefix + (scale_dim,), dtype=torch.float16).cuda()
         else:
             kv_cache = torch.zeros(cache_shape_prefix + (head_dim,), dtype=torch.float16).cuda()
             kv_scale = torch.empty(0)
@@ -137,10 +139,11 @@ class LLaMA(__TextGenerator__):
         else:
             raise Exception("unsupported cache_layout: {}".format(self.model.params.cache_layout))
 
-        if self.model.params.cache_quant_bit == 8:
-            scale_head_dim = head_dim // self.model.params.cache_quant_group
-            kv_cache = torch.zeros(cache_shape_prefix + (head_dim,), dtype=torch.int8)
-            kv_scale = torch.zeros(cache_shape_prefix + (scale_head_dim,), dtype=torch.float16)
+        if self.model.params.cache_quant_bit > 0:
+            cache_dim, scale_dim = cache_quant_dims(head_dim, self.model.params.cache_quant_bit,
+                self.model.params.cache_quant_group, self.model.params.cache_quant_zero_point)
+            kv_cache = torch.zeros(cache_shape_prefix + (cache_dim,), dtype=torch.int8)
+            kv_scale = torch.zeros(cache_shape_prefix + (scale_dim,), dtype=torch.float16)
         else:
             kv_cache = torch.zeros(cache_shape_prefix + (head_dim,), dtype=torch.float16)
             kv_scale = torch.empty(0)
@@ -78,6 +78,7 @@ def write_pmx_model(model_path, input_base_path):
     for key in ('max_position_embeddings', 'rope_theta'):
         if key in params:
             pmx_params_dict[key] = params[key]
+    pmx_params_dict['sliding_window'] = params.get('sliding_window') or 0
 
     print(pmx_params_dict)
     write_json(pmx_params_dict, os.path.join(model_path, "opmx_params.json"))
@@ -66,7 +66,7 @@ def write_pmx_model(model_path, input_base_path):
     
     pmx_params_dict['num_experts'] = params['num_local_experts']
     pmx_params_dict['num_experts_per_token'] = params['num_experts_per_tok']
-    pmx_params_dict['sliding_window'] = params['sliding_window']
+    pmx_params_dict['sliding_window'] = params.get('sliding_window') or 0
     
     write_json(pmx_params_dict, os.path.join(model_path, "opmx_params.json"))
     print(pmx_params_dict)
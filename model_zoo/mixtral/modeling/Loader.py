@@ -62,6 +62,10 @@ def load(
     proc_group = dist.new_group(ranks=[_ for _ in range(world_size)], backend=
                                 'gloo' if load_to_cpu else 'nccl')
 
+    if model_params.expert_parallel:
+        if model_params.num_experts % world_size != 0:
+            raise Exception("{} experts can not be placed on {} ranks".format(model_params.num_experts, world_size))
+
     model_params.dynamic_batching = bool(dynamic_batching)
     model_params.auto_causal = bool(auto_causal)
     model_params.cache_layout = cache_layout
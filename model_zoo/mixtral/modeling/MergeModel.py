@@ -33,7 +33,12 @@ def merge_pmx_model(model_path, input_base_path, num_shards):
 
     dims_per_head = hidden_dim // params['num_heads']
     key_value_dim = dims_per_head * num_kv_heads
-    
+
+    # expert parallel shards hold whole experts, which are concatenated back along the expert dim
+    expert_parallel = params.get('expert_parallel', False)
+    ff_w13_dim, ff_w2_dim = (0, 0) if expert_parallel else (-2, -1)
+    params['expert_parallel'] = False
+
     write_json(params, os.path.join(model_path, "opmx_params.json"))
 
     loaded = [
@@ -79,9 +84,9 @@ def merge_pmx_model(model_path, input_base_path, num_shards):
             f"layers.{layer_i}.attention_norm.weight": loaded[0][f"layers.{layer_i}.attention_norm.weight"].clone(),
             f"layers.{layer_i}.ffn_norm.weight": loaded[0][f"layers.{layer_i}.ffn_norm.weight"].clone(),
             f"layers.{layer_i}.attention.wo.weight": torch.cat([loaded[i][f"layers.{layer_i}.attention.wo.weight"] for i in range(num_shards)], dim=1),
-            f"layers.{layer_i}.feed_forward.w1.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w1.weight"] for i in range(num_shards)], dim=-2),
-            f"layers.{layer_i}.feed_forward.w2.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w2.weight"] for i in range(num_shards)], dim=-1),
-            f"layers.{layer_i}.feed_forward.w3.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w3.weight"] for i in range(num_shards)], dim=-2),
+            f"layers.{layer_i}.feed_forward.w1.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w1.weight"] for i in range(num_shards)], dim=ff_w13_dim),
+            f"layers.{layer_i}.feed_forward.w2.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w2.weight"] for i in range(num_shards)], dim=ff_w2_dim),
+            f"layers.{layer_i}.feed_forward.w3.weight": torch.cat([loaded[i][f"layers.{layer_i}.feed_forward.w3.weight"] for i in range(num_shards)], dim=ff_w13_dim),
         })
 
     state_dict.update({
@@ -20,9 +20,16 @@ def write_json(text, path):
         json.dump(text, f)
 
 
-def split_pmx_model(model_path, input_base_path, num_shards):
+def split_pmx_model(model_path, input_base_path, num_shards, expert_parallel=False):
     os.makedirs(model_path, exist_ok=True)
     params = read_json((os.path.join(input_base_path, "opmx_params.json")))
+    # expert parallel shards hold num_experts / num_shards whole experts, attention is still split by heads
+    num_experts = params['num_experts']
+    if expert_parallel:
+        if num_experts % num_shards != 0:
+            raise Exception("{} experts are not divisible by {} shards".format(num_experts, num_shards))
+        params['expert_parallel'] = True
+    num_experts_per_shard = num_experts // num_shards
     # weight sharding
     hidden_dim = params['hidden_dim']
     intermediate_dim = params['intermediate_dim']
@@ -51,9 +58,14 @@ def split_pmx_model(model_path, input_base_path, num_shards):
         wv = [w.reshape(-1, hidden_dim) for w in wv]
 
         wo = state_dict[f"layers.{layer_i}.attention.wo.weight"].split([hidden_dim // num_shards]*num_shards, dim=1)
-        ff_w1 = state_dict[f"layers.{layer_i}.feed_forward.w1.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-2)
-        ff_w2 = state_dict[f"layers.{layer_i}.feed_forward.w2.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-1)
-        ff_w3 = state_dict[f"layers.{layer_i}.feed_forward.w3.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-2)
+        if expert_parallel:
+            ff_w1 = state_dict[f"layers.{layer_i}.feed_forward.w1.weight"].split([num_experts_per_shard]*num_shards, dim=0)
+            ff_w2 = state_dict[f"layers.{layer_i}.feed_forward.w2.weight"].split([num_experts_per_shard]*num_shards, dim=0)
+            ff_w3 = state_dict[f"layers.{layer_i}.feed_forward.w3.weight"].split([num_experts_per_shard]*num_shards, dim=0)
+        else:
+            ff_w1 = state_dict[f"layers.{layer_i}.feed_forward.w1.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-2)
+            ff_w2 = state_dict[f"layers.{layer_i}.feed_forward.w2.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-1)
+            ff_w3 = state_dict[f"layers.{layer_i}.feed_forward.w3.weight"].split([intermediate_dim // num_shards]*num_shards, dim=-2)
 
         state_dict.update({
             f"layers.{layer_i}.attention.wq.weight": wq,
@@ -74,6 +86,10 @@ def split_pmx_model(model_path, input_base_path, num_shards):
 
     # only split ColParallelLinear bias
     for key in state_dict.keys():
+        if expert_parallel and 'feed_forward.w' in key and 'bias' in key:
+            # expert biases go with their experts
+            state_dict.update({key: state_dict[key].split([num_experts_per_shard]*num_shards, dim=0)})
+            continue
         if 'wo.bias' in key or 'w2.bias' in key: continue
         if 'bias' in key:
             bias_dim = state_dict[key].shape[0]
@@ -107,11 +123,17 @@ def main():
         "--output_dir",
         help="Location to write OPMX model",
     )
+    parser.add_argument(
+        "--expert_parallel",
+        help="place whole experts on every shard instead of splitting each expert",
+        action="store_true"
+    )
     args = parser.parse_args()
     split_pmx_model(
         model_path=args.output_dir,
         input_base_path=args.input_dir,
-        num_shards=args.num_shards
+        num_shards=args.num_shards,
+        expert_parallel=args.expert_parallel
     )
 
 if __name__ == "__main__":
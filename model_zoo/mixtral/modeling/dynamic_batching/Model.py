@@ -46,6 +46,7 @@ class Attention(nn.Module):
         self.cache_quant_group = args.cache_quant_group
         self.cache_layout = args.cache_layout
         self.cache_mode = args.cache_mode
+        self.sliding_window = args.sliding_window or 0 # null in some huggingface configs
 
         self.friendly_gqa = friendly_gqa
         self.fused_qkv = fused_qkv
@@ -116,7 +117,8 @@ class Attention(nn.Module):
                 quant_bit=self.cache_quant_bit,
                 quant_group=self.cache_quant_group,
                 cache_mode=self.cache_mode,
-                cache_layout=self.cache_layout)
+                cache_layout=self.cache_layout,
+                sliding_window=self.sliding_window)
         else:
             keys, values = OPMX.dynamic_batching.key_value_cache(
                                             xk, xv, seqstarts, kvstarts,
@@ -129,7 +131,8 @@ class Attention(nn.Module):
                                             quant_group=self.cache_quant_group,
                                             num_repeat=self.num_local_kv_repeats if self.friendly_gqa else 1,
                                             cache_mode=self.cache_mode,
-                                            cache_layout=self.cache_layout)
+                                            cache_layout=self.cache_layout,
+                                            sliding_window=self.sliding_window)
             # TensorDumper.dump(kv_cache, "layer{}_modified_kv_cache".format(self.layer_id))
             # TensorDumper.dump(kv_scale, "layer{}_modified_kv_scale".format(self.layer_id))
             # TensorDumper.dump(keys, "layer{}_key_value_cache_out_keys".format(self.layer_id))
@@ -143,7 +146,8 @@ class Attention(nn.Module):
                                             num_heads=self.num_local_heads,
                                             head_dim=self.head_dim,
                                             is_causal=self.auto_causal,
-                                            num_kv_heads=0 if self.friendly_gqa else self.num_local_kv_heads)
+                                            num_kv_heads=0 if self.friendly_gqa else self.num_local_kv_heads,
+                                            sliding_window=self.sliding_window)
         attn = OPMX.reshape(attn, (0, -1))
         # TensorDumper.dump(attn, "layer{}_multi_head_attention_out".format(self.layer_id))
 
@@ -166,29 +170,45 @@ class MoeFeedForward(nn.Module):
         self.fused_ffn_glu = fused_ffn_glu
         self.num_experts = args.num_experts
         self.num_experts_per_token = args.num_experts_per_token
+        self.expert_parallel = args.expert_parallel
+        self.proc_group = proc_group
         self.gate = Linear(args.hidden_dim, args.num_experts, bias_term=False)
 
+        # expert parallel: whole local experts, tokens are exchanged with all_to_all instead of
+        # splitting every expert over the ranks
+        world_size = 1 if proc_group is None else proc_group.size()
+        expert_group = proc_group
+        num_local_experts = args.num_experts
+        if self.expert_parallel:
+            assert args.num_experts % world_size == 0, "{} is not divisible by {}".format(args.num_experts, world_size)
+            expert_group = None
+            num_local_experts = args.num_experts // world_size
+
         if self.fused_ffn_glu:
             self.wu = MoeColumnParallelLinear(
-                proc_group, args.num_experts, args.hidden_dim, 2 * args.intermediate_dim,
+                expert_group, num_local_experts, args.hidden_dim, 2 * args.intermediate_dim,
                 bias_term=linear_bias_term, gather_output=False)
         else:
             self.w1 = MoeColumnParallelLinear(
-                proc_group, args.num_experts, args.hidden_dim, args.intermediate_dim,
+                expert_group, num_local_experts, args.hidden_dim, args.intermediate_dim,
                 bias_term=linear_bias_term, gather_output=False)
             self.w3 = MoeColumnParallelLinear(
-                proc_group, args.num_experts, args.hidden_dim, args.intermediate_dim,
+                expert_group, num_local_experts, args.hidden_dim, args.intermediate_dim,
                 bias_term=linear_bias_term, gather_output=False)
 
         self.w2 = MoeRowParallelLinear(
-            proc_group, args.num_experts, args.intermediate_dim, args.hidden_dim, bias_term=linear_bias_term, input_is_parallel=True)
+            expert_group, num_local_experts, args.intermediate_dim, args.hidden_dim, bias_term=linear_bias_term, input_is_parallel=True)
 
 
     def forward(self, x):
         router_logits = self.gate(x)
         # TensorDumper.dump(router_logits, "layer{}_ffn_gate_score".format(self.layer_id))
 
-        x_experts, expert_weights, invert_permutation, expert_offset = OPMX.moe_select(x, router_logits, self.num_experts, self.num_experts_per_token)
+        if self.expert_parallel:
+            x_experts, expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts = OPMX.moe_expert_dispatch(
+                x, router_logits, self.proc_group, self.num_experts, self.num_experts_per_token)
+        else:
+            x_experts, expert_weights, invert_permutation, expert_offset = OPMX.moe_select(x, router_logits, self.num_experts, self.num_experts_per_token)
         # TensorDumper.dump(x_experts, "layer{}_ffn_moe_expanded_x".format(self.layer_id))
         # TensorDumper.dump(expert_weights, "layer{}_ffn_moe_expert_weights".format(self.layer_id))
         # TensorDumper.dump(invert_permutation, "layer{}_ffn_moe_inv_perm".format(self.layer_id))
@@ -208,7 +228,11 @@ class MoeFeedForward(nn.Module):
         x_out = self.w2(x13, expert_offset)
         # TensorDumper.dump(x_out, "layer{}_ffn_w2".format(self.layer_id))
 
-        output = OPMX.moe_reduce(x_out, expert_weights, invert_permutation, self.num_experts_per_token)
+        if self.expert_parallel:
+            output = OPMX.moe_expert_combine(x_out, expert_weights, invert_permutation, dispatch_index, dispatch_counts,
+                                             self.proc_group, self.num_experts_per_token)
+        else:
+            output = OPMX.moe_reduce(x_out, expert_weights, invert_permutation, self.num_experts_per_token)
         # TensorDumper.dump(output, "layer{}_ffn_output".format(self.layer_id))
 
         return output
@@ -293,7 +317,8 @@ class Transformer(nn.Module):
         head_dim = params.hidden_dim // params.num_heads
         self.local_q_dim = num_local_heads * head_dim
         self.local_kv_dim = num_local_kv_heads * head_dim
-        self.local_imm_dim = params.intermediate_dim // world_size 
+        # expert parallel ranks hold whole experts
+        self.local_imm_dim = params.intermediate_dim if params.expert_parallel else params.intermediate_dim // world_size
 
         self.tok_embeddings = ParallelEmbedding(proc_group, params.vocab_size, params.hidden_dim)
 
@@ -9,6 +9,7 @@ from .Model import Transformer, TensorDumper
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../../..")
 
 from ModelUtils import __Tokenizer__, __TextGenerator__
+from torch_function.dynamic_batching.MultiHeadAttention import causal_attn_mask
 
 
 class BatchState:
@@ -21,7 +22,7 @@ class BatchState:
         self.is_decoding = False
 
 
-class LLaMA(__TextGenerator__):
+class Mixtral(__TextGenerator__):
     def __init__(self, model: Transformer):
         self.model = model
         self.context_chunking = False
@@ -72,6 +73,9 @@ class LLaMA(__TextGenerator__):
                 total_cache_len += len(p) + max_gen_len
             if self.model.params.cache_mode == 1:
                 total_cache_len += round_up_to_page(len(p) + max_gen_len)
+            if self.model.params.cache_mode == 2:
+                # ring buffer, the cache of a sequence never outgrows its window
+                total_cache_len += self.model.params.sliding_window
 
         head_dim = self.model.params.hidden_dim // self.model.params.num_heads
         num_local_kv_heads = self.model.params.num_kv_heads // torch.distributed.get_world_size(group=self.model.proc_group)
@@ -118,6 +122,9 @@ class LLaMA(__TextGenerator__):
                 if self.model.params.cache_mode == 0:
                     state.cache_starts = allocated_cache_len
                     allocated_cache_len += input_len + max_gen_len
+                if self.model.params.cache_mode == 2:
+                    state.cache_starts = allocated_cache_len
+                    allocated_cache_len += self.model.params.sliding_window
                 if self.model.params.cache_mode == 1:
                     # paged attetion. We must align cache len to page size to avoid overlap
                     cache_len = round_up_to_page(input_len + max_gen_len)
@@ -144,7 +151,11 @@ class LLaMA(__TextGenerator__):
                     seqlens.append(len(s.input_tokens) if not s.is_decoding else 1)
                     token_ids.extend(s.input_tokens if not s.is_decoding else [s.output_tokens[-1]])
 
-            kvlens = [s.start_pos + l for (s, l) in zip(batch_states, seqlens)]
+            if self.model.params.cache_mode == 2:
+                # the ring holds the last sliding_window - 1 tokens the new ones can still see
+                kvlens = [min(s.start_pos, self.model.params.sliding_window - 1) + l for (s, l) in zip(batch_states, seqlens)]
+            else:
+                kvlens = [s.start_pos + l for (s, l) in zip(batch_states, seqlens)]
             seqstarts[1:] = torch.tensor(seqlens, dtype=torch.int64)
             kvstarts[1:] = torch.tensor(kvlens, dtype=torch.int64)
             seqstarts = seqstarts.cumsum(0)
@@ -153,22 +164,10 @@ class LLaMA(__TextGenerator__):
             start_pos = torch.tensor([s.start_pos for s in batch_states], dtype=torch.int64).cuda()
             token_ids = torch.tensor(token_ids, dtype=torch.int64).cuda()
 
-            # generate attention mask [sum(seqlens), pad(sum(kvlens), 16)]
+            # packed [seqlen, kvlen] causal block per sequence, see causal_attn_mask
             attn_mask = torch.empty(0, dtype=torch.float16)
             if self.model.params.auto_causal == False and decoding_batches < current_batches:
-                attn_mask = torch.zeros((seqstarts[-1], (kvstarts[-1] + 15) // 16 * 16), dtype=torch.float16).cuda()
-                for b in range(decoding_batches, current_batches):
-                    seqbeg = seqstarts[b]
-                    seqend = seqstarts[b+1]
-                    kvbeg = kvstarts[b]
-                    kvend = kvstarts[b+1]
-
-                    attn_mask[seqbeg:seqend, kvbeg:kvend] = (
-                        torch.triu(
-                            torch.full_like(attn_mask[seqbeg:seqend, kvbeg:kvend], float("-inf")),
-                            diagonal=1
-                        )
-                    )
+                attn_mask = causal_attn_mask(seqstarts, kvstarts, torch.float16).cuda()
 
             seqstarts = seqstarts.cuda()
             kvstarts = kvstarts.cuda()
@@ -271,7 +270,7 @@ class LLaMA(__TextGenerator__):
         max_seqlen = torch.tensor([seqlen])
         attn_mask = torch.empty(0, dtype=torch.float16)
 
-        if self.model.params.cache_mode == 0:
+        if self.model.params.cache_mode == 0 or self.model.params.cache_mode == 2:
             cachestarts = torch.arange(0, total_len * bsz, total_len, dtype=torch.int64)
             cachestarts_axes = {
                 0:'batch'
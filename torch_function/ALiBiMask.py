@@ -56,11 +56,9 @@ class ALiBiMask(torch.autograd.Function):
         slopes = torch.tensor(get_slopes(num_heads), dtype=data_type)
         alibi_mask = torch.full((seqlen_q, padded_last_dim), float("-inf"), dtype=data_type)
 
-        for i in range(seqlen_q-1, -1, -1):
-            for j in range(seqlen_kv):
-                mask = j - seqlen_kv + 1 + (seqlen_q - 1 - i)
-                if mask <= 0:
-                    alibi_mask[i][j] = mask
+        # query i sits at position seqlen_kv - seqlen_q + i and gets -distance to each key, future keys stay -inf
+        distance = (torch.arange(seqlen_kv - seqlen_q, seqlen_kv)[:, None] - torch.arange(seqlen_kv)[None, :])
+        alibi_mask[:, :last_dim] = (-distance).to(data_type).masked_fill(distance < 0, float("-inf"))
 
         # alibi_mask shape -> (num_heads, seqlen_q, seqlen_kv)
         alibi_mask = alibi_mask.unsqueeze(0).expand(num_heads, -1, -1)
@@ -2,13 +2,20 @@ import torch
 
 from typing import Optional
 
+if not __package__: # run as a script or imported by one
+    from KeyValueCacheQuantUtils import cache_quant, cache_dequant
+else:
+    from .KeyValueCacheQuantUtils import cache_quant, cache_dequant
+
+
 class KeyValueCache(torch.autograd.Function):
     @staticmethod
     def symbolic(
         g, current_key: torch.Value, current_value: torch.Value,
         start_pos: torch.Value, cache: torch.Value, scale: Optional[torch.Value],
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
-        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0):
+        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0,
+        quant_zero_point: bool = False):
         if scale is not None:
             key, value = g.op("opmx::KeyValueCache",
                     current_key, current_value,
@@ -19,6 +26,7 @@ class KeyValueCache(torch.autograd.Function):
                     quant_group_i = quant_group,
                     num_repeat_i = num_repeat,
                     cache_layout_i = cache_layout,
+                    quant_zero_point_i = quant_zero_point,
                     outputs = 2)
         else:
             key, value = g.op("opmx::KeyValueCache",
@@ -30,6 +38,7 @@ class KeyValueCache(torch.autograd.Function):
                     quant_group_i = quant_group,
                     num_repeat_i = num_repeat,
                     cache_layout_i = cache_layout,
+                    quant_zero_point_i = quant_zero_point,
                     outputs = 2)
         return key, value
 
@@ -39,32 +48,19 @@ class KeyValueCache(torch.autograd.Function):
         self, current_key: torch.Tensor, current_value: torch.Tensor,
         start_pos: torch.Tensor, cache: torch.Tensor, scale: Optional[torch.Tensor],
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
-        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0):
+        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0,
+        quant_zero_point: bool = False):
         if torch.onnx.is_in_onnx_export():
             return current_key, current_value
 
 
         def quant(input: torch.Tensor, quant_bit: int, quant_group: int):
-            if quant_bit != 8:
-                raise Exception("only supporte 8bit quantize")
-            X = input.reshape(*input.shape[:-1], -1, quant_group)
-            scale, _ = torch.max(torch.abs(X), -1, True)
-            scale = scale / torch.tensor([127.0], dtype=input.dtype, device=input.device)
-            scale = torch.maximum(scale, torch.tensor([1e-5], dtype=input.dtype, device=input.device))
-            output = torch.round(X / scale).clamp(-127.0, 127.0).type(torch.int8)
-
-            output = output.reshape_as(input)
-            scale = scale.reshape(*input.shape[:-1], -1)
-            return output, scale
+            return cache_quant(input, quant_bit, quant_group, quant_zero_point)
 
 
         def dequant(input: torch.Tensor, scale: torch.Tensor,
                     quant_bit: int, quant_group: int):
-            if quant_bit != 8:
-                raise Exception("only supporte 8bit dequantize")
-            X = input.reshape(*input.shape[:-1], -1, quant_group).type_as(scale)
-            S = scale.reshape(*input.shape[:-1], -1, 1)
-            return (X * S).reshape_as(input)
+            return cache_dequant(input, scale, quant_bit, quant_group, quant_zero_point)
 
         assert start_pos.numel() == 1, "start_pos.numel() = {}".format(start_pos.numel())
         # must use for loop to take the value in start_pos
@@ -130,8 +126,10 @@ class KeyValueCache(torch.autograd.Function):
             else:
                 raise Exception("invalid cache_layout: {}".format(cache_layout))
         if num_repeat > 1:
-            return key[:, :, :, None, :].expand(bs, out_seqlen, num_head, num_repeat, head_dim).reshape(bs, out_seqlen, num_head * num_repeat, head_dim), \
-                value[:, :, :, None, :].expand(bs, out_seqlen, num_head, num_repeat, head_dim).reshape(bs, out_seqlen, num_head * num_repeat, head_dim)
+            # [bs, out_seqlen, num_head, num_repeat, head_dim] broadcast view, the attention ops read the kv heads
+            # through it instead of a num_repeat times larger copy
+            return key[:, :, :, None, :].expand(bs, out_seqlen, num_head, num_repeat, head_dim), \
+                value[:, :, :, None, :].expand(bs, out_seqlen, num_head, num_repeat, head_dim)
         else:
             return key, value
 
@@ -140,9 +138,11 @@ def key_value_cache(
         current_key: torch.Tensor, current_value: torch.Tensor,
         start_pos: torch.Tensor, cache: torch.Tensor, scale: Optional[torch.Tensor],
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
-        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0) -> torch.Tensor:
+        quant_group: int = 8, num_repeat: int = 1, cache_layout: int = 0,
+        quant_zero_point: bool = False) -> torch.Tensor:
     return KeyValueCache.apply(current_key, current_value, start_pos, cache, scale,
-                        num_layer, layer_idx, quant_bit, quant_group, num_repeat, cache_layout)
+                        num_layer, layer_idx, quant_bit, quant_group, num_repeat, cache_layout,
+                        quant_zero_point)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import torch
+
+from typing import Tuple
+
+
+# Quantized key value cache storage, shared by the static and dynamic batching ops.
+#   quant_bit == 8: one int8 per element
+#   quant_bit == 4: two elements per int8, element 2i in the low nibble and 2i+1 in the high nibble
+# scale holds one scale per quant_group elements, followed by one zero point per group
+# when quant_zero_point is set: [..., head_dim // quant_group * (2 if quant_zero_point else 1)]
+
+
+def cache_quant_dims(head_dim: int, quant_bit: int, quant_group: int,
+                     quant_zero_point: bool = False) -> Tuple[int, int]:
+    # last dim of the cache and of the scale tensor
+    if quant_bit == 0:
+        return head_dim, 0
+    if quant_bit != 8 and quant_bit != 4:
+        raise Exception("only support 4bit and 8bit kv cache quantization")
+    scale_dim = head_dim // quant_group
+    if quant_zero_point:
+        scale_dim *= 2
+    return head_dim * quant_bit // 8, scale_dim
+
+
+def pack_int4(input: torch.Tensor) -> torch.Tensor:
+    # int8 values in [-8, 7] -> nibble pairs packed into int8
+    X = input.reshape(*input.shape[:-1], -1, 2).to(torch.int16) & 0x0F
+    return (X[..., 0] | (X[..., 1] << 4)).to(torch.uint8).view(torch.int8)
+
+
+def unpack_int4(input: torch.Tensor) -> torch.Tensor:
+    X = input.view(torch.uint8).to(torch.int16)
+    X = torch.stack([X & 0x0F, X >> 4], dim=-1)
+    X = (X ^ 8) - 8 # sign extend the nibbles
+    return X.flatten(-2).to(torch.int8)
+
+
+def cache_quant(input: torch.Tensor, quant_bit: int, quant_group: int,
+                quant_zero_point: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    if quant_bit != 8 and quant_bit != 4:
+        raise Exception("only support 4bit and 8bit quantize")
+    X = input.reshape(*input.shape[:-1], -1, quant_group)
+    qmax = 2 ** (quant_bit - 1) - 1
+    eps = torch.tensor([1e-5], dtype=input.dtype, device=input.device)
+    if quant_zero_point:
+        qmin = -qmax - 1
+        # the range always covers zero so that zero stays in [qmin, qmax], and the arithmetic is done in
+        # float32, a narrow range far from zero would otherwise overflow X / scale in half precision
+        X = X.float()
+        xmax = torch.amax(X, -1, True).clamp(min=0)
+        xmin = torch.amin(X, -1, True).clamp(max=0)
+        scale = torch.maximum((xmax - xmin) / (qmax - qmin), eps.float())
+        # quantize with the scale dequant will read back
+        scale = scale.type(input.dtype).float()
+        zero = (qmin - torch.round(xmin / scale)).clamp(qmin, qmax)
+        output = (torch.round(X / scale) + zero).clamp(qmin, qmax).type(torch.int8)
+    else:
+        scale, _ = torch.max(torch.abs(X), -1, True)
+        scale = scale / torch.tensor([float(qmax)], dtype=input.dtype, device=input.device)
+        scale = torch.maximum(scale, eps)
+        output = torch.round(X / scale).clamp(-qmax, qmax).type(torch.int8)
+
+    output = output.reshape_as(input)
+    if quant_bit == 4:
+        output = pack_int4(output)
+    scale = scale.reshape(*input.shape[:-1], -1).type(input.dtype)
+    if quant_zero_point:
+        scale = torch.cat([scale, zero.reshape(*input.shape[:-1], -1).type(input.dtype)], dim=-1)
+    return output, scale
+
+
+def cache_dequant(input: torch.Tensor, scale: torch.Tensor,
+                  quant_bit: int, quant_group: int,
+                  quant_zero_point: bool = False) -> torch.Tensor:
+    if quant_bit == 4:
+        input = unpack_int4(input)
+    elif quant_bit != 8:
+        raise Exception("only support 4bit and 8bit dequantize")
+    X = input.reshape(*input.shape[:-1], -1, quant_group).type_as(scale)
+    if quant_zero_point:
+        scale, zero = scale.chunk(2, dim=-1)
+        X = X - zero.reshape(*input.shape[:-1], -1, 1)
+    S = scale.reshape(*input.shape[:-1], -1, 1)
+    return (X * S).reshape_as(input)
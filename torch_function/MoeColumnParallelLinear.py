@@ -1,8 +1,12 @@
 import torch
-import torch.nn.functional as F
 from torch import nn
 import torch.distributed as dist
 
+if not __package__: # run as a script or imported by one
+    from MoeLinearUtils import expert_linear
+else:
+    from .MoeLinearUtils import expert_linear
+
 
 class MoeColumnParallelLinear(torch.autograd.Function):
     @staticmethod
@@ -56,16 +60,7 @@ class MoeColumnParallelLinear(torch.autograd.Function):
             return Y
         else:
             X_flat = X.view(-1, X.shape[-1]) # (seqlen * num_experts_per_token, hidden_dim)
-            output_parallel = torch.zeros(*X.shape[:-1], out_dim).view(-1, out_dim)        
-            
-            for i in range(num_experts):
-                if expert_offset[i+1] - expert_offset[i] <= 0:
-                    continue
-                
-                output_parallel[expert_offset[i]: expert_offset[i+1]] = (
-                    F.linear(X_flat[expert_offset[i]: expert_offset[i+1]], W[i], B[i] if B is not None else None)
-                )
-                
+            output_parallel = expert_linear(X_flat, expert_offset, W, B)
             output_parallel = output_parallel.view(*X.shape[:-1], out_dim)
 
             if gather_output and proc_group is not None and torch.distributed.get_world_size(proc_group) > 1:
@@ -0,0 +1,192 @@
+import torch
+import torch.distributed as dist
+
+if not __package__: # run as a script or imported by one
+    from MoeSelect import MoeSelect
+    from MoeReduce import MoeReduce
+else:
+    from .MoeSelect import MoeSelect
+    from .MoeReduce import MoeReduce
+
+
+# expert parallelism: every rank of proc_group owns num_experts / world_size whole experts, rank r the
+# experts [r * num_local_experts, (r + 1) * num_local_experts). the replicated tokens are split in
+# world_size slices, rank r routes slice r, sends every routed row to the rank owning its expert and
+# gets the expert outputs back, then the reduced slices are gathered on every rank again.
+# only all_to_all_single and all_gather are used, both of which gloo supports on cpu.
+
+
+def token_slices(num_tokens: int, world_size: int):
+    # [begin, end) of the token slice of every rank, the last ones may be shorter or empty
+    size = (num_tokens + world_size - 1) // world_size
+    return [(min(r * size, num_tokens), min((r + 1) * size, num_tokens)) for r in range(world_size)]
+
+
+class MoeExpertDispatch(torch.autograd.Function):
+    @staticmethod
+    def symbolic(
+        g: torch._C.Graph, X: torch.Value, scores: torch.Value,
+        proc_group: dist.ProcessGroup, num_experts: int, num_experts_per_token: int):
+
+        X_local, local_expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts = (
+            g.op("opmx::MoeExpertDispatch", X, scores,
+                num_experts_i=num_experts,
+                num_experts_per_token_i=num_experts_per_token,
+                outputs = 6)
+        )
+        return X_local, local_expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts
+
+
+    @staticmethod
+    def forward(self, X: torch.Tensor, scores: torch.Tensor,
+                proc_group: dist.ProcessGroup, num_experts: int, num_experts_per_token: int):
+        # X: [num_tokens, hidden_dim], the same on every rank
+        # scores: [num_tokens, num_experts]
+        # X_local: [rows, hidden_dim], rows routed to the local experts by all ranks, sorted by local expert
+        # local_expert_offset: [num_local_experts + 1]
+        # expert_weights, invert_permutation: [slice_tokens, num_experts_per_token] of the local token slice
+        # dispatch_index: [rows], received row of every row of X_local
+        # dispatch_counts: [3, world_size], rows sent to and received from every rank and the token slice sizes
+        world_size = 1 if proc_group is None else dist.get_world_size(proc_group)
+        rank = 0 if proc_group is None else dist.get_rank(proc_group)
+        assert num_experts % world_size == 0, "{} is not divisible by {}".format(num_experts, world_size)
+        num_local_experts = num_experts // world_size
+
+        if torch.onnx.is_in_onnx_export():
+            X_local = torch.zeros(X.shape[0] * num_experts_per_token, X.shape[-1], dtype=X.dtype, device=X.device)
+            local_expert_offset = torch.zeros(num_local_experts + 1, dtype=torch.int64, device=X.device)
+            expert_weights = torch.zeros(X.shape[0], num_experts_per_token, dtype=X.dtype, device=X.device)
+            invert_permutation = torch.zeros(X.shape[0], num_experts_per_token, dtype=torch.int64, device=X.device)
+            dispatch_index = torch.zeros(X_local.shape[0], dtype=torch.int64, device=X.device)
+            dispatch_counts = torch.zeros(3, world_size, dtype=torch.int64, device=X.device)
+            return X_local, local_expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts
+
+        slices = token_slices(X.shape[0], world_size)
+        begin, end = slices[rank]
+        X_expand_permute, expert_weights, invert_permutation, expert_offset = MoeSelect.forward(
+            None, X[begin:end], scores[begin:end], num_experts, num_experts_per_token)
+        X_send = X_expand_permute.reshape(-1, X.shape[-1])
+
+        # rows of the slice are sorted by expert, so the rows for every rank are contiguous
+        send_counts = (expert_offset[1:] - expert_offset[:-1]).view(world_size, num_local_experts)
+        recv_counts = torch.empty_like(send_counts)
+        if world_size > 1:
+            dist.all_to_all_single(recv_counts, send_counts, group=proc_group)
+        else:
+            recv_counts.copy_(send_counts)
+        send_splits = send_counts.sum(1).tolist()
+        recv_splits = recv_counts.sum(1).tolist()
+
+        X_recv = X_send.new_empty(sum(recv_splits), X.shape[-1])
+        if world_size > 1:
+            dist.all_to_all_single(X_recv, X_send.contiguous(), recv_splits, send_splits, group=proc_group)
+        else:
+            X_recv.copy_(X_send)
+
+        # received rows come by source rank, then by local expert: regroup them by local expert
+        recv_expert = torch.repeat_interleave(
+            torch.arange(num_local_experts, device=X.device).repeat(world_size), recv_counts.view(-1).to(X.device))
+        _, dispatch_index = recv_expert.sort(stable=True)
+        X_local = X_recv[dispatch_index]
+        local_expert_offset = torch.zeros(num_local_experts + 1, dtype=torch.int64, device=X.device)
+        local_expert_offset[1:] = recv_counts.sum(0).cumsum(0)
+
+        dispatch_counts = torch.tensor([send_splits, recv_splits, [e - b for b, e in slices]], dtype=torch.int64)
+        return X_local, local_expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts
+
+
+class MoeExpertCombine(torch.autograd.Function):
+    @staticmethod
+    def symbolic(
+        g: torch._C.Graph, Y: torch.Value, expert_weights: torch.Value,
+        invert_permutation: torch.Value, dispatch_index: torch.Value, dispatch_counts: torch.Value,
+        proc_group: dist.ProcessGroup, num_experts_per_token: int):
+
+        Y_out = g.op("opmx::MoeExpertCombine", Y, expert_weights, invert_permutation,
+                     dispatch_index, dispatch_counts,
+                     num_experts_per_token_i=num_experts_per_token)
+        return Y_out.setTypeAs(Y)
+
+
+    @staticmethod
+    def forward(self, Y: torch.Tensor, expert_weights: torch.Tensor,
+                invert_permutation: torch.Tensor, dispatch_index: torch.Tensor, dispatch_counts: torch.Tensor,
+                proc_group: dist.ProcessGroup, num_experts_per_token: int):
+        # Y: [rows, hidden_dim], local expert outputs in the order of X_local of MoeExpertDispatch
+        # Y_out: [num_tokens, hidden_dim], the same on every rank
+        world_size = 1 if proc_group is None else dist.get_world_size(proc_group)
+        send_splits, recv_splits, slice_sizes = dispatch_counts.tolist()
+        num_tokens = sum(slice_sizes)
+
+        if torch.onnx.is_in_onnx_export():
+            return torch.zeros(num_tokens, Y.shape[-1], dtype=Y.dtype, device=Y.device)
+
+        # back to the received order and to the ranks the rows came from
+        Y_recv = torch.empty_like(Y)
+        Y_recv[dispatch_index] = Y
+        Y_back = Y.new_empty(sum(send_splits), Y.shape[-1])
+        if world_size > 1:
+            dist.all_to_all_single(Y_back, Y_recv, send_splits, recv_splits, group=proc_group)
+        else:
+            Y_back.copy_(Y_recv)
+
+        Y_slice = MoeReduce.forward(None, Y_back, expert_weights, invert_permutation, num_experts_per_token)
+        if world_size == 1:
+            return Y_slice
+
+        # slices are padded to the longest one for the gather
+        max_slice = max(slice_sizes)
+        Y_pad = Y_slice.new_zeros(max_slice, Y.shape[-1])
+        Y_pad[:Y_slice.shape[0]] = Y_slice
+        tensor_list = [torch.empty_like(Y_pad) for _ in range(world_size)]
+        dist.all_gather(tensor_list, Y_pad, group=proc_group)
+        return torch.cat([t[:size] for t, size in zip(tensor_list, slice_sizes)], dim=0)
+
+
+def moe_expert_dispatch(X: torch.Tensor, scores: torch.Tensor, proc_group: dist.ProcessGroup,
+                        num_experts: int, num_experts_per_token: int):
+
+    return MoeExpertDispatch.apply(X, scores, proc_group, num_experts, num_experts_per_token)
+
+
+def moe_expert_combine(Y: torch.Tensor, expert_weights: torch.Tensor,
+                       invert_permutation: torch.Tensor, dispatch_index: torch.Tensor, dispatch_counts: torch.Tensor,
+                       proc_group: dist.ProcessGroup, num_experts_per_token: int):
+
+    return MoeExpertCombine.apply(Y, expert_weights, invert_permutation, dispatch_index, dispatch_counts,
+                                  proc_group, num_experts_per_token)
+
+
+if __name__ == "__main__":
+    # torchrun --nproc_per_node 2 MoeExpertParallel.py, checks expert parallel against the dense experts over gloo
+    dist.init_process_group("gloo")
+    world_size = dist.get_world_size()
+    rank = dist.get_rank()
+    proc_group = dist.new_group(ranks=[_ for _ in range(world_size)], backend='gloo')
+
+    torch.manual_seed(1)
+    num_experts, num_experts_per_token = 4 * world_size, 2
+    num_tokens, hidden_dim = 13, 64
+    X = torch.randn(num_tokens, hidden_dim)
+    scores = torch.randn(num_tokens, num_experts)
+    W = torch.randn(num_experts, hidden_dim, hidden_dim)
+
+    # reference: every expert on every rank
+    X_expand_permute, expert_weights, invert_permutation, expert_offset = MoeSelect.forward(
+        None, X, scores, num_experts, num_experts_per_token)
+    Y_ref = X_expand_permute.reshape(-1, hidden_dim).clone()
+    offsets = expert_offset.tolist()
+    for i in range(num_experts):
+        Y_ref[offsets[i]:offsets[i + 1]] = Y_ref[offsets[i]:offsets[i + 1]] @ W[i].t()
+    Y_ref = MoeReduce.forward(None, Y_ref, expert_weights, invert_permutation, num_experts_per_token)
+
+    num_local_experts = num_experts // world_size
+    X_local, local_expert_offset, expert_weights, invert_permutation, dispatch_index, dispatch_counts = moe_expert_dispatch(
+        X, scores, proc_group, num_experts, num_experts_per_token)
+    Y_local = X_local.clone()
+    offsets = local_expert_offset.tolist()
+    for i in range(num_local_experts):
+        Y_local[offsets[i]:offsets[i + 1]] = X_local[offsets[i]:offsets[i + 1]] @ W[rank * num_local_experts + i].t()
+    Y = moe_expert_combine(Y_local, expert_weights, invert_permutation, dispatch_index, dispatch_counts,
+                           proc_group, num_experts_per_token)
+    print("rank {}: max diff {}".format(rank, (Y - Y_ref).abs().max().item()))
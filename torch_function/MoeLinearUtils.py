@@ -0,0 +1,65 @@
+import torch
+import torch.nn.functional as F
+
+from typing import Optional
+
+if not __package__: # run as a script or imported by one
+    from _internal.Configure import Configure
+else:
+    from ._internal.Configure import Configure
+
+
+# grouped execution of the expert linears of MoeColumnParallelLinear and MoeRowParallelLinear.
+# the rows of X are sorted by expert, rows [expert_offset[i], expert_offset[i + 1]) go through W[i].
+
+
+def expert_row_index(expert_offset: torch.Tensor, num_rows: int) -> torch.Tensor:
+    # expert of every row, [num_rows]
+    counts = expert_offset[1:] - expert_offset[:-1]
+    return torch.repeat_interleave(torch.arange(counts.numel(), device=counts.device), counts, output_size=num_rows)
+
+
+def expert_linear_backend(counts: list) -> str:
+    # padded bmm computes num_experts * max(counts) rows, wasted when a few experts take most of the tokens.
+    # bmm reads W as it is, so it needs every expert active, gathering the active weights would copy them
+    backend = Configure.moe_linear_backend
+    if backend != 'auto' and backend != 'loop' and backend != 'bmm':
+        raise Exception("unsupported moe_linear_backend: {}".format(Configure.moe_linear_backend))
+    if backend == 'loop' or len(counts) < 2 or min(counts) <= 0:
+        return 'loop'
+    if backend == 'auto' and len(counts) * max(counts) > Configure.moe_bmm_max_padding * sum(counts):
+        return 'loop'
+    return 'bmm'
+
+
+def expert_linear(X: torch.Tensor, expert_offset: torch.Tensor,
+                  W: torch.Tensor, B: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # X: [rows, in_features], W: [num_experts, out_features, in_features], B: [num_experts, out_features]
+    # fused gate and up projections are one wider out_features, nothing special is needed for them
+    num_rows, out_dim = X.shape[0], W.shape[1]
+    offsets = expert_offset.tolist()
+    counts = [offsets[i + 1] - offsets[i] for i in range(W.shape[0])]
+    Y = torch.empty(num_rows, out_dim, dtype=X.dtype, device=X.device)
+    # rows past expert_offset[-1] belong to no expert
+    Y[offsets[-1]:] = 0
+
+    if expert_linear_backend(counts) == 'loop':
+        for i, count in enumerate(counts):
+            if count <= 0:
+                continue
+            Y[offsets[i]:offsets[i + 1]] = F.linear(X[offsets[i]:offsets[i + 1]], W[i], B[i] if B is not None else None)
+        return Y
+
+    max_count = max(counts)
+    starts = torch.tensor(offsets[:-1], dtype=torch.int64, device=X.device)
+    lens = torch.tensor(counts, dtype=torch.int64, device=X.device)
+    # [num_experts, max_count] rows of every expert, padding reads the last row and is dropped
+    rows = starts[:, None] + torch.arange(max_count, device=X.device)[None, :]
+    valid = torch.arange(max_count, device=X.device)[None, :] < lens[:, None]
+    rows = rows.clamp(max=num_rows - 1)
+
+    Y_pad = torch.bmm(X[rows], W.transpose(1, 2))
+    if B is not None:
+        Y_pad = Y_pad + B[:, None, :]
+    Y[rows[valid]] = Y_pad[valid]
+    return Y
@@ -21,9 +21,19 @@ class MoeReduce(torch.autograd.Function):
         # Y_out: [*, hidden_dim]
 
         Y = Y.view(-1, Y.shape[-1])
-        Y_out = Y[invert_permutation].view(*expert_weights.shape, -1)
-        Y_out = (Y_out * expert_weights.unsqueeze(-1)).sum(dim=-2) # [*, hidden_dim]
-        return Y_out
+        # token and weight of every expert output row, the weighted rows are added to their token
+        # in place of gathering a [*, num_experts_per_token, hidden_dim] copy first
+        flat_invert = invert_permutation.reshape(-1)
+        row_token = torch.empty_like(flat_invert)
+        row_token[flat_invert] = torch.arange(flat_invert.numel(), dtype=flat_invert.dtype,
+                                              device=flat_invert.device) // num_experts_per_token
+        row_weight = torch.empty(flat_invert.numel(), dtype=expert_weights.dtype, device=expert_weights.device)
+        row_weight[flat_invert] = expert_weights.reshape(-1)
+
+        out_dtype = torch.result_type(Y, expert_weights)
+        Y_out = torch.zeros(flat_invert.numel() // num_experts_per_token, Y.shape[-1], dtype=out_dtype, device=Y.device)
+        Y_out.index_add_(0, row_token, Y * row_weight.unsqueeze(-1))
+        return Y_out.view(*expert_weights.shape[:-1], Y.shape[-1]) # [*, hidden_dim]
 
 
 def moe_reduce(Y: torch.Tensor, expert_weights: torch.Tensor,
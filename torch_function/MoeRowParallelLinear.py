@@ -1,8 +1,12 @@
 import torch
-import torch.nn.functional as F
 from torch import nn
 import torch.distributed as dist
 
+if not __package__: # run as a script or imported by one
+    from MoeLinearUtils import expert_linear, expert_row_index
+else:
+    from .MoeLinearUtils import expert_linear, expert_row_index
+
 
 class MoeRowParallelLinear(torch.autograd.Function):
     @staticmethod
@@ -42,22 +46,15 @@ class MoeRowParallelLinear(torch.autograd.Function):
             output_parallel = torch.zeros(*X.shape[:-1], out_dim, dtype=W.dtype).to(X.device)
         else:
             X_flat = X.view(-1, X.shape[-1]) # (seqlen * num_experts_per_token, hidden_dim)
-            output_parallel = torch.zeros(*X.shape[:-1], out_dim).view(-1, out_dim)        
-            
-            for i in range(num_experts):
-                if expert_offset[i+1] - expert_offset[i] <= 0:
-                    continue
-                
-                output_parallel[expert_offset[i]: expert_offset[i+1]] = (
-                    F.linear(X_flat[expert_offset[i]: expert_offset[i+1]], W[i])
-                )
-                
-            output_parallel = output_parallel.view(*X.shape[:-1], out_dim)
+            output_parallel = expert_linear(X_flat, expert_offset, W)
 
             if proc_group is not None and torch.distributed.get_world_size(proc_group) > 1:
                 torch.distributed.all_reduce(output_parallel, group=proc_group)
             if B is not None:
-                output_parallel = output_parallel + B
+                # bias of the expert of every routed row, added once after the reduction
+                num_routed = int(expert_offset[-1])
+                output_parallel[:num_routed] += B[expert_row_index(expert_offset, num_routed)]
+            output_parallel = output_parallel.view(*X.shape[:-1], out_dim)
 
         return output_parallel
 
@@ -41,24 +41,18 @@ class MoeSelect(torch.autograd.Function):
             expert_weights = expert_weights.softmax(dim=-1)
             flat_expert_indices = expert_indices.view(-1)   # (seqlen * num_experts_per_token)
             
-            sorted_expert_indices, permute_token_idx = flat_expert_indices.sort(stable=True)
-            X_expand_permute = X_expand_permute.repeat_interleave(num_experts_per_token, dim=0) # (seqlen * num_experts_per_token, hidden_dim)
-            
-            X_expand_permute = X_expand_permute[permute_token_idx]
-
-            invert_permutation = torch.full_like(permute_token_idx, -1, device=scores.device)
-            for i in range(len(permute_token_idx)):
-                reidx = permute_token_idx[i]
-                invert_permutation[reidx] = i
-
-            expert_offset = torch.full((num_experts + 1,), -1, device=scores.device)
-            ptr = 0
-            for i in range(num_experts):
-                while(ptr < len(sorted_expert_indices) and sorted_expert_indices[ptr] < i):
-                    ptr += 1
-                expert_offset[i] = ptr
-            expert_offset[num_experts] = X_expand_permute.size(0)
-            X_expand_permute = X_expand_permute.view(*origin_shape[:-1], num_experts_per_token, -1)
+            _, permute_token_idx = flat_expert_indices.sort(stable=True)
+            # row i of the expanded tokens is token i // num_experts_per_token, gathered in expert order directly
+            X_expand_permute = X_expand_permute[permute_token_idx // num_experts_per_token] # (seqlen * num_experts_per_token, hidden_dim)
+
+            invert_permutation = torch.empty_like(permute_token_idx)
+            invert_permutation[permute_token_idx] = torch.arange(
+                permute_token_idx.numel(), dtype=permute_token_idx.dtype, device=permute_token_idx.device)
+
+            # rows of expert i are [expert_offset[i], expert_offset[i + 1])
+            expert_offset = torch.zeros(num_experts + 1, dtype=torch.int64, device=scores.device)
+            expert_offset[1:] = torch.bincount(flat_expert_indices, minlength=num_experts).cumsum(0)
+            X_expand_permute = X_expand_permute.view(*origin_shape[:-1], num_experts_per_token, origin_shape[-1])
             invert_permutation = invert_permutation.view(*origin_shape[:-1], num_experts_per_token)
 
             return X_expand_permute, expert_weights, invert_permutation, expert_offset 
@@ -1,7 +1,13 @@
 import torch
+import math
 
 from typing import Optional
 
+if not __package__: # run as a script or imported by one
+    from MultiHeadAttentionUtils import alibi_slopes, attention, head_split
+else:
+    from .MultiHeadAttentionUtils import alibi_slopes, attention, head_split
+
 
 class MultiHeadAttention(torch.autograd.Function):
     @staticmethod
@@ -47,51 +53,39 @@ class MultiHeadAttention(torch.autograd.Function):
         seqlen_kv = _key.shape[1]
 
         _num_kv_heads = num_kv_heads
+        if _key.dim() == 5:
+            # friendly gqa KeyValueCache output broadcast over [num_kv_heads, num_repeat], take the kv heads back
+            _key, _value = _key[:, :, :, 0], _value[:, :, :, 0]
+            _num_kv_heads = _key.shape[2]
         if _num_kv_heads == 0:
             _num_kv_heads = num_heads
-        if _num_kv_heads != num_heads:
-            assert num_heads % _num_kv_heads == 0, "{} is not divisible by {}".format(num_heads, _num_kv_heads)
-            num_rep = num_heads // _num_kv_heads
-            _key = (_key[:, :, :, None, :]
-                    .expand(bsz, seqlen_kv, _num_kv_heads, num_rep, head_dim)
-                    .reshape(bsz, seqlen_kv, num_heads, head_dim)
-            )
-            _value = (_value[:, :, :, None, :]
-                    .expand(bsz, seqlen_kv, _num_kv_heads, num_rep, head_dim)
-                    .reshape(bsz, seqlen_kv, num_heads, head_dim)
-            )
-
-        if is_causal and seqlen_q > 1:
-            causal_mask = torch.zeros((1, 1, seqlen_q, seqlen_kv), device=_query.device, dtype=_query.dtype)
-            causal_mask[..., -seqlen_q:] = float("-inf")
-            causal_mask[..., -seqlen_q:] = torch.triu(causal_mask[..., -seqlen_q:], diagonal=1)
-        else:
-            causal_mask = None
+        assert num_heads % _num_kv_heads == 0, "{} is not divisible by {}".format(num_heads, _num_kv_heads)
+        # gqa: the query heads of a kv head are viewed as [num_kv_heads, num_rep], key and value are not repeated
+        num_rep = num_heads // _num_kv_heads
 
+        slopes = None
         if is_alibi:
-            if __name__ == "__main__":
-                from ALiBiMask import alibi_mask
-            else:
-                from .ALiBiMask import alibi_mask
-
-        _query = _query.transpose(1, 2)
-        _key = _key.transpose(1, 2)
-        _value = _value.transpose(1, 2)
-        scores = torch.matmul(_query, _key.transpose(2, 3)) / torch.math.sqrt(head_dim)
-        if causal_mask is not None:
-            scores = scores + causal_mask
+            slopes = alibi_slopes(num_heads, _query.device).view(_num_kv_heads, num_rep, 1, 1)
+
+        mask = None
         if attn_mask is not None and attn_mask.numel() > 0:
-            scores = scores + attn_mask.to(scores.device)[..., :seqlen_kv]
-        if is_alibi:
-            scores = scores + alibi_mask(
-                torch.tensor(seqlen_q),
-                torch.tensor(seqlen_kv),
-                None,
-                num_heads=num_heads,
-                data_type=_query.dtype).to(device=scores.device)[..., :seqlen_kv]
-        scores = torch.nn.functional.softmax(scores.float(), dim=-1).type_as(_query)
-        output = torch.matmul(scores, _value)
-        output = output.transpose(1, 2).contiguous()
+            mask = attn_mask.to(_query.device)[..., :seqlen_kv]
+
+
+        def mask_bias(qbeg: int, qend: int, kvbeg: int, kvend: int):
+            if mask is None:
+                return None
+            rows = slice(qbeg, qend) if mask.shape[-2] > 1 else slice(None)
+            return head_split(mask[..., rows, kvbeg:kvend], _num_kv_heads, num_rep)
+
+
+        # [bsz, num_kv_heads, num_rep, seqlen_q, head_dim] against [bsz, num_kv_heads, 1, seqlen_kv, head_dim]
+        _query = _query.transpose(1, 2).view(bsz, _num_kv_heads, num_rep, seqlen_q, head_dim)
+        _key = _key.transpose(1, 2).unsqueeze(2)
+        _value = _value.transpose(1, 2).unsqueeze(2)
+        output = attention(_query, _key, _value, 1.0 / math.sqrt(head_dim),
+                           is_causal=is_causal, slopes=slopes, bias=mask_bias)
+        output = output.view(bsz, num_heads, seqlen_q, head_dim).transpose(1, 2).contiguous()
 
         return output
 
@@ -0,0 +1,142 @@
+import torch
+
+from typing import Callable, Optional
+
+if not __package__: # run as a script or imported by one
+    from ALiBiSlope import alibi_slope
+    from _internal.Configure import Configure
+else:
+    from .ALiBiSlope import alibi_slope
+    from ._internal.Configure import Configure
+
+
+# Attention shared by the static and dynamic batching attention ops.
+# the reference backend computes scores one [query_tile, kv_tile] block at a time and folds them into
+# a running max and sum per query row (online softmax), so memory no longer grows with seqlen * kvlen.
+# the sdpa backend hands the same inputs to torch.nn.functional.scaled_dot_product_attention.
+
+
+# (num_heads, device) -> alibi slopes, shared by every layer and step
+ALIBI_SLOPES = {}
+
+
+def alibi_slopes(num_heads: int, device: torch.device) -> torch.Tensor:
+    key = (num_heads, str(device))
+    if key not in ALIBI_SLOPES:
+        ALIBI_SLOPES[key] = alibi_slope(num_heads).to(device)
+    return ALIBI_SLOPES[key]
+
+
+def head_split(mask: torch.Tensor, num_kv_heads: int, num_rep: int) -> torch.Tensor:
+    # [..., num_heads, q, k] -> [..., num_kv_heads, num_rep, q, k] to match grouped queries,
+    # masks without a head dim get a broadcast one
+    if mask.dim() >= 3 and mask.shape[-3] == num_kv_heads * num_rep:
+        return mask.unflatten(-3, (num_kv_heads, num_rep))
+    return mask.unsqueeze(-3)
+
+
+def tiled_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, scale: float,
+                    is_causal: bool = False, sliding_window: int = 0,
+                    slopes: Optional[torch.Tensor] = None,
+                    bias: Optional[Callable[[int, int, int, int], Optional[torch.Tensor]]] = None,
+                    query_tile: int = 1024, kv_tile: int = 1024) -> torch.Tensor:
+    # query [..., seqlen, head_dim], key and value [..., kvlen, head_dim] broadcast against the leading dims
+    # of query. queries are aligned to the last keys, query i sits at position kvlen - seqlen + i.
+    # slopes: alibi slopes broadcastable to [..., 1, 1], alibi masks future keys like alibi_mask does.
+    # bias(qbeg, qend, kvbeg, kvend): additive term of a block broadcastable to [..., q, k], or None.
+    # plain ints, traced sizes would leak into the tile bounds when the op runs under torch.jit tracing
+    seqlen, kvlen = int(query.shape[-2]), int(key.shape[-2])
+    offset = kvlen - seqlen
+    device = query.device
+    mask_future = is_causal or slopes is not None
+
+    outputs = []
+    for qbeg in range(0, seqlen, query_tile):
+        qend = min(qbeg + query_tile, seqlen)
+        q = query[..., qbeg:qend, :].float()
+        # blocks entirely in the future or out of the window are skipped
+        kvbeg_min = max(0, qbeg + offset - sliding_window + 1) if sliding_window > 0 else 0
+        kvend_max = min(kvlen, qend + offset) if mask_future else kvlen
+
+        row_max, row_sum, acc = None, None, None
+        for kvbeg in range(kvbeg_min, kvend_max, kv_tile):
+            kvend = min(kvbeg + kv_tile, kvend_max)
+            scores = torch.matmul(q, key[..., kvbeg:kvend, :].float().transpose(-1, -2)) * scale
+
+            distance = (torch.arange(qbeg + offset, qend + offset, device=device)[:, None]
+                        - torch.arange(kvbeg, kvend, device=device)[None, :])
+            if mask_future:
+                scores = scores.masked_fill(distance < 0, float("-inf"))
+            if sliding_window > 0:
+                scores = scores.masked_fill(distance >= sliding_window, float("-inf"))
+            if slopes is not None:
+                scores = scores - slopes * distance
+            if bias is not None:
+                block_bias = bias(qbeg, qend, kvbeg, kvend)
+                if block_bias is not None:
+                    scores = scores + block_bias.float()
+
+            tile_max = scores.amax(-1, keepdim=True)
+            new_max = tile_max if row_max is None else torch.maximum(row_max, tile_max)
+            # rows that have not seen a visible key yet keep a zero reference instead of -inf
+            safe_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+            probs = torch.exp(scores - safe_max)
+            tile_sum = probs.sum(-1, keepdim=True)
+            tile_out = torch.matmul(probs, value[..., kvbeg:kvend, :].float())
+            if acc is None:
+                row_sum, acc = tile_sum, tile_out
+            else:
+                correction = torch.exp(row_max - safe_max)
+                row_sum = row_sum * correction + tile_sum
+                acc = acc * correction + tile_out
+            row_max = new_max
+        # rows without any visible key divide 0 by 0, like softmax over -inf scores
+        outputs.append((acc / row_sum).to(value.dtype))
+    return torch.cat(outputs, dim=-2)
+
+
+def sdpa_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, scale: float,
+                   is_causal: bool = False, sliding_window: int = 0,
+                   slopes: Optional[torch.Tensor] = None,
+                   bias: Optional[Callable[[int, int, int, int], Optional[torch.Tensor]]] = None) -> torch.Tensor:
+    # same inputs as tiled_attention. every term is folded into one additive mask, a plain causal
+    # mask over square scores is passed as is_causal so that the fused kernels can take it
+    seqlen, kvlen = int(query.shape[-2]), int(key.shape[-2])
+    block_bias = bias(0, seqlen, 0, kvlen) if bias is not None else None
+    mask, causal = None, False
+    if block_bias is None and slopes is None and sliding_window <= 0 and (seqlen == kvlen or not is_causal):
+        causal = is_causal
+    else:
+        # scaled_dot_product_attention aligns its causal mask to the first keys, ours to the last
+        distance = (torch.arange(kvlen - seqlen, kvlen, device=query.device)[:, None]
+                    - torch.arange(kvlen, device=query.device)[None, :])
+        mask = torch.zeros(distance.shape, dtype=torch.float32, device=query.device)
+        if is_causal or slopes is not None:
+            mask = mask.masked_fill(distance < 0, float("-inf"))
+        if sliding_window > 0:
+            mask = mask.masked_fill(distance >= sliding_window, float("-inf"))
+        if slopes is not None:
+            mask = mask - slopes * distance
+        if block_bias is not None:
+            mask = mask + block_bias.float()
+
+    # the kernels do not broadcast grouped kv heads, expanding is a view
+    dtype = value.dtype
+    key = key.float().expand(*query.shape[:-2], kvlen, key.shape[-1])
+    value = value.float().expand(*query.shape[:-2], kvlen, value.shape[-1])
+    output = torch.nn.functional.scaled_dot_product_attention(
+        query.float(), key, value, attn_mask=mask, is_causal=causal, scale=scale)
+    return output.to(dtype)
+
+
+def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, scale: float,
+              is_causal: bool = False, sliding_window: int = 0,
+              slopes: Optional[torch.Tensor] = None,
+              bias: Optional[Callable[[int, int, int, int], Optional[torch.Tensor]]] = None) -> torch.Tensor:
+    # backend selected by Configure.attention_backend
+    if Configure.attention_backend == 'sdpa':
+        return sdpa_attention(query, key, value, scale, is_causal, sliding_window, slopes, bias)
+    if Configure.attention_backend != 'reference':
+        raise Exception("unsupported attention_backend: {}".format(Configure.attention_backend))
+    return tiled_attention(query, key, value, scale, is_causal, sliding_window, slopes, bias,
+                           Configure.attention_query_tile, Configure.attention_kv_tile)
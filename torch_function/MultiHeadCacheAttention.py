@@ -17,7 +17,8 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                  attn_mask: Optional[torch.Value], num_heads: int, head_dim: int,
                  is_causal: bool = True, is_alibi: bool = False,
                  num_kv_heads: int = 0, num_layer: int = 1, layer_idx: int = 0,
-                 quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0):
+                 quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0,
+                 quant_zero_point: bool = False):
         # g: GraphContext, defined in onnx/_internal/jit_utils.py
         if attn_mask is not None:
             output = g.op('opmx::MultiHeadCacheAttention',
@@ -32,7 +33,8 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 layer_idx_i=layer_idx,
                 quant_bit_i=quant_bit,
                 quant_group_i=quant_group,
-                cache_layout_i=cache_layout)
+                cache_layout_i=cache_layout,
+                quant_zero_point_i=quant_zero_point)
         elif scale is not None:
             output = g.op('opmx.dynamic_batching::MultiHeadCacheAttention',
                 query, current_key, current_value,
@@ -46,7 +48,8 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 layer_idx_i=layer_idx,
                 quant_bit_i=quant_bit,
                 quant_group_i=quant_group,
-                cache_layout_i=cache_layout)
+                cache_layout_i=cache_layout,
+                quant_zero_point_i=quant_zero_point)
         else:
             output = g.op('opmx.dynamic_batching::MultiHeadCacheAttention',
                 query, current_key, current_value,
@@ -60,7 +63,8 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 layer_idx_i=layer_idx,
                 quant_bit_i=quant_bit,
                 quant_group_i=quant_group,
-                cache_layout_i=cache_layout)
+                cache_layout_i=cache_layout,
+                quant_zero_point_i=quant_zero_point)
         return output.setTypeAs(query)
 
 
@@ -70,7 +74,8 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                  attn_mask: Optional[torch.Tensor], num_heads: int, head_dim: int,
                  is_causal: bool = True, is_alibi: bool = False,
                  num_kv_heads: int = 0, num_layer: int = 1, layer_idx: int = 0,
-                 quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0):
+                 quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0,
+                 quant_zero_point: bool = False):
         if torch.onnx.is_in_onnx_export():
             return query
 
@@ -78,24 +83,13 @@ class MultiHeadCacheAttention(torch.autograd.Function):
             current_key, current_value,
             start_pos, cache, scale, num_layer, layer_idx,
             quant_bit, quant_group, 1,
-            cache_layout)
-
-        if is_alibi:
-            if __name__ == "__main__":
-                from ALiBiMask import alibi_mask
-            else:
-                from .ALiBiMask import alibi_mask
-            attn_mask = alibi_mask(
-                torch.tensor(query.shape[1]),
-                torch.tensor(key.shape[1]),
-                attn_mask,
-                num_heads=num_heads,
-                data_type=query.dtype)
-        
+            cache_layout, quant_zero_point)
+
+        # alibi is applied from its slopes inside attention, no dense mask is built
         output = multi_head_attention(
             query, key, value, attn_mask,
             num_heads, head_dim,
-            is_causal, False, num_kv_heads)
+            is_causal, is_alibi, num_kv_heads)
 
         return output
 
@@ -106,7 +100,8 @@ def multi_head_cache_attention(
                 attn_mask: Optional[torch.Tensor], num_heads: int, head_dim: int,
                 is_causal: bool = True, is_alibi: bool = False,
                 num_kv_heads: int = 0, num_layer: int = 1, layer_idx: int = 0,
-                quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0) -> torch.Tensor:
+                quant_bit: int = 0, quant_group: int = 8, cache_layout: int = 0,
+                quant_zero_point: bool = False) -> torch.Tensor:
     if attn_mask is not None and scale is None:
         _scale = torch.empty(0, device=query.device)
     else:
@@ -114,7 +109,8 @@ def multi_head_cache_attention(
     return MultiHeadCacheAttention.apply(query, current_key, current_value, start_pos, 
                                          cache, _scale, attn_mask, num_heads, head_dim,
                                          is_causal, is_alibi, num_kv_heads, num_layer,
-                                         layer_idx, quant_bit, quant_group, cache_layout)
+                                         layer_idx, quant_bit, quant_group, cache_layout,
+                                         quant_zero_point)
 
 
 if __name__ == "__main__":
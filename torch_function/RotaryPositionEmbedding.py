@@ -1,5 +1,10 @@
 import torch
 
+if not __package__: # run as a script or imported by one
+    from RotaryPositionEmbeddingUtils import rotary_gather, rotary_rows, rotary_table
+else:
+    from .RotaryPositionEmbeddingUtils import rotary_gather, rotary_rows, rotary_table
+
 
 class RotaryPositionEmbedding(torch.autograd.Function):
     @staticmethod
@@ -49,25 +54,21 @@ class RotaryPositionEmbedding(torch.autograd.Function):
 
         position = start_pos.item()
 
-        # generate cos cache, sin cache
-        freqs_cis = torch.zeros(bs, seqlen, dim // 2, dtype=torch.float, device=query.device)
-
-        for i in range(bs):
-            pos_beg = position - pad_len[i]
-            pos_end = position - pad_len[i] + seqlen
-            t = torch.arange(pos_beg, pos_end, dtype=torch.float, device=query.device)
-            _theta = theta
-            if scaling_type == 'linear':
-                t = t / scaling_factor
-            if scaling_type == 'dynamic' and pos_end > max_position_embeddings:
-                _theta = theta * (
-                    (scaling_factor * pos_end / max_position_embeddings) - (scaling_factor - 1)
-                ) ** (dim / (dim - 2))
-
-            freqs = (1.0 / (_theta ** (torch.arange(0, dim, 2, dtype=torch.float, device=query.device)[: (dim // 2)] / dim)))
-            freqs_cis[i] = torch.outer(t, freqs)
-
-        cos, sin = freqs_cis.cos().unsqueeze(2), freqs_cis.sin().unsqueeze(2)  # (bs, seqlen, 1, dim / 2)
+        # gather cos cache, sin cache shared by every layer and step
+        positions = position - pad_len.to(query.device).view(bs, 1) + torch.arange(seqlen, device=query.device).view(1, seqlen)
+        pos_ends = (position - pad_len + seqlen).tolist()
+        if scaling_type == 'dynamic' and max(pos_ends) > max_position_embeddings:
+            # rows past max_position_embeddings each have their own ntk theta
+            cos = torch.empty(bs, seqlen, dim // 2, dtype=torch.float, device=query.device)
+            sin = torch.empty(bs, seqlen, dim // 2, dtype=torch.float, device=query.device)
+            for i in range(bs):
+                cos[i], sin[i] = rotary_rows(theta, dim, max_position_embeddings, scaling_type, scaling_factor,
+                                             pos_ends[i], positions[i])
+        else:
+            cos_table, sin_table = rotary_table(theta, dim, max_position_embeddings, scaling_type, scaling_factor,
+                                                max(pos_ends), query.device)
+            cos, sin = rotary_gather(cos_table, sin_table, positions)
+        cos, sin = cos.unsqueeze(2), sin.unsqueeze(2)  # (bs, seqlen, 1, dim / 2)
 
 
         def do_rotate(x: torch.Tensor, cos: torch.tensor, sin: torch.tensor):
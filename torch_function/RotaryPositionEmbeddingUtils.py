@@ -0,0 +1,120 @@
+import torch
+
+from typing import Tuple
+
+
+# cos and sin of every position shared by the static and dynamic batching RotaryPositionEmbedding ops,
+# so that rotating a token is a gather from the table and a multiply-add instead of per layer trig work.
+
+
+# (theta, rotary_dim, scaling_type, scaling_factor, device) -> (cos, sin) of [positions, rotary_dim / 2].
+# a sequence past max_position_embeddings under dynamic ntk scaling has a theta that changes with every
+# step, its rows are computed by rotary_rows and never tabled
+ROTARY_TABLES = {}
+
+
+def rotary_theta(theta: float, rotary_dim: int, max_position_embeddings: int,
+                 scaling_type: str, scaling_factor: float, pos_end: int) -> float:
+    # dynamic ntk scaling raises theta once a sequence grows past max_position_embeddings
+    if scaling_type == 'dynamic' and pos_end > max_position_embeddings:
+        return theta * (
+            (scaling_factor * pos_end / max_position_embeddings) - (scaling_factor - 1)
+        ) ** (rotary_dim / (rotary_dim - 2))
+    return theta
+
+
+def rotary_freqs(theta: float, rotary_dim: int, device: torch.device) -> torch.Tensor:
+    return (1.0 / (theta ** (torch.arange(0, rotary_dim, 2, dtype=torch.float, device=device)[: (rotary_dim // 2)] / rotary_dim)))
+
+
+def rotary_table_build(theta: float, rotary_dim: int, scaling_type: str, scaling_factor: float,
+                       length: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    t = torch.arange(0, length, dtype=torch.float, device=device)
+    if scaling_type == 'linear':
+        t = t / scaling_factor
+    freqs_cis = torch.outer(t, rotary_freqs(theta, rotary_dim, device))
+    return freqs_cis.cos(), freqs_cis.sin()
+
+
+def rotary_table(theta: float, rotary_dim: int, max_position_embeddings: int,
+                 scaling_type: str, scaling_factor: float, pos_end: int,
+                 device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    # (cos, sin) tables of the unscaled theta covering positions [0, pos_end), dynamic scaling keeps it
+    # below max_position_embeddings. tables start at max_position_embeddings and double when a longer
+    # sequence shows up
+    if scaling_type == 'dynamic':
+        scaling_type = ''
+    key = (theta, rotary_dim, scaling_type, scaling_factor, str(device))
+    cached = ROTARY_TABLES.get(key)
+    if cached is None or cached[0].shape[0] < pos_end:
+        length = max(pos_end, max_position_embeddings)
+        if cached is not None:
+            length = max(length, 2 * cached[0].shape[0])
+        cached = rotary_table_build(theta, rotary_dim, scaling_type, scaling_factor, length, device)
+        ROTARY_TABLES[key] = cached
+    return cached
+
+
+def rotary_gather(cos: torch.Tensor, sin: torch.Tensor, positions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # positions of left padded tokens are negative, cos is even and sin is odd in them
+    index = positions.abs()
+    sign = torch.where(positions < 0, -1.0, 1.0).to(sin.dtype).unsqueeze(-1)
+    return cos[index], sin[index] * sign
+
+
+def rotary_rows(theta: float, rotary_dim: int, max_position_embeddings: int,
+                scaling_type: str, scaling_factor: float, pos_end: int,
+                positions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # cos and sin of positions of a sequence ending at pos_end, [*positions.shape, rotary_dim / 2]
+    _theta = rotary_theta(theta, rotary_dim, max_position_embeddings, scaling_type, scaling_factor, pos_end)
+    if _theta == theta:
+        cos, sin = rotary_table(theta, rotary_dim, max_position_embeddings, scaling_type, scaling_factor,
+                                pos_end, positions.device)
+        return rotary_gather(cos, sin, positions)
+    # the ntk theta is only valid for this pos_end, only the requested rows are computed
+    freqs_cis = positions.abs().float().unsqueeze(-1) * rotary_freqs(_theta, rotary_dim, positions.device)
+    sign = torch.where(positions < 0, -1.0, 1.0).unsqueeze(-1)
+    return freqs_cis.cos(), freqs_cis.sin() * sign
+
+
+def packed_positions(seqstarts: torch.Tensor, start_pos: torch.Tensor, num_tokens: int) -> torch.Tensor:
+    # position of every token of a packed batch, what PositionIndex computes sequence by sequence
+    seqlens = seqstarts[1:] - seqstarts[:-1]
+    batch = torch.repeat_interleave(torch.arange(seqlens.shape[0], device=seqstarts.device), seqlens, output_size=num_tokens)
+    return torch.arange(num_tokens, device=seqstarts.device) - seqstarts[batch] + start_pos[batch]
+
+
+def rotate_pairs(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, rotary_dim: int) -> torch.Tensor:
+    # rotates the interleaved pairs (x[2i], x[2i+1]) of the first rotary_dim channels in place of the
+    # de-interleave, rotate and re-interleave round trip: x * cos + (-x[2i+1], x[2i]) * sin.
+    # cos and sin [..., rotary_dim / 2] broadcast against x [..., head_dim] without its last dim
+    x_rot = x[..., :rotary_dim].float()
+    cos = cos.repeat_interleave(2, dim=-1)
+    sin = torch.stack((-sin, sin), dim=-1).flatten(-2)
+    x_swap = x_rot.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+    x_embed = (x_rot * cos + x_swap * sin).type_as(x)
+    if rotary_dim == x.shape[-1]:
+        return x_embed
+    out = x.clone()
+    out[..., :rotary_dim] = x_embed
+    return out
+
+
+def packed_rotary(seqstarts: torch.Tensor, start_pos: torch.Tensor, positions: torch.Tensor,
+                  rotary_dim: int, theta: float, max_position_embeddings: int,
+                  scaling_type: str, scaling_factor: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    # cos and sin rows of every token of a packed batch, [seqstarts[-1], rotary_dim / 2]
+    pos_ends = start_pos + (seqstarts[1:] - seqstarts[:-1])
+    # below max_position_embeddings dynamic scaling keeps theta, the table is the unscaled one
+    cos, sin = rotary_table(theta, rotary_dim, max_position_embeddings, scaling_type,
+                            scaling_factor, int(pos_ends.max()), positions.device)
+    cos, sin = cos[positions], sin[positions]
+    if scaling_type == 'dynamic':
+        # sequences past max_position_embeddings each have their own ntk theta
+        for b, pos_end in enumerate(pos_ends.tolist()):
+            if pos_end > max_position_embeddings:
+                seqbeg, seqend = int(seqstarts[b]), int(seqstarts[b+1])
+                cos[seqbeg:seqend], sin[seqbeg:seqend] = rotary_rows(
+                    theta, rotary_dim, max_position_embeddings, scaling_type, scaling_factor,
+                    pos_end, positions[seqbeg:seqend])
+    return cos, sin
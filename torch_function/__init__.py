@@ -15,6 +15,7 @@ from .LayerNorm import skip_layer_norm
 from .Linear import linear
 
 from .MoeColumnParallelLinear import moe_column_parallel_linear
+from .MoeExpertParallel import moe_expert_dispatch, moe_expert_combine
 from .MoeReduce import moe_reduce
 from .MoeRowParallelLinear import moe_row_parallel_linear
 from .MoeSelect import moe_select
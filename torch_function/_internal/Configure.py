@@ -1,6 +1,25 @@
 class __Configure__:
     def __init__(self):
-        pass
+        # query lengths bounding the prefill buckets of the dynamic batching MultiHeadAttention,
+        # longer prompts run alone. each bucket is padded to its longest prompt
+        self.prefill_bucket_edges = [16, 32, 64, 128, 256, 512, 1024, 2048]
+        # when set to a dict, bucket edge -> [sequences, query tokens, padded query tokens] is accumulated
+        # on every call so that the edges can be tuned against the padding waste
+        self.prefill_bucket_stats = None
+
+        # attention of the MultiHeadAttention and MultiHeadCacheAttention ops: 'reference' for the tiled
+        # matmul and softmax, 'sdpa' for torch.nn.functional.scaled_dot_product_attention
+        self.attention_backend = 'reference'
+        # query and key block sizes of the tiled MultiHeadAttention ops, bounding their score memory
+        self.attention_query_tile = 1024
+        self.attention_kv_tile = 1024
+
+        # expert linears of the Moe*ParallelLinear ops: 'loop' runs one linear per expert, 'bmm' pads the token
+        # groups of the experts to the largest one and runs a single batched matmul over the weights in place,
+        # only when every expert has tokens. 'auto' takes bmm while the padded rows stay within
+        # moe_bmm_max_padding times the routed rows
+        self.moe_linear_backend = 'auto'
+        self.moe_bmm_max_padding = 2.0
 
 
 Configure = __Configure__()
@@ -3,6 +3,11 @@ import torch
 import math
 from typing import Optional
 
+if not __package__: # run as a script or imported by one
+    from MultiHeadAttention import dense_attn_mask
+else:
+    from .MultiHeadAttention import dense_attn_mask
+
 
 torch2onnx_dtype = {torch.float16: 10,
                     torch.float32: 1}
@@ -53,28 +58,29 @@ class ALiBiMask(torch.autograd.Function):
         slopes = torch.tensor(get_slopes(num_heads), dtype=data_type)
         alibi_mask = torch.zeros((seqstarts[-1], padded_last_dim), dtype=data_type)
 
+        # query i of a sequence sits at position kvlen - seqlen + i and gets -distance to each of its keys,
+        # future keys are -inf. pairs of different sequences stay 0
+        seqstarts, kvstarts = seqstarts.cpu(), kvstarts.cpu()
         seqlens = seqstarts[1:] - seqstarts[:-1]
         kvlens = kvstarts[1:] - kvstarts[:-1]
-        for batch_idx, seqlen in enumerate(seqlens):
-            kvlen = kvlens[batch_idx]
-            seqbeg = seqstarts[batch_idx]
-            seqend = seqstarts[batch_idx+1]
-            kvbeg = kvstarts[batch_idx]
-            kvend = kvstarts[batch_idx+1]
-
-            tmp_alibi_mask = torch.full((seqlen, kvlen), float("-inf"), dtype=data_type)
-            for i in range(seqlen-1, -1, -1):
-                for j in range(kvlen):
-                    mask = j - kvlen + 1 + (seqlen - 1 - i)
-                    if mask <= 0:
-                        tmp_alibi_mask[i][j] = mask
-            alibi_mask[seqbeg:seqend, kvbeg:kvend] = tmp_alibi_mask
+        batch_idx = torch.arange(seqlens.shape[0])
+        row_batch = torch.repeat_interleave(batch_idx, seqlens)
+        col_batch = torch.repeat_interleave(batch_idx, kvlens)
+        q_pos = torch.arange(seqstarts[-1]) - seqstarts[row_batch] + (kvlens - seqlens)[row_batch]
+        kv_pos = torch.arange(kvstarts[-1]) - kvstarts[col_batch]
+        distance = q_pos[:, None] - kv_pos[None, :]
+        block = row_batch[:, None] == col_batch[None, :]
+        alibi_mask[:, :last_dim] = torch.where(
+            block, (-distance).to(data_type).masked_fill(distance < 0, float("-inf")),
+            torch.zeros((), dtype=data_type))
 
         # alibi_mask shape -> (num_heads, sum(seqlens), sum(kvlens))
         alibi_mask = alibi_mask.unsqueeze(0).expand(num_heads, -1, -1)
         alibi_mask = slopes.unsqueeze(1).unsqueeze(1) * alibi_mask
 
         if attention_mask is not None and attention_mask.numel() > 0:
+            if len(attention_mask.shape) == 1:
+                attention_mask = dense_attn_mask(attention_mask, seqstarts, kvstarts)
             assert len(attention_mask.shape) == 2 or len(attention_mask.shape) == 3
             if len(attention_mask.shape) == 2:
                 attention_mask = attention_mask.unsqueeze(0).expand(num_heads, -1, -1)
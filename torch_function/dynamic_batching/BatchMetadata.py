@@ -0,0 +1,84 @@
+import torch
+
+from typing import Optional, Tuple
+
+if not __package__: # run as a script or imported by one
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from RotaryPositionEmbeddingUtils import packed_positions, packed_rotary
+    from KeyValueCache import kv_cache_indices, ring_cache_indices
+    from MultiHeadAttention import attention_buckets
+else:
+    from ..RotaryPositionEmbeddingUtils import packed_positions, packed_rotary
+    from .KeyValueCache import kv_cache_indices, ring_cache_indices
+    from .MultiHeadAttention import attention_buckets
+
+
+class BatchMetadata:
+    # everything the dynamic batching ops derive from seqstarts, kvstarts, cachestarts and start_pos,
+    # built once per step on the device of the cache and handed to the rotary_position_embedding,
+    # key_value_cache, multi_head_cache_attention and multi_head_attention of every layer.
+    # only valid for the step it was built for, ops fall back to their own indices when it is None
+    def __init__(self, seqstarts: torch.Tensor, kvstarts: torch.Tensor,
+                 cachestarts: torch.Tensor, start_pos: torch.Tensor,
+                 decoding_batches: torch.Tensor,
+                 cache_mode: int = 0, page_size: int = 128, sliding_window: int = 0,
+                 device: Optional[torch.device] = None,
+                 attention_mass: Optional[torch.Tensor] = None):
+        _device = cachestarts.device if device is None else device
+        self.device = _device
+        self.seqstarts = seqstarts.to(_device)
+        self.kvstarts = kvstarts.to(_device)
+        self.cachestarts = cachestarts.to(_device)
+        self.start_pos = start_pos.to(_device)
+        self.num_decoding = decoding_batches.item()
+        self.num_tokens = self.seqstarts[-1].item()
+        self.cache_mode = cache_mode
+        self.page_size = page_size
+
+        self.seqlens = self.seqstarts[1:] - self.seqstarts[:-1]
+        self.kvlens = self.kvstarts[1:] - self.kvstarts[:-1]
+        # sequence and position of every new token, [seqstarts[-1]]
+        self.seq_batch = torch.repeat_interleave(
+            torch.arange(self.seqlens.shape[0], device=_device), self.seqlens, output_size=self.num_tokens)
+        self.positions = packed_positions(self.seqstarts, self.start_pos, self.num_tokens)
+
+        # cache slots the new tokens are stored to and the kv tokens are loaded from, see KeyValueCache
+        self.storemask, self.newmask = None, None
+        if cache_mode == 2:
+            if sliding_window <= 0:
+                raise Exception("cache_mode 2 needs sliding_window > 0")
+            self.storemask, self.storeidx, self.newmask, self.loadidx = ring_cache_indices(
+                self.seqstarts, self.kvstarts, self.cachestarts, self.start_pos, sliding_window, _device)
+        else:
+            self.storeidx, self.loadidx = kv_cache_indices(
+                self.seqstarts, self.kvstarts, self.cachestarts, self.start_pos, cache_mode, page_size, _device)
+        # page of every new token in the page table of its sequence, cache_mode 1 only
+        self.store_pages = None
+        if cache_mode == 1:
+            self.store_pages = self.positions // page_size
+
+        self.rotary_tables = {}
+        self.buckets = None
+        # [cache tokens] float tensor indexed by cache slot, multi_head_cache_attention adds the attention
+        # probability every cached token receives to it
+        self.attention_mass = attention_mass
+
+
+    def rotary(self, rotary_dim: int, theta: float, max_position_embeddings: int,
+               scaling_type: str, scaling_factor: float) -> Tuple[torch.Tensor, torch.Tensor]:
+        # cos and sin rows of every new token, [seqstarts[-1], rotary_dim / 2], gathered by the first layer
+        key = (rotary_dim, theta, max_position_embeddings, scaling_type, scaling_factor)
+        if key not in self.rotary_tables:
+            self.rotary_tables[key] = packed_rotary(
+                self.seqstarts, self.start_pos, self.positions, rotary_dim, theta,
+                max_position_embeddings, scaling_type, scaling_factor)
+        return self.rotary_tables[key]
+
+
+    def attention_buckets(self):
+        # prefill buckets and their padded query and kv indices, see attention_buckets
+        if self.buckets is None:
+            self.buckets = attention_buckets(self.seqstarts, self.kvstarts, self.num_decoding, self.device)
+        return self.buckets
@@ -2,6 +2,127 @@ import torch
 
 from typing import Optional
 
+if not __package__: # run as a script or imported by one
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from KeyValueCacheQuantUtils import cache_quant, cache_dequant
+else:
+    from ..KeyValueCacheQuantUtils import cache_quant, cache_dequant
+
+
+def cache_token_index(
+        cachestarts: torch.Tensor, batch_idx: torch.Tensor, pos: torch.Tensor,
+        cache_mode: int = 0, page_size: int = 128):
+    # cache slot of the token at position pos of sequence batch_idx
+    if cache_mode == 0:
+        return cachestarts[batch_idx] + pos
+    elif cache_mode == 1:
+        return cachestarts[batch_idx, pos // page_size] + pos % page_size
+    else:
+        raise Exception("invalid cache_mode: {}".format(cache_mode))
+
+
+def cache_token_view(t: torch.Tensor, layer_idx: int, kv: int, cache_layout: int = 0):
+    # [num_tokens, num_kv_heads, head_dim] view of one (layer_idx, k or v) slice of cache or scale,
+    # indexing its first dim scatters to and gathers from the cache in place
+    if cache_layout == 0:
+        return t[:, layer_idx, kv]
+    elif cache_layout == 1:
+        return t[layer_idx, :, kv]
+    elif cache_layout == 2:
+        return t[layer_idx, kv]
+    elif cache_layout == 3:
+        return t[layer_idx, kv].transpose(0, 1)
+    else:
+        raise Exception("invalid cache_layout: {}".format(cache_layout))
+
+
+def kv_cache_store_index(
+        seqstarts: torch.Tensor, cachestarts: torch.Tensor, start_pos: torch.Tensor,
+        cache_mode: int = 0, page_size: int = 128,
+        device: Optional[torch.device] = None):
+    # cache slot of every new token of the batch, [seqstarts[-1]]
+    _device = cachestarts.device if device is None else device
+    seqstarts = seqstarts.to(_device)
+    cachestarts = cachestarts.to(_device)
+    start_pos = start_pos.to(_device)
+
+    batch = seqstarts.numel() - 1
+    batch_idx = torch.arange(batch, dtype=torch.int64, device=_device)
+    seq_batch = torch.repeat_interleave(batch_idx, seqstarts[1:] - seqstarts[:-1])
+    store_pos = (torch.arange(seq_batch.numel(), dtype=torch.int64, device=_device)
+                 - seqstarts[seq_batch] + start_pos[seq_batch])
+    return cache_token_index(cachestarts, seq_batch, store_pos, cache_mode, page_size)
+
+
+def kv_cache_indices(
+        seqstarts: torch.Tensor, kvstarts: torch.Tensor,
+        cachestarts: torch.Tensor, start_pos: torch.Tensor,
+        cache_mode: int = 0, page_size: int = 128,
+        device: Optional[torch.device] = None):
+    # build the cache slot of every new token (storeidx, [seqstarts[-1]])
+    # and of every token to be read back (loadidx, [kvstarts[-1]]) for the whole batch at once
+    _device = cachestarts.device if device is None else device
+    storeidx = kv_cache_store_index(seqstarts, cachestarts, start_pos, cache_mode, page_size, _device)
+
+    kvstarts = kvstarts.to(_device)
+    cachestarts = cachestarts.to(_device)
+    batch = kvstarts.numel() - 1
+    batch_idx = torch.arange(batch, dtype=torch.int64, device=_device)
+    kv_batch = torch.repeat_interleave(batch_idx, kvstarts[1:] - kvstarts[:-1])
+    load_pos = torch.arange(kv_batch.numel(), dtype=torch.int64, device=_device) - kvstarts[kv_batch]
+    loadidx = cache_token_index(cachestarts, kv_batch, load_pos, cache_mode, page_size)
+    return storeidx, loadidx
+
+
+def ring_cache_store_index(
+        seqstarts: torch.Tensor, cachestarts: torch.Tensor, start_pos: torch.Tensor,
+        sliding_window: int, device: Optional[torch.device] = None):
+    # cache_mode 2: sequence b owns the sliding_window slots from cachestarts[b] on as a ring buffer,
+    # the token at position pos lives in slot pos % sliding_window.
+    # only the last sliding_window new tokens of a sequence are kept: storemask selects them
+    # from the new tokens, [seqstarts[-1]], storeidx holds their slots
+    _device = cachestarts.device if device is None else device
+    seqstarts = seqstarts.to(_device)
+    cachestarts = cachestarts.to(_device)
+    start_pos = start_pos.to(_device)
+
+    batch = seqstarts.numel() - 1
+    batch_idx = torch.arange(batch, dtype=torch.int64, device=_device)
+    seqlens = seqstarts[1:] - seqstarts[:-1]
+    seq_batch = torch.repeat_interleave(batch_idx, seqlens)
+    store_pos = (torch.arange(seq_batch.numel(), dtype=torch.int64, device=_device)
+                 - seqstarts[seq_batch] + start_pos[seq_batch])
+    storemask = store_pos >= (start_pos + seqlens - sliding_window)[seq_batch]
+    storeidx = (cachestarts[seq_batch] + store_pos % sliding_window)[storemask]
+    return storemask, storeidx
+
+
+def ring_cache_indices(
+        seqstarts: torch.Tensor, kvstarts: torch.Tensor,
+        cachestarts: torch.Tensor, start_pos: torch.Tensor,
+        sliding_window: int, device: Optional[torch.device] = None):
+    # the kv of sequence b is its last kvlen - seqlen cached tokens followed by its new tokens.
+    # besides the store slots, returns newmask, [kvstarts[-1]], marking the kv rows taken from
+    # the new tokens, and loadidx, the ring slots of the other rows
+    _device = cachestarts.device if device is None else device
+    storemask, storeidx = ring_cache_store_index(seqstarts, cachestarts, start_pos, sliding_window, _device)
+
+    seqstarts = seqstarts.to(_device)
+    kvstarts = kvstarts.to(_device)
+    cachestarts = cachestarts.to(_device)
+    start_pos = start_pos.to(_device)
+    batch = kvstarts.numel() - 1
+    batch_idx = torch.arange(batch, dtype=torch.int64, device=_device)
+    cachedlens = (kvstarts[1:] - kvstarts[:-1]) - (seqstarts[1:] - seqstarts[:-1])
+    kv_batch = torch.repeat_interleave(batch_idx, kvstarts[1:] - kvstarts[:-1])
+    kv_offset = torch.arange(kv_batch.numel(), dtype=torch.int64, device=_device) - kvstarts[kv_batch]
+    newmask = kv_offset >= cachedlens[kv_batch]
+    load_pos = kv_offset + (start_pos - cachedlens)[kv_batch]
+    loadidx = (cachestarts[kv_batch] + load_pos % sliding_window)[~newmask]
+    return storemask, storeidx, newmask, loadidx
+
 
 class KeyValueCache(torch.autograd.Function):
     @staticmethod
@@ -14,7 +135,8 @@ class KeyValueCache(torch.autograd.Function):
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
         quant_group: int = 8, num_repeat: int = 1,
         cache_mode: int = 0, cache_layout: int = 0,
-        page_size: int = 128):
+        page_size: int = 128, quant_zero_point: bool = False,
+        sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None):
         if scale is not None:
              key, value = g.op("opmx.dynamic_batching::KeyValueCache",
                     current_key, current_value, seqstarts, kvstarts,
@@ -27,6 +149,8 @@ class KeyValueCache(torch.autograd.Function):
                     cache_mode_i = cache_mode,
                     cache_layout_i = cache_layout,
                     page_size_i = page_size,
+                    quant_zero_point_i = quant_zero_point,
+                    sliding_window_i = sliding_window,
                     outputs = 2)
         else:
             key, value = g.op("opmx.dynamic_batching::KeyValueCache",
@@ -40,6 +164,8 @@ class KeyValueCache(torch.autograd.Function):
                     cache_mode_i = cache_mode,
                     cache_layout_i = cache_layout,
                     page_size_i = page_size,
+                    quant_zero_point_i = quant_zero_point,
+                    sliding_window_i = sliding_window,
                     outputs = 2)
         return key, value
 
@@ -54,279 +180,89 @@ class KeyValueCache(torch.autograd.Function):
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
         quant_group: int = 8, num_repeat: int = 1,
         cache_mode: int = 0, cache_layout: int = 0,
-        page_size: int = 128):
+        page_size: int = 128, quant_zero_point: bool = False,
+        sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None):
         if torch.onnx.is_in_onnx_export():
             return current_key, current_value
 
 
         def quant(input: torch.Tensor, quant_bit: int, quant_group: int):
-            if quant_bit != 8:
-                raise Exception("only supporte 8bit quantize")
-            X = input.reshape(*input.shape[:-1], -1, quant_group)
-            scale, _ = torch.max(torch.abs(X), -1, True)
-            scale = scale / torch.tensor([127.0]).type_as(input)
-            scale = torch.maximum(scale, torch.tensor([1e-5]).type_as(input))
-            output = torch.round(X / scale).clamp(-127.0, 127.0).type(torch.int8)
-
-            output = output.reshape_as(input)
-            scale = scale.reshape(*input.shape[:-1], -1)
-            return output, scale
+            return cache_quant(input, quant_bit, quant_group, quant_zero_point)
 
 
         def dequant(input: torch.Tensor, scale: torch.Tensor,
                     quant_bit: int, quant_group: int):
-            if quant_bit != 8:
-                raise Exception("only supporte 8bit dequantize")
-            X = input.reshape(*input.shape[:-1], -1, quant_group).type_as(scale)
-            S = scale.reshape(*input.shape[:-1], -1, 1)
-            return (X * S).reshape_as(input)
+            return cache_dequant(input, scale, quant_bit, quant_group, quant_zero_point)
 
 
         _, num_head, head_dim = current_key.shape
-        key = torch.zeros(kvstarts[-1], num_head, head_dim, dtype=current_key.dtype, device=current_key.device)
-        value = torch.zeros(kvstarts[-1], num_head, head_dim, dtype=current_value.dtype, device=current_value.device)
-
-        seqlens = seqstarts[1:] - seqstarts[:-1]
-        for b, seqlen in enumerate(seqlens):
-            position = start_pos[b]
-            seqbeg = seqstarts[b]
-            seqend = seqstarts[b+1]
-            kvbeg = kvstarts[b]
-            kvend = kvstarts[b+1]
-            kvlen = kvend - kvbeg
-            if cache_mode == 0:
-                storebeg = cachestarts[b] + position
-                storeend = cachestarts[b] + position + seqlen
-                loadbeg = cachestarts[b]
-                loadend = storeend
-            elif cache_mode == 1:
-                storeidx = torch.zeros(seqlen, dtype=torch.int64)
-                loadidx = torch.zeros(kvlen, dtype=torch.int64)
-                for i, t in zip(range(0, seqlen), range(position, position + seqlen)):
-                    storeidx[i] = cachestarts[b, t // page_size] + t % page_size
-                for i in range(0, kvlen):
-                    loadidx[i] = cachestarts[b, i // page_size] + i % page_size
-                storeidx.to(device=cachestarts.device)
-                loadidx.to(device=cachestarts.device)
-            else:
-                raise Exception("invalid cache_mode: {}".format(cache_mode))
-
-
-            def process_mode_0_layout_0():
-                if quant_bit > 0:
-                    cache[storebeg:storeend, layer_idx, 0], \
-                    scale[storebeg:storeend, layer_idx, 0] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[storebeg:storeend, layer_idx, 1], \
-                    scale[storebeg:storeend, layer_idx, 1] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[loadbeg:loadend, layer_idx, 0],
-                        scale[loadbeg:loadend, layer_idx, 0],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[loadbeg:loadend, layer_idx, 1],
-                        scale[loadbeg:loadend, layer_idx, 1],
-                        quant_bit, quant_group)
-                else:
-                    cache[storebeg:storeend, layer_idx, 0] = current_key[seqbeg:seqend]
-                    cache[storebeg:storeend, layer_idx, 1] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[loadbeg:loadend, layer_idx, 0]
-                    value[kvbeg:kvend] = cache[loadbeg:loadend, layer_idx, 1]
-
-
-            def process_mode_0_layout_1():
-                if quant_bit > 0:
-                    cache[layer_idx, storebeg:storeend, 0], \
-                    scale[layer_idx, storebeg:storeend, 0] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, storebeg:storeend, 1], \
-                    scale[layer_idx, storebeg:storeend, 1] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, loadbeg:loadend, 0],
-                        scale[layer_idx, loadbeg:loadend, 0],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, loadbeg:loadend, 1],
-                        scale[layer_idx, loadbeg:loadend, 1],
-                        quant_bit, quant_group)
-                else:
-                    cache[layer_idx, storebeg:storeend, 0] = current_key[seqbeg:seqend]
-                    cache[layer_idx, storebeg:storeend, 1] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[layer_idx, loadbeg:loadend, 0]
-                    value[kvbeg:kvend] = cache[layer_idx, loadbeg:loadend, 1]
-
-
-            def process_mode_0_layout_2():
-                if quant_bit > 0:
-                    cache[layer_idx, 0, storebeg:storeend], \
-                    scale[layer_idx, 0, storebeg:storeend] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 1, storebeg:storeend], \
-                    scale[layer_idx, 1, storebeg:storeend] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 0, loadbeg:loadend],
-                        scale[layer_idx, 0, loadbeg:loadend],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 1, loadbeg:loadend],
-                        scale[layer_idx, 1, loadbeg:loadend],
-                        quant_bit, quant_group)
-                else:
-                    cache[layer_idx, 0, storebeg:storeend] = current_key[seqbeg:seqend]
-                    cache[layer_idx, 1, storebeg:storeend] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[layer_idx, 0, loadbeg:loadend]
-                    value[kvbeg:kvend] = cache[layer_idx, 1, loadbeg:loadend]
-
-
-            def process_mode_0_layout_3():
-                if quant_bit > 0:
-                    c, s = quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 0, :, storebeg:storeend], \
-                    scale[layer_idx, 0, :, storebeg:storeend] =  \
-                        c.transpose(-3, -2), s.transpose(-3, -2)
-                    c, s = quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 1, :, storebeg:storeend], \
-                    scale[layer_idx, 1, :, storebeg:storeend] =  \
-                        c.transpose(-3, -2), s.transpose(-3, -2)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 0, :, loadbeg:loadend],
-                        scale[layer_idx, 0, :, loadbeg:loadend],
-                        quant_bit, quant_group).transpose(-3, -2)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 1, :, loadbeg:loadend],
-                        scale[layer_idx, 1, :, loadbeg:loadend],
-                        quant_bit, quant_group).transpose(-3, -2)
-                else:
-                    cache[layer_idx, 0, :, storebeg:storeend] = current_key[seqbeg:seqend].transpose(-3, -2)
-                    cache[layer_idx, 1, :, storebeg:storeend] = current_value[seqbeg:seqend].transpose(-3, -2)
-                    key[kvbeg:kvend] = cache[layer_idx, 0, :, loadbeg:loadend].transpose(-3, -2)
-                    value[kvbeg:kvend] = cache[layer_idx, 1, :, loadbeg:loadend].transpose(-3, -2)
-
-
-            def process_mode_1_layout_0():
-                if quant_bit > 0:
-                    cache[storeidx, layer_idx, 0], \
-                    scale[storeidx, layer_idx, 0] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[storeidx, layer_idx, 1], \
-                    scale[storeidx, layer_idx, 1] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[loadidx, layer_idx, 0],
-                        scale[loadidx, layer_idx, 0],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[loadidx, layer_idx, 1],
-                        scale[loadidx, layer_idx, 1],
-                        quant_bit, quant_group)
-                else:
-                    cache[storeidx, layer_idx, 0] = current_key[seqbeg:seqend]
-                    cache[storeidx, layer_idx, 1] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[loadidx, layer_idx, 0]
-                    value[kvbeg:kvend] = cache[loadidx, layer_idx, 1]
-
-
-            def process_mode_1_layout_1():
-                if quant_bit > 0:
-                    cache[layer_idx, storeidx, 0], \
-                    scale[layer_idx, storeidx, 0] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, storeidx, 1], \
-                    scale[layer_idx, storeidx, 1] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, loadidx, 0],
-                        scale[layer_idx, loadidx, 0],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, loadidx, 1],
-                        scale[layer_idx, loadidx, 1],
-                        quant_bit, quant_group)
+        key_cache = cache_token_view(cache, layer_idx, 0, cache_layout)
+        value_cache = cache_token_view(cache, layer_idx, 1, cache_layout)
+        if quant_bit > 0:
+            key_scale = cache_token_view(scale, layer_idx, 0, cache_layout)
+            value_scale = cache_token_view(scale, layer_idx, 1, cache_layout)
+            k, ks = quant(current_key, quant_bit, quant_group)
+            v, vs = quant(current_value, quant_bit, quant_group)
+
+
+        def store(storeidx: torch.Tensor, storemask: Optional[torch.Tensor] = None):
+            if quant_bit > 0:
+                if storemask is None:
+                    key_cache[storeidx], key_scale[storeidx] = k, ks
+                    value_cache[storeidx], value_scale[storeidx] = v, vs
                 else:
-                    cache[layer_idx, storeidx, 0] = current_key[seqbeg:seqend]
-                    cache[layer_idx, storeidx, 1] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[layer_idx, loadidx, 0]
-                    value[kvbeg:kvend] = cache[layer_idx, loadidx, 1]
-
-
-            def process_mode_1_layout_2():
-                if quant_bit > 0:
-                    cache[layer_idx, 0, storeidx], \
-                    scale[layer_idx, 0, storeidx] =  \
-                        quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 1, storeidx], \
-                    scale[layer_idx, 1, storeidx] =  \
-                        quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 0, loadidx],
-                        scale[layer_idx, 0, loadidx],
-                        quant_bit, quant_group)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 1, loadidx],
-                        scale[layer_idx, 1, loadidx],
-                        quant_bit, quant_group)
-                else:
-                    cache[layer_idx, 0, storeidx] = current_key[seqbeg:seqend]
-                    cache[layer_idx, 1, storeidx] = current_value[seqbeg:seqend]
-                    key[kvbeg:kvend] = cache[layer_idx, 0, loadidx]
-                    value[kvbeg:kvend] = cache[layer_idx, 1, loadidx]
-
-
-            def process_mode_1_layout_3():
-                if quant_bit > 0:
-                    c, s = quant(current_key[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 0, :, storeidx], \
-                    scale[layer_idx, 0, :, storeidx] =  \
-                        c.transpose(-3, -2), s.transpose(-3, -2)
-                    c, s = quant(current_value[seqbeg:seqend], quant_bit, quant_group)
-                    cache[layer_idx, 1, :, storeidx], \
-                    scale[layer_idx, 1, :, storeidx] =  \
-                        c.transpose(-3, -2), s.transpose(-3, -2)
-                    key[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 0, :, loadidx],
-                        scale[layer_idx, 0, :, loadidx],
-                        quant_bit, quant_group).transpose(-3, -2)
-                    value[kvbeg:kvend] = dequant(
-                        cache[layer_idx, 1, :, loadidx],
-                        scale[layer_idx, 1, :, loadidx],
-                        quant_bit, quant_group).transpose(-3, -2)
-                else:
-                    cache[layer_idx, 0, :, storeidx] = current_key[seqbeg:seqend].transpose(-3, -2)
-                    cache[layer_idx, 1, :, storeidx] = current_value[seqbeg:seqend].transpose(-3, -2)
-                    key[kvbeg:kvend] = cache[layer_idx, 0, :, loadidx].transpose(-3, -2)
-                    value[kvbeg:kvend] = cache[layer_idx, 1, :, loadidx].transpose(-3, -2)
-
-
-            if cache_mode == 0:
-                if cache_layout == 0:
-                    process_mode_0_layout_0()
-                elif cache_layout == 1:
-                    process_mode_0_layout_1()
-                elif cache_layout == 2:
-                    process_mode_0_layout_2()
-                elif cache_layout == 3:
-                    process_mode_0_layout_3()
-                else:
-                    raise Exception("invalid cache_layout: {}".format(cache_layout))
-            elif cache_mode == 1:
-                if cache_layout == 0:
-                    process_mode_1_layout_0()
-                elif cache_layout == 1:
-                    process_mode_1_layout_1()
-                elif cache_layout == 2:
-                    process_mode_1_layout_2()
-                elif cache_layout == 3:
-                    process_mode_1_layout_3()
+                    key_cache[storeidx], key_scale[storeidx] = k[storemask], ks[storemask]
+                    value_cache[storeidx], value_scale[storeidx] = v[storemask], vs[storemask]
+            else:
+                # index_put does not cast like the slice copies it replaced, the cache dtype wins
+                _key, _value = current_key.to(key_cache.dtype), current_value.to(value_cache.dtype)
+                if storemask is None:
+                    key_cache[storeidx], value_cache[storeidx] = _key, _value
                 else:
-                    raise Exception("invalid cache_layout: {}".format(cache_layout))
+                    key_cache[storeidx], value_cache[storeidx] = _key[storemask], _value[storemask]
+
+
+        def load(loadidx: torch.Tensor):
+            if quant_bit > 0:
+                return dequant(key_cache[loadidx], key_scale[loadidx], quant_bit, quant_group), \
+                    dequant(value_cache[loadidx], value_scale[loadidx], quant_bit, quant_group)
+            return key_cache[loadidx].to(current_key.dtype), value_cache[loadidx].to(current_value.dtype)
+
+
+        if cache_mode == 2:
+            if sliding_window <= 0:
+                raise Exception("cache_mode 2 needs sliding_window > 0")
+            if metadata is not None:
+                storemask, storeidx, newmask, loadidx = metadata.storemask, metadata.storeidx, metadata.newmask, metadata.loadidx
+            else:
+                storemask, storeidx, newmask, loadidx = ring_cache_indices(
+                    seqstarts, kvstarts, cachestarts, start_pos, sliding_window, cache.device)
+            if quant_bit > 0:
+                new_key = dequant(k, ks, quant_bit, quant_group)
+                new_value = dequant(v, vs, quant_bit, quant_group)
             else:
-                raise Exception("invalid cache_mode: {}".format(cache_mode))
+                new_key, new_value = current_key, current_value
+            key = new_key.new_empty((newmask.numel(), num_head, head_dim))
+            value = new_value.new_empty((newmask.numel(), num_head, head_dim))
+            key[newmask], value[newmask] = new_key, new_value
+            # history is read before the new tokens overwrite the oldest slots of the ring
+            key[~newmask], value[~newmask] = load(loadidx)
+            store(storeidx, storemask)
+        else:
+            if metadata is not None:
+                storeidx, loadidx = metadata.storeidx, metadata.loadidx
+            else:
+                storeidx, loadidx = kv_cache_indices(
+                    seqstarts, kvstarts, cachestarts, start_pos,
+                    cache_mode, page_size, cache.device)
+            store(storeidx)
+            key, value = load(loadidx)
+
         if num_repeat > 1:
-            return key[:, :, None, :].expand(kvstarts[-1], num_head, num_repeat, head_dim).reshape(kvstarts[-1], num_head * num_repeat, head_dim), \
-                value[:, :, None, :].expand(kvstarts[-1], num_head, num_repeat, head_dim).reshape(kvstarts[-1], num_head * num_repeat, head_dim)
+            # [kvlen, num_head, num_repeat, head_dim] broadcast view, the attention ops read the kv heads
+            # through it instead of a num_repeat times larger copy
+            return key[:, :, None, :].expand(kvstarts[-1], num_head, num_repeat, head_dim), \
+                value[:, :, None, :].expand(kvstarts[-1], num_head, num_repeat, head_dim)
         else:
             return key, value
 
@@ -340,10 +276,12 @@ def key_value_cache(
         num_layer: int = 1, layer_idx: int = 0, quant_bit: int = 0,
         quant_group: int = 8, num_repeat: int = 1,
         cache_mode: int = 0, cache_layout: int = 0,
-        page_size: int = 128) -> torch.Tensor:
+        page_size: int = 128, quant_zero_point: bool = False,
+        sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None) -> torch.Tensor:
     return KeyValueCache.apply(current_key, current_value, seqstarts, kvstarts, cachestarts, 
                                start_pos, max_seqlen, max_kvlen, cache, scale, num_layer, layer_idx,
-                               quant_bit, quant_group, num_repeat, cache_mode, cache_layout, page_size)
+                               quant_bit, quant_group, num_repeat, cache_mode, cache_layout, page_size,
+                               quant_zero_point, sliding_window, metadata)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,97 @@
 import torch
+import math
 
 from typing import Optional
 
+if not __package__: # run as a script or imported by one
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from MultiHeadAttentionUtils import alibi_slopes, attention
+    from _internal.Configure import Configure
+else:
+    from ..MultiHeadAttentionUtils import alibi_slopes, attention
+    from .._internal.Configure import Configure
+
+
+# attn_mask of the dynamic batching attention ops comes in two formats:
+#   dense:  [(num_heads,) seqstarts[-1], >= kvstarts[-1]], only the diagonal block of every sequence is read.
+#           kept for onnx export, see dense_attn_mask
+#   packed: 1 dim, the row major [seqlen, kvlen] block of every sequence back to back, see packed_mask_starts.
+#           its size grows with the per sequence areas instead of the square of the batch tokens
+
+
+def packed_mask_starts(seqstarts: torch.Tensor, kvstarts: torch.Tensor) -> torch.Tensor:
+    # offset of the block of every sequence in a packed attn_mask, [batch + 1]
+    areas = (seqstarts[1:] - seqstarts[:-1]) * (kvstarts[1:] - kvstarts[:-1])
+    maskstarts = torch.zeros_like(seqstarts)
+    maskstarts[1:] = areas.cumsum(0)
+    return maskstarts
+
+
+def packed_mask_coords(seqstarts: torch.Tensor, kvstarts: torch.Tensor):
+    # sequence, row and column inside its block of every element of a packed attn_mask
+    seqlens = seqstarts[1:] - seqstarts[:-1]
+    kvlens = kvstarts[1:] - kvstarts[:-1]
+    maskstarts = packed_mask_starts(seqstarts, kvstarts)
+    batch = torch.repeat_interleave(torch.arange(seqlens.shape[0], device=seqstarts.device), seqlens * kvlens)
+    local = torch.arange(maskstarts[-1].item(), device=seqstarts.device) - maskstarts[batch]
+    return batch, local // kvlens[batch], local % kvlens[batch]
+
+
+def causal_attn_mask(seqstarts: torch.Tensor, kvstarts: torch.Tensor,
+                     dtype: torch.dtype = torch.float16) -> torch.Tensor:
+    # packed causal mask, query i of a sequence sits at position kvlen - seqlen + i
+    batch, row, col = packed_mask_coords(seqstarts, kvstarts)
+    seqlens = seqstarts[1:] - seqstarts[:-1]
+    kvlens = kvstarts[1:] - kvstarts[:-1]
+    distance = (kvlens - seqlens)[batch] + row - col
+    return torch.zeros(distance.shape, dtype=dtype, device=seqstarts.device).masked_fill(distance < 0, float("-inf"))
+
+
+def dense_attn_mask(attn_mask: torch.Tensor, seqstarts: torch.Tensor, kvstarts: torch.Tensor) -> torch.Tensor:
+    # packed -> dense [seqstarts[-1], pad(kvstarts[-1], 16)], pairs of different sequences are 0
+    batch, row, col = packed_mask_coords(seqstarts, kvstarts)
+    dense = torch.zeros((seqstarts[-1].item(), (kvstarts[-1].item() + 15) // 16 * 16),
+                        dtype=attn_mask.dtype, device=attn_mask.device)
+    dense[seqstarts[batch] + row, kvstarts[batch] + col] = attn_mask
+    return dense
+
+
+def attention_buckets(seqstarts: torch.Tensor, kvstarts: torch.Tensor, num_decoding: int,
+                      device: torch.device):
+    # the single token queries of the decoding sequences form one bucket, prefill sequences are grouped
+    # in buckets of similar length. each bucket runs as one dense batch, left padded so that all queries
+    # and keys end at the end of the bucket: the position distance, and with it the causal, sliding window
+    # and alibi terms, is then shared by the whole bucket.
+    # returns (edge, batch, seqlens, kvlens, pad_seqlen, pad_kvlen, qoffset, kvoffset, qidx, kvidx) of every bucket
+    seqlens = seqstarts[1:] - seqstarts[:-1]
+    kvlens = kvstarts[1:] - kvstarts[:-1]
+    assert (seqlens[:num_decoding] == 1).all(), "decoding sequences must have seqlen 1"
+
+    groups = {}
+    if num_decoding > 0:
+        groups[0] = [b for b in range(num_decoding)]
+    seqlens_list = seqlens.tolist()
+    for b in range(num_decoding, len(seqlens_list)):
+        edge = next((e for e in Configure.prefill_bucket_edges if e >= seqlens_list[b]), seqlens_list[b])
+        groups.setdefault(edge, []).append(b)
+
+    num_tokens, num_kv_tokens = seqstarts[-1].item(), kvstarts[-1].item()
+    buckets = []
+    for edge, batch in groups.items():
+        bseqlens = seqlens[batch].to(device)
+        bkvlens = kvlens[batch].to(device)
+        pad_seqlen = bseqlens.max().item()
+        pad_kvlen = bkvlens.max().item()
+        # token of a sequence at each padded position, negative on the padding
+        qoffset = torch.arange(pad_seqlen, device=device)[None, :] - (pad_seqlen - bseqlens[:, None])
+        kvoffset = torch.arange(pad_kvlen, device=device)[None, :] - (pad_kvlen - bkvlens[:, None])
+        qidx = (seqstarts[batch].to(device)[:, None] + qoffset).clamp(0, num_tokens - 1)
+        kvidx = (kvstarts[batch].to(device)[:, None] + kvoffset).clamp(0, num_kv_tokens - 1)
+        buckets.append((edge, batch, bseqlens, bkvlens, pad_seqlen, pad_kvlen, qoffset, kvoffset, qidx, kvidx))
+    return buckets
+
 
 class MultiHeadAttention(torch.autograd.Function):
     @staticmethod
@@ -11,7 +101,8 @@ class MultiHeadAttention(torch.autograd.Function):
                  attn_mask: Optional[torch.Value],
                  num_heads: int, head_dim: int,
                  is_causal: bool = True, is_alibi: bool = False,
-                 num_kv_heads: int = 0):
+                 num_kv_heads: int = 0, sliding_window: int = 0,
+                 metadata: Optional["BatchMetadata"] = None):
         # g: GraphContext, defined in onnx/_internal/jit_utils.py
         if attn_mask is not None:
             output = g.op('opmx.dynamic_batching::MultiHeadAttention',
@@ -22,7 +113,8 @@ class MultiHeadAttention(torch.autograd.Function):
                 head_dim_i=head_dim,
                 is_causal_i=is_causal,
                 is_alibi_i=is_alibi,
-                num_kv_heads_i=num_kv_heads)
+                num_kv_heads_i=num_kv_heads,
+                sliding_window_i=sliding_window)
         else:
             output = g.op('opmx.dynamic_batching::MultiHeadAttention',
                 query, key, value, seqstarts,
@@ -32,7 +124,8 @@ class MultiHeadAttention(torch.autograd.Function):
                 head_dim_i=head_dim,
                 is_causal_i=is_causal,
                 is_alibi_i=is_alibi,
-                num_kv_heads_i=num_kv_heads)
+                num_kv_heads_i=num_kv_heads,
+                sliding_window_i=sliding_window)
         return output.setTypeAs(query)
 
 
@@ -43,70 +136,87 @@ class MultiHeadAttention(torch.autograd.Function):
                 attn_mask: Optional[torch.Tensor],
                 num_heads: int, head_dim: int,
                 is_causal: bool = True, is_alibi: bool = False,
-                num_kv_heads: int = 0):
+                num_kv_heads: int = 0, sliding_window: int = 0,
+                metadata: Optional["BatchMetadata"] = None):
         if torch.onnx.is_in_onnx_export():
             return query
 
-        if attn_mask is not None and attn_mask.numel() > 0:
+        if attn_mask is not None and attn_mask.numel() > 0 and attn_mask.dim() == 1:
+            maskstarts = packed_mask_starts(seqstarts, kvstarts).to(query.device)
+            assert maskstarts[-1] == attn_mask.numel(), "{} vs. {}".format(maskstarts[-1], attn_mask.numel())
+        elif attn_mask is not None and attn_mask.numel() > 0:
             assert 2 == attn_mask.dim() or 3 == attn_mask.dim(), "attn_mask.dim is {}".format(attn_mask.dim())
             assert kvstarts[-1] <= attn_mask.shape[-1], "{} vs. {}".format(kvstarts[-1], attn_mask.shape[-1])
             assert seqstarts[-1] == attn_mask.shape[-2], "{} vs. {}".format(seqstarts[-1], attn_mask.shape[-2])
 
-        __query, __key, __value = query, key, value
-
         _num_kv_heads = num_kv_heads
+        if key.dim() == 4:
+            # friendly gqa KeyValueCache output broadcast over [num_kv_heads, num_repeat], take the kv heads back
+            key, value = key[:, :, 0], value[:, :, 0]
+            _num_kv_heads = key.shape[1]
         if _num_kv_heads == 0:
             _num_kv_heads = num_heads
-        if _num_kv_heads != num_heads:
-            assert num_heads % _num_kv_heads == 0, "{} is not divisible by {}".format(num_heads, _num_kv_heads)
-            num_rep = num_heads // _num_kv_heads
-            __key = torch.repeat_interleave(__key, dim=-2, repeats=num_rep)
-            __value = torch.repeat_interleave(__value, dim=-2, repeats=num_rep)
-
-        output = torch.zeros_like(__query)
+        assert num_heads % _num_kv_heads == 0, "{} is not divisible by {}".format(num_heads, _num_kv_heads)
+        # gqa: the query heads of a kv head are viewed as [num_kv_heads, num_rep], key and value are not repeated
+        num_rep = num_heads // _num_kv_heads
 
+        output = torch.zeros_like(query)
+        device = query.device
+        slopes = None
         if is_alibi:
-            if __name__ == "__main__":
-                from ALiBiMask import alibi_mask
-            else:
-                from .ALiBiMask import alibi_mask
-
-        seqlens = seqstarts[1:] - seqstarts[:-1]
-        kvlens = kvstarts[1:] - kvstarts[:-1]
-        for b, seqlen in enumerate(seqlens):
-            kvlen = kvlens[b]
-            seqbeg = seqstarts[b]
-            seqend = seqstarts[b+1]
-            kvbeg = kvstarts[b]
-            kvend = kvstarts[b+1]
-            kvlen = kvend - kvbeg
-
-            if is_causal and seqlen > 1 and b >= decoding_batches.item():
-                causal_mask = torch.zeros((1, seqlen, kvlen), device=__query.device, dtype=__query.dtype)
-                causal_mask[..., -seqlen:] = float("-inf")
-                causal_mask[..., -seqlen:] = torch.triu(causal_mask[..., -seqlen:], diagonal=1)
-            else:
-                causal_mask = None
-
-            _query = __query[seqbeg:seqend].transpose(0, 1).float() # fix for qwen2-1.5b-instruct model
-            _key = __key[kvbeg:kvend].transpose(0, 1).float()
-            _value = __value[kvbeg:kvend].transpose(0, 1)
-            scores = torch.matmul(_query, _key.transpose(1, 2)) / torch.math.sqrt(head_dim)
-            if causal_mask is not None:
-                scores = scores + causal_mask
-            if attn_mask is not None and attn_mask.numel() > 0:
-                # scores (num_heads, seqlen, kvlen)
-                scores = scores + attn_mask.to(scores.device)[..., seqbeg:seqend, kvbeg:kvend]
-            if is_alibi:
-                alibi_mask(
-                    torch.tensor([0, seqlen]),
-                    torch.tensor([0, kvlen]),
-                    None,
-                    num_heads=num_heads,
-                    data_type=_query.dtype).to(device=scores.device)[..., :kvlen]
-
-            scores = torch.nn.functional.softmax(scores.float(), dim=-1).type_as(_value)
-            output[seqbeg:seqend] = torch.matmul(scores, _value).transpose(0, 1).contiguous()
+            slopes = alibi_slopes(num_heads, device).view(_num_kv_heads, num_rep, 1, 1)
+        mask = None
+        if attn_mask is not None and attn_mask.numel() > 0:
+            mask = attn_mask.to(device)
+
+        if metadata is not None:
+            buckets = metadata.attention_buckets()
+        else:
+            buckets = attention_buckets(seqstarts, kvstarts, decoding_batches.item(), device)
+
+        for edge, batch, bseqlens, bkvlens, pad_seqlen, pad_kvlen, qoffset, kvoffset, qidx, kvidx in buckets:
+            n = len(batch)
+            if edge > 0 and Configure.prefill_bucket_stats is not None:
+                stats = Configure.prefill_bucket_stats.setdefault(edge, [0, 0, 0])
+                stats[0] += n
+                stats[1] += bseqlens.sum().item()
+                stats[2] += n * pad_seqlen
+
+            # [n, num_kv_heads, num_rep, pad_seqlen, head_dim] against [n, num_kv_heads, 1, pad_kvlen, head_dim]
+            _query = query[qidx].view(n, pad_seqlen, _num_kv_heads, num_rep, head_dim).permute(0, 2, 3, 1, 4)
+            _key = key[kvidx].transpose(1, 2).unsqueeze(2)
+            _value = value[kvidx].transpose(1, 2).unsqueeze(2)
+
+
+            def bucket_bias(qbeg: int, qend: int, kvbeg: int, kvend: int):
+                # padding keys of the shorter sequences and the attn_mask block of every sequence
+                bias = torch.zeros((n, kvend - kvbeg), dtype=torch.float32, device=device)
+                bias = bias.masked_fill(kvoffset[:, kvbeg:kvend] < 0, float("-inf")).view(n, 1, 1, 1, kvend - kvbeg)
+                if mask is not None and mask.dim() == 1:
+                    # padding rows and columns read arbitrary elements, they are masked or dropped anyway
+                    rows = qoffset[:, qbeg:qend, None].clamp(min=0)
+                    cols = kvoffset[:, None, kvbeg:kvend].clamp(min=0)
+                    maskidx = maskstarts[batch][:, None, None] + rows * bkvlens[:, None, None] + cols
+                    bias = bias + mask[maskidx.clamp(max=mask.numel() - 1)].view(
+                        n, 1, 1, qend - qbeg, kvend - kvbeg).float()
+                elif mask is not None:
+                    rows = qidx[:, qbeg:qend, None]
+                    cols = kvidx[:, None, kvbeg:kvend].clamp(max=mask.shape[-1] - 1)
+                    if mask.dim() == 2:
+                        bias = bias + mask[rows, cols].view(n, 1, 1, qend - qbeg, kvend - kvbeg).float()
+                    else:
+                        bias = bias + mask[:, rows, cols].transpose(0, 1).reshape(
+                            n, _num_kv_heads, num_rep, qend - qbeg, kvend - kvbeg).float()
+                return bias
+
+
+            # padded query rows may see no key at all, they are dropped below
+            bucket_output = attention(_query, _key, _value, 1.0 / math.sqrt(head_dim),
+                                      is_causal=is_causal, sliding_window=sliding_window,
+                                      slopes=slopes, bias=bucket_bias)
+            bucket_output = bucket_output.permute(0, 3, 1, 2, 4).reshape(n, pad_seqlen, num_heads, head_dim)
+            qvalid = qoffset >= 0
+            output[qidx[qvalid]] = bucket_output[qvalid]
 
         return output
 
@@ -118,10 +228,12 @@ def multi_head_attention(
                 attn_mask: Optional[torch.Tensor],
                 num_heads: int, head_dim: int,
                 is_causal: bool = True, is_alibi: bool = False,
-                num_kv_heads: int = 0) -> torch.Tensor:
+                num_kv_heads: int = 0, sliding_window: int = 0,
+                metadata: Optional["BatchMetadata"] = None) -> torch.Tensor:
     return MultiHeadAttention.apply(query, key, value, seqstarts, kvstarts, decoding_batches,
                                     max_seqlen, max_kvlen, attn_mask,
-                                    num_heads, head_dim, is_causal, is_alibi, num_kv_heads)
+                                    num_heads, head_dim, is_causal, is_alibi, num_kv_heads,
+                                    sliding_window, metadata)
 
 
 if __name__ == "__main__":
@@ -3,11 +3,24 @@ import torch
 from typing import Optional
 
 if __name__ == "__main__":
-    from KeyValueCache import key_value_cache
-    from MultiHeadAttention import multi_head_attention
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from KeyValueCache import cache_token_index, cache_token_view, kv_cache_store_index, ring_cache_store_index
+    from KeyValueCacheQuantUtils import cache_quant, cache_dequant
+    from MultiHeadAttentionUtils import alibi_slopes, head_split, sdpa_attention
+    from MultiHeadAttention import packed_mask_starts
+    from _internal.Configure import Configure
 else:
-    from .KeyValueCache import key_value_cache
-    from .MultiHeadAttention import multi_head_attention
+    from .KeyValueCache import cache_token_index, cache_token_view, kv_cache_store_index, ring_cache_store_index
+    from ..KeyValueCacheQuantUtils import cache_quant, cache_dequant
+    from ..MultiHeadAttentionUtils import alibi_slopes, head_split, sdpa_attention
+    from .MultiHeadAttention import packed_mask_starts
+    from .._internal.Configure import Configure
+
+
+# kv tokens attended per step of the tiled attention, rounded up to whole pages for cache_mode 1
+CACHE_TILE_SIZE = 256
 
 
 class MultiHeadCacheAttention(torch.autograd.Function):
@@ -25,7 +38,9 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                  num_layer: int = 1, layer_idx: int = 0,
                  quant_bit: int = 0, quant_group: int = 8,
                  cache_mode: int = 0, cache_layout: int = 0,
-                 page_size: int = 128):
+                 page_size: int = 128, quant_zero_point: bool = False,
+                 sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None,
+                 kv_stored: bool = False):
         # g: GraphContext, defined in onnx/_internal/jit_utils.py
         if attn_mask is not None:
             output = g.op('opmx.dynamic_batching::MultiHeadCacheAttention',
@@ -45,7 +60,9 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 quant_group_i=quant_group,
                 cache_mode_i=cache_mode,
                 cache_layout_i=cache_layout,
-                page_size_i=page_size)
+                page_size_i=page_size,
+                quant_zero_point_i=quant_zero_point,
+                sliding_window_i=sliding_window)
         elif scale is not None:
             output = g.op('opmx.dynamic_batching::MultiHeadCacheAttention',
                 query, current_key, current_value,
@@ -64,7 +81,9 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 quant_group_i=quant_group,
                 cache_mode_i=cache_mode,
                 cache_layout_i=cache_layout,
-                page_size_i=page_size)
+                page_size_i=page_size,
+                quant_zero_point_i=quant_zero_point,
+                sliding_window_i=sliding_window)
         else:
             output = g.op('opmx.dynamic_batching::MultiHeadCacheAttention',
                 query, current_key, current_value,
@@ -82,7 +101,9 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                 quant_group_i=quant_group,
                 cache_mode_i=cache_mode,
                 cache_layout_i=cache_layout,
-                page_size_i=page_size)
+                page_size_i=page_size,
+                quant_zero_point_i=quant_zero_point,
+                sliding_window_i=sliding_window)
         return output.setTypeAs(query)
 
 
@@ -100,32 +121,288 @@ class MultiHeadCacheAttention(torch.autograd.Function):
                  num_layer: int = 1, layer_idx: int = 0,
                  quant_bit: int = 0, quant_group: int = 8,
                  cache_mode: int = 0, cache_layout: int = 0,
-                 page_size: int = 128):
+                 page_size: int = 128, quant_zero_point: bool = False,
+                 sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None,
+                 kv_stored: bool = False):
         if torch.onnx.is_in_onnx_export():
             return query
 
-        key, value = key_value_cache(
-            current_key, current_value,
-            seqstarts, kvstarts, cachestarts,
-            start_pos, max_seqlen, max_kvlen,
-            cache, scale, num_layer, layer_idx,
-            quant_bit, quant_group, 1,
-            cache_mode, cache_layout, page_size)
+        # every sequence walks its cache tile by tile with an online softmax: only one dequantized
+        # tile of key and value is alive at a time instead of the whole
+        # [kvstarts[-1], num_kv_heads, head_dim] history.
+        # cache_mode 0 and 1 write the new tokens to the cache first and read everything back from it,
+        # the ring buffer of cache_mode 2 is read first and the new tokens are attended directly,
+        # since writing them could overwrite history still inside the window of earlier queries.
+        _num_kv_heads = num_heads if num_kv_heads == 0 else num_kv_heads
+        assert num_heads % _num_kv_heads == 0, "{} is not divisible by {}".format(num_heads, _num_kv_heads)
+        num_rep = num_heads // _num_kv_heads
+        if cache_mode == 2 and sliding_window <= 0:
+            raise Exception("cache_mode 2 needs sliding_window > 0")
+
+        key_cache = cache_token_view(cache, layer_idx, 0, cache_layout)
+        value_cache = cache_token_view(cache, layer_idx, 1, cache_layout)
+        key_scale, value_scale = None, None
+        if kv_stored and cache_mode == 2:
+            raise Exception("new tokens can only be stored ahead of the attention for cache_mode 0 and 1")
+        if quant_bit > 0:
+            key_scale = cache_token_view(scale, layer_idx, 0, cache_layout)
+            value_scale = cache_token_view(scale, layer_idx, 1, cache_layout)
+        if quant_bit > 0 and not kv_stored:
+            key, kscale = cache_quant(current_key, quant_bit, quant_group, quant_zero_point)
+            value, vscale = cache_quant(current_value, quant_bit, quant_group, quant_zero_point)
+        else:
+            key, value = current_key, current_value
 
-        if is_alibi:
-            if __name__ == "__main__":
-                from ALiBiMask import alibi_mask
+
+        def store(storeidx: torch.Tensor, storemask: Optional[torch.Tensor] = None):
+            if storemask is None:
+                key_cache[storeidx], value_cache[storeidx] = key, value
+                if quant_bit > 0:
+                    key_scale[storeidx], value_scale[storeidx] = kscale, vscale
             else:
-                from .ALiBiMask import alibi_mask
-            attn_mask = alibi_mask(seqstarts, kvstarts, attn_mask,
-                                   num_heads, query.dtype)
+                key_cache[storeidx], value_cache[storeidx] = key[storemask], value[storemask]
+                if quant_bit > 0:
+                    key_scale[storeidx], value_scale[storeidx] = kscale[storemask], vscale[storemask]
+
+
+        def as_tile(X: torch.Tensor):
+            # [num_kv_heads, 1, tile, head_dim], broadcast over the query heads sharing each kv head
+            return X.float().transpose(0, 1).unsqueeze(1)
+
+
+        def load_rows(cache_view: torch.Tensor, scale_view: Optional[torch.Tensor], slots: torch.Tensor):
+            if quant_bit > 0:
+                return cache_dequant(cache_view[slots], scale_view[slots], quant_bit, quant_group, quant_zero_point)
+            return cache_view[slots]
+
 
-        output = multi_head_attention(
-            query, key, value, seqstarts,
-            kvstarts, decoding_batches,
-            max_seqlen, max_kvlen, attn_mask,
-            num_heads, head_dim,
-            is_causal, False, num_kv_heads)
+        def load_tile(cache_view: torch.Tensor, scale_view: Optional[torch.Tensor], slots: torch.Tensor):
+            return as_tile(load_rows(cache_view, scale_view, slots))
+
+
+        if cache_mode == 2:
+            if metadata is not None:
+                storemask, storeidx = metadata.storemask, metadata.storeidx
+            else:
+                storemask, storeidx = ring_cache_store_index(
+                    seqstarts, cachestarts, start_pos, sliding_window, cache.device)
+            if quant_bit > 0:
+                new_key = cache_dequant(key, kscale, quant_bit, quant_group, quant_zero_point)
+                new_value = cache_dequant(value, vscale, quant_bit, quant_group, quant_zero_point)
+            else:
+                new_key, new_value = current_key, current_value
+        else:
+            if kv_stored:
+                pass # written by RotaryKeyValueCache
+            elif metadata is not None:
+                store(metadata.storeidx)
+            else:
+                store(kv_cache_store_index(seqstarts, cachestarts, start_pos, cache_mode, page_size, cache.device))
+
+        tile_size = CACHE_TILE_SIZE
+        if cache_mode == 1:
+            tile_size = (tile_size + page_size - 1) // page_size * page_size
+
+        cachestarts = cachestarts.to(cache.device)
+        _start_pos = start_pos.tolist()
+        if is_alibi:
+            slopes = alibi_slopes(num_heads, query.device).view(num_heads, 1, 1)
+        output = torch.zeros_like(query)
+        attention_mass = metadata.attention_mass if metadata is not None and cache_mode != 2 else None
+
+        has_mask = attn_mask is not None and attn_mask.numel() > 0
+        if has_mask and attn_mask.dim() == 1:
+            maskstarts = packed_mask_starts(seqstarts, kvstarts).tolist()
+        _seqstarts = seqstarts.tolist()
+        _kvstarts = kvstarts.tolist()
+        num_decoding = metadata.num_decoding if metadata is not None else decoding_batches.item()
+        seqlens = [_seqstarts[b + 1] - _seqstarts[b] for b in range(len(_seqstarts) - 1)]
+        kvlens = [_kvstarts[b + 1] - _kvstarts[b] for b in range(len(_kvstarts) - 1)]
+
+        # the single token queries of the decoding sequences attend the cache together, tile by tile over
+        # their histories padded to the longest one. the ring buffer of cache_mode 2 goes sequence by sequence
+        decode_batch = []
+        if cache_mode != 2:
+            decode_batch = [b for b in range(num_decoding) if seqlens[b] == 1]
+        decoded = set(decode_batch)
+        if len(decode_batch) > 0:
+            n = len(decode_batch)
+            dbatch = torch.tensor(decode_batch, dtype=torch.int64, device=cache.device)
+            dkvlens = torch.tensor([kvlens[b] for b in decode_batch], dtype=torch.int64, device=query.device)
+            drows = torch.tensor([_seqstarts[b] for b in decode_batch], dtype=torch.int64, device=query.device)
+            # [n, num_kv_heads, num_rep, 1, head_dim]
+            _query = query[drows].float().view(n, _num_kv_heads, num_rep, 1, head_dim) / torch.math.sqrt(head_dim)
+            dmask = None
+            if has_mask and attn_mask.dim() == 1:
+                dmask = torch.tensor([maskstarts[b] for b in decode_batch], dtype=torch.int64, device=query.device)
+            elif has_mask:
+                dmask = torch.tensor([_kvstarts[b] for b in decode_batch], dtype=torch.int64, device=query.device)
+            dkvlen = max(kvlens[b] for b in decode_batch)
+            # tiles older than the window of every decoding query are skipped
+            first = 0
+            if sliding_window > 0:
+                first = max(0, min(kvlens[b] for b in decode_batch) - sliding_window) // tile_size * tile_size
+
+
+            def decode_tiles():
+                for tile_beg in range(first, dkvlen, tile_size):
+                    tile_end = min(tile_beg + tile_size, dkvlen)
+                    kv_pos = torch.arange(tile_beg, tile_end, device=query.device)
+                    valid = kv_pos[None, :] < dkvlens[:, None] # [n, tile]
+                    # padding reads the first token of its sequence and is masked
+                    slots = cache_token_index(cachestarts, dbatch[:, None],
+                                              torch.where(valid, kv_pos[None, :], 0).to(cache.device), cache_mode, page_size)
+                    # [n, num_kv_heads, 1, tile, head_dim]
+                    _key = load_rows(key_cache, key_scale, slots).float().transpose(1, 2).unsqueeze(2)
+                    _value = load_rows(value_cache, value_scale, slots).float().transpose(1, 2).unsqueeze(2)
+                    yield kv_pos, valid, slots, _key, _value
+
+
+            def decode_scores(kv_pos: torch.Tensor, valid: torch.Tensor, _key: torch.Tensor):
+                scores = torch.matmul(_query, _key.transpose(-1, -2)).view(n, num_heads, -1)
+                distance = (dkvlens[:, None] - 1) - kv_pos[None, :]
+                bias = torch.zeros(valid.shape, dtype=torch.float32, device=query.device).masked_fill(~valid, float("-inf"))
+                if sliding_window > 0:
+                    bias = bias.masked_fill(distance >= sliding_window, float("-inf"))
+                scores = scores + bias.unsqueeze(1)
+                if is_alibi:
+                    scores = scores - slopes.view(1, num_heads, 1) * distance.unsqueeze(1).float()
+                if dmask is not None:
+                    pos = torch.where(valid, kv_pos[None, :], 0)
+                    if attn_mask.dim() == 1:
+                        scores = scores + attn_mask[dmask[:, None] + pos].to(query.device).unsqueeze(1).float()
+                    elif attn_mask.dim() == 2:
+                        scores = scores + attn_mask[drows[:, None], dmask[:, None] + pos].to(query.device).unsqueeze(1).float()
+                    else:
+                        scores = scores + attn_mask[:, drows[:, None], dmask[:, None] + pos].to(query.device).transpose(0, 1).float()
+                return scores
+
+
+            row_max = torch.full((n, num_heads, 1), float("-inf"), device=query.device)
+            row_sum = torch.zeros((n, num_heads, 1), device=query.device)
+            acc = torch.zeros((n, num_heads, head_dim), device=query.device)
+            for kv_pos, valid, _, _key, _value in decode_tiles():
+                scores = decode_scores(kv_pos, valid, _key)
+                tile_max = torch.maximum(row_max, scores.amax(-1, keepdim=True))
+                offset = tile_max.masked_fill(tile_max == float("-inf"), 0.0)
+                probs = torch.exp(scores - offset)
+                rescale = torch.exp(row_max - offset)
+                row_sum = row_sum * rescale + probs.sum(-1, keepdim=True)
+                acc = acc * rescale + torch.matmul(
+                    probs.view(n, _num_kv_heads, num_rep, 1, -1), _value).view(n, num_heads, head_dim)
+                row_max = tile_max
+            output[drows] = (acc / row_sum).type_as(query)
+
+            if attention_mass is not None:
+                offset = row_max.masked_fill(row_max == float("-inf"), 0.0)
+                for kv_pos, valid, slots, _key, _ in decode_tiles():
+                    probs = (torch.exp(decode_scores(kv_pos, valid, _key) - offset) / row_sum).sum(1)
+                    attention_mass.index_add_(0, slots[valid.to(slots.device)].to(attention_mass.device),
+                                              probs[valid].to(attention_mass.device, attention_mass.dtype))
+
+        for b, seqlen in enumerate(seqlens):
+            kvlen = kvlens[b]
+            seqbeg = _seqstarts[b]
+            kvbeg = _kvstarts[b]
+            if seqlen == 0 or b in decoded:
+                continue
+            cached_len = kvlen - seqlen if cache_mode == 2 else kvlen
+            # [(num_heads,) seqlen, kvlen] block of this sequence from a dense or packed attn_mask
+            seq_mask = None
+            if has_mask and attn_mask.dim() == 1:
+                seq_mask = attn_mask[maskstarts[b]:maskstarts[b + 1]].view(seqlen, kvlen).to(query.device)
+            elif has_mask:
+                seq_mask = attn_mask[..., seqbeg:seqbeg + seqlen, kvbeg:kvbeg + kvlen].to(query.device)
+
+
+            def kv_tiles(first: int):
+                for tile_beg in range(first, cached_len, tile_size):
+                    tile_end = min(tile_beg + tile_size, cached_len)
+                    kv_pos = torch.arange(tile_beg, tile_end, device=cache.device)
+                    if cache_mode == 2:
+                        slots = cachestarts[b] + (kv_pos + _start_pos[b] - cached_len) % sliding_window
+                    else:
+                        slots = cache_token_index(cachestarts, b, kv_pos, cache_mode, page_size)
+                    yield tile_beg, tile_end, slots, load_tile(key_cache, key_scale, slots), load_tile(value_cache, value_scale, slots)
+                for tile_beg in range(max(first, cached_len), kvlen, tile_size):
+                    tile_end = min(tile_beg + tile_size, kvlen)
+                    new_beg, new_end = seqbeg + tile_beg - cached_len, seqbeg + tile_end - cached_len
+                    yield tile_beg, tile_end, None, as_tile(new_key[new_beg:new_end]), as_tile(new_value[new_beg:new_end])
+
+
+            # [num_kv_heads, num_rep, seqlen, head_dim]
+            _query = query[seqbeg:seqbeg + seqlen].float().view(seqlen, _num_kv_heads, num_rep, head_dim).permute(1, 2, 0, 3)
+            _query = _query / torch.math.sqrt(head_dim)
+            q_pos = torch.arange(kvlen - seqlen, kvlen, device=query.device)
+            # tiles older than the window of the first query are skipped
+            first = 0
+            if sliding_window > 0:
+                first = max(0, kvlen - seqlen - sliding_window + 1) // tile_size * tile_size
+
+
+            def tile_scores(tile_beg: int, tile_end: int, _key: torch.Tensor):
+                scores = torch.matmul(_query, _key.transpose(-1, -2)).view(num_heads, seqlen, -1)
+                kv_pos = torch.arange(tile_beg, tile_end, device=query.device)
+                distance = q_pos[:, None] - kv_pos[None, :]
+                if (is_causal and seqlen > 1 and b >= num_decoding) or is_alibi:
+                    scores = scores.masked_fill(distance < 0, float("-inf"))
+                if sliding_window > 0:
+                    scores = scores.masked_fill(distance >= sliding_window, float("-inf"))
+                if is_alibi:
+                    scores = scores - slopes * distance.float()
+                if seq_mask is not None:
+                    scores = scores + seq_mask[..., tile_beg:tile_end]
+                return scores
+
+
+            if Configure.attention_backend == 'sdpa' and attention_mass is None:
+                # the visible history is gathered and attended in one scaled_dot_product_attention call
+                tiles = list(kv_tiles(first))
+                _key = torch.cat([t[3] for t in tiles], dim=-2)
+                _value = torch.cat([t[4] for t in tiles], dim=-2)
+
+
+                def cache_bias(qbeg: int, qend: int, tile_beg: int, tile_end: int):
+                    if seq_mask is None:
+                        return None
+                    return head_split(seq_mask[..., qbeg:qend, first + tile_beg:first + tile_end], _num_kv_heads, num_rep)
+
+
+                out = sdpa_attention(_query, _key, _value, 1.0, is_causal=is_causal, sliding_window=sliding_window,
+                                     slopes=slopes.view(_num_kv_heads, num_rep, 1, 1) if is_alibi else None,
+                                     bias=cache_bias)
+                output[seqbeg:seqbeg + seqlen] = out.reshape(num_heads, seqlen, head_dim).transpose(0, 1).type_as(query)
+                continue
+
+            row_max = torch.full((num_heads, seqlen, 1), float("-inf"), device=query.device)
+            row_sum = torch.zeros((num_heads, seqlen, 1), device=query.device)
+            acc = torch.zeros((num_heads, seqlen, head_dim), device=query.device)
+            for tile_beg, tile_end, _, _key, _value in kv_tiles(first):
+                scores = tile_scores(tile_beg, tile_end, _key)
+                tile_max = torch.maximum(row_max, scores.amax(-1, keepdim=True))
+                # rows with every score masked so far keep a zero offset to avoid inf - inf
+                offset = tile_max.masked_fill(tile_max == float("-inf"), 0.0)
+                probs = torch.exp(scores - offset)
+                rescale = torch.exp(row_max - offset)
+                row_sum = row_sum * rescale + probs.sum(-1, keepdim=True)
+                acc = acc * rescale + torch.matmul(
+                    probs.view(_num_kv_heads, num_rep, seqlen, -1), _value).view(num_heads, seqlen, head_dim)
+                row_max = tile_max
+
+            output[seqbeg:seqbeg + seqlen] = (acc / row_sum).transpose(0, 1).type_as(query)
+
+            if attention_mass is not None:
+                # second pass with the final softmax statistics, summed over heads and queries per cache slot
+                offset = row_max.masked_fill(row_max == float("-inf"), 0.0)
+                for tile_beg, tile_end, slots, _key, _ in kv_tiles(first):
+                    if slots is None:
+                        continue
+                    probs = torch.exp(tile_scores(tile_beg, tile_end, _key) - offset) / row_sum
+                    attention_mass.index_add_(0, slots.to(attention_mass.device),
+                                              probs.sum((0, 1)).to(attention_mass.device, attention_mass.dtype))
+
+        if cache_mode == 2:
+            store(storeidx, storemask)
 
         return output
 
@@ -144,7 +421,9 @@ def multi_head_cache_attention(
                 num_layer: int = 1, layer_idx: int = 0,
                 quant_bit: int = 0, quant_group: int = 8,
                 cache_mode: int = 0, cache_layout: int = 0,
-                page_size: int = 128) -> torch.Tensor:
+                page_size: int = 128, quant_zero_point: bool = False,
+                sliding_window: int = 0, metadata: Optional["BatchMetadata"] = None,
+                kv_stored: bool = False) -> torch.Tensor:
     if attn_mask is not None and scale is None:
         _scale = torch.empty(0, device=query.device)
     else:
@@ -157,7 +436,8 @@ def multi_head_cache_attention(
                                         num_kv_heads, num_layer,
                                         layer_idx, quant_bit, quant_group,
                                         cache_mode, cache_layout,
-                                        page_size)
+                                        page_size, quant_zero_point,
+                                        sliding_window, metadata, kv_stored)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,13 @@
 import torch
 
+if __name__ == "__main__":
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from RotaryPositionEmbeddingUtils import packed_positions
+else:
+    from ..RotaryPositionEmbeddingUtils import packed_positions
+
 
 class PositionIndex(torch.autograd.Function):
     @staticmethod
@@ -20,14 +28,8 @@ class PositionIndex(torch.autograd.Function):
             return torch.zeros_like(sequences)
 
         position_idx = torch.zeros_like(sequences)
-        seqlens = seqstarts[1:] - seqstarts[:-1]
-        for b, seqlen in enumerate(seqlens):
-            seqbeg = seqstarts[b]
-            seqend = seqstarts[b+1]
-            position = start_pos[b]
-
-            position_idx[seqbeg:seqend] = torch.arange(
-                position, position + seqlen, dtype=torch.int64, device=sequences.device)
+        num_tokens = int(seqstarts[-1])
+        position_idx[:num_tokens] = packed_positions(seqstarts, start_pos, num_tokens).to(position_idx)
         return position_idx
 
 
@@ -0,0 +1,201 @@
+import torch
+
+from typing import Optional
+
+if __name__ == "__main__":
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from KeyValueCache import cache_token_view, kv_cache_store_index
+    from KeyValueCacheQuantUtils import cache_quant
+    from RotaryPositionEmbeddingUtils import packed_positions, packed_rotary, rotate_pairs
+else:
+    from .KeyValueCache import cache_token_view, kv_cache_store_index
+    from ..KeyValueCacheQuantUtils import cache_quant
+    from ..RotaryPositionEmbeddingUtils import packed_positions, packed_rotary, rotate_pairs
+
+
+class RotaryKeyValueCache(torch.autograd.Function):
+    # prologue of the fused kv cache attention: splits the fused qkv projection, rotates query and key,
+    # quantizes key and value and writes them to the cache, and returns only the rotated query.
+    # the attention that follows reads the new tokens back from the cache like the history, so only
+    # cache_mode 0 and 1 are supported, the ring buffer of cache_mode 2 must be read before it is written
+    @staticmethod
+    def symbolic(g, qkv: torch.Value,
+                 seqstarts: torch.Value, cachestarts: torch.Value,
+                 start_pos: torch.Value, max_seqlen: torch.Value,
+                 cache: torch.Value, scale: Optional[torch.Value],
+                 num_heads: int, num_kv_heads: int,
+                 rotary_dim: int = 0, theta: float = 10000.0,
+                 max_position_embeddings: int = 2048,
+                 scaling_type: str = '', scaling_factor: float = 1.0,
+                 num_layer: int = 1, layer_idx: int = 0,
+                 quant_bit: int = 0, quant_group: int = 8,
+                 cache_mode: int = 0, cache_layout: int = 0,
+                 page_size: int = 128, quant_zero_point: bool = False,
+                 metadata: Optional["BatchMetadata"] = None):
+        # g: GraphContext, defined in onnx/_internal/jit_utils.py
+        if scale is not None:
+            rotated_query = g.op('opmx.dynamic_batching::RotaryKeyValueCache',
+                qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache, scale,
+                num_heads_i=num_heads,
+                num_kv_heads_i=num_kv_heads,
+                rotary_dim_i=rotary_dim,
+                theta_f=theta,
+                max_position_embeddings_i=max_position_embeddings,
+                scaling_type_s=scaling_type,
+                scaling_factor_f=scaling_factor,
+                num_layer_i=num_layer,
+                layer_idx_i=layer_idx,
+                quant_bit_i=quant_bit,
+                quant_group_i=quant_group,
+                cache_mode_i=cache_mode,
+                cache_layout_i=cache_layout,
+                page_size_i=page_size,
+                quant_zero_point_i=quant_zero_point)
+        else:
+            rotated_query = g.op('opmx.dynamic_batching::RotaryKeyValueCache',
+                qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache,
+                num_heads_i=num_heads,
+                num_kv_heads_i=num_kv_heads,
+                rotary_dim_i=rotary_dim,
+                theta_f=theta,
+                max_position_embeddings_i=max_position_embeddings,
+                scaling_type_s=scaling_type,
+                scaling_factor_f=scaling_factor,
+                num_layer_i=num_layer,
+                layer_idx_i=layer_idx,
+                quant_bit_i=quant_bit,
+                quant_group_i=quant_group,
+                cache_mode_i=cache_mode,
+                cache_layout_i=cache_layout,
+                page_size_i=page_size,
+                quant_zero_point_i=quant_zero_point)
+        return rotated_query.setTypeAs(qkv)
+
+
+    @staticmethod
+    def forward(ctx, qkv: torch.Tensor,
+                seqstarts: torch.Tensor, cachestarts: torch.Tensor,
+                start_pos: torch.Tensor, max_seqlen: torch.Tensor,
+                cache: torch.Tensor, scale: Optional[torch.Tensor],
+                num_heads: int, num_kv_heads: int,
+                rotary_dim: int = 0, theta: float = 10000.0,
+                max_position_embeddings: int = 2048,
+                scaling_type: str = '', scaling_factor: float = 1.0,
+                num_layer: int = 1, layer_idx: int = 0,
+                quant_bit: int = 0, quant_group: int = 8,
+                cache_mode: int = 0, cache_layout: int = 0,
+                page_size: int = 128, quant_zero_point: bool = False,
+                metadata: Optional["BatchMetadata"] = None):
+        # shape of qkv: [seqstarts[batch], num_heads + 2 * num_kv_heads, head_dim]
+        if torch.onnx.is_in_onnx_export():
+            return qkv[:, :num_heads]
+
+        if cache_mode != 0 and cache_mode != 1:
+            raise Exception("RotaryKeyValueCache does not support cache_mode {}".format(cache_mode))
+        assert qkv.shape[1] == num_heads + 2 * num_kv_heads, "{} vs. {}".format(qkv.shape[1], num_heads + 2 * num_kv_heads)
+
+        dim = qkv.shape[2] if rotary_dim == 0 else rotary_dim
+        if metadata is not None:
+            cos, sin = metadata.rotary(dim, theta, max_position_embeddings, scaling_type, scaling_factor)
+            storeidx = metadata.storeidx
+        else:
+            positions = packed_positions(seqstarts.to(qkv.device), start_pos.to(qkv.device), qkv.shape[0])
+            cos, sin = packed_rotary(seqstarts.to(qkv.device), start_pos.to(qkv.device), positions, dim, theta,
+                                     max_position_embeddings, scaling_type, scaling_factor)
+            storeidx = kv_cache_store_index(seqstarts, cachestarts, start_pos, cache_mode, page_size, cache.device)
+        cos, sin = cos.unsqueeze(1), sin.unsqueeze(1)  # (seqstarts[batch], 1, dim / 2)
+
+        # query, key and value are views of qkv, only the rotated query and key are new tensors
+        query = qkv[:, :num_heads]
+        key = rotate_pairs(qkv[:, num_heads:num_heads + num_kv_heads], cos, sin, dim)
+        value = qkv[:, num_heads + num_kv_heads:]
+
+        key_cache = cache_token_view(cache, layer_idx, 0, cache_layout)
+        value_cache = cache_token_view(cache, layer_idx, 1, cache_layout)
+        if quant_bit > 0:
+            key_scale = cache_token_view(scale, layer_idx, 0, cache_layout)
+            value_scale = cache_token_view(scale, layer_idx, 1, cache_layout)
+            key_cache[storeidx], key_scale[storeidx] = cache_quant(key, quant_bit, quant_group, quant_zero_point)
+            value_cache[storeidx], value_scale[storeidx] = cache_quant(value, quant_bit, quant_group, quant_zero_point)
+        else:
+            key_cache[storeidx], value_cache[storeidx] = key, value
+
+        return rotate_pairs(query, cos, sin, dim)
+
+
+def rotary_key_value_cache(
+                qkv: torch.Tensor,
+                seqstarts: torch.Tensor, cachestarts: torch.Tensor,
+                start_pos: torch.Tensor, max_seqlen: torch.Tensor,
+                cache: torch.Tensor, scale: Optional[torch.Tensor],
+                num_heads: int, num_kv_heads: int,
+                rotary_dim: int = 0, theta: float = 10000.0,
+                max_position_embeddings: int = 2048,
+                scaling_type: str = '', scaling_factor: float = 1.0,
+                num_layer: int = 1, layer_idx: int = 0,
+                quant_bit: int = 0, quant_group: int = 8,
+                cache_mode: int = 0, cache_layout: int = 0,
+                page_size: int = 128, quant_zero_point: bool = False,
+                metadata: Optional["BatchMetadata"] = None) -> torch.Tensor:
+    return RotaryKeyValueCache.apply(qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache, scale,
+                                     num_heads, num_kv_heads, rotary_dim, theta,
+                                     max_position_embeddings, scaling_type, scaling_factor,
+                                     num_layer, layer_idx, quant_bit, quant_group,
+                                     cache_mode, cache_layout, page_size, quant_zero_point,
+                                     metadata)
+
+
+if __name__ == "__main__":
+    class TestModule1(torch.nn.Module):
+        def __init__(self, num_heads: int, num_kv_heads: int,
+                     num_layer: int = 1, layer_idx: int = 0,
+                     quant_bit: int = 0, quant_group: int = 8) -> None:
+            super().__init__()
+            self.num_heads = num_heads
+            self.num_kv_heads = num_kv_heads
+            self.num_layer = num_layer
+            self.layer_idx = layer_idx
+            self.quant_bit = quant_bit
+            self.quant_group = quant_group
+
+
+        def forward(self, qkv: torch.Tensor,
+                    seqstarts: torch.Tensor, cachestarts: torch.Tensor,
+                    start_pos: torch.Tensor, max_seqlen: torch.Tensor,
+                    cache: torch.Tensor, scale: Optional[torch.Tensor] = None):
+            return rotary_key_value_cache(
+                qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache, scale,
+                self.num_heads, self.num_kv_heads,
+                num_layer=self.num_layer, layer_idx=self.layer_idx,
+                quant_bit=self.quant_bit, quant_group=self.quant_group)
+
+
+    bsz = 2
+    seqlen = 16
+    max_seq_len = 64
+    num_heads = 32
+    num_kv_heads = 8
+    head_dim = 128
+    num_layer = 2
+    layer_idx = 1
+    quant_bit = 8
+    quant_group = 8
+
+    qkv = torch.randn(bsz * seqlen, num_heads + 2 * num_kv_heads, head_dim)
+    seqstarts = torch.arange(0, (bsz + 1) * seqlen, seqlen, dtype=torch.int64)
+    cachestarts = torch.arange(0, bsz * max_seq_len, max_seq_len, dtype=torch.int64)
+    start_pos = torch.full([bsz], 8, dtype=torch.int64)
+    max_seqlen = torch.tensor([seqlen])
+    cache = torch.zeros([bsz * max_seq_len, num_layer, 2, num_kv_heads, head_dim], dtype=torch.int8)
+    scale = torch.zeros([bsz * max_seq_len, num_layer, 2, num_kv_heads, head_dim // quant_group])
+
+    test_op1 = TestModule1(num_heads, num_kv_heads, num_layer, layer_idx, quant_bit, quant_group)
+    print(test_op1.forward(qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache, scale).shape)
+
+    model_str1 = torch.onnx.export_to_pretty_string(
+        test_op1, (qkv, seqstarts, cachestarts, start_pos, max_seqlen, cache, scale),
+        "RotaryKeyValueCache1.onnx", opset_version=11)
+
+    print(model_str1)
@@ -1,5 +1,15 @@
 import torch
 
+from typing import Optional
+
+if __name__ == "__main__":
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from RotaryPositionEmbeddingUtils import packed_positions, packed_rotary, rotate_pairs
+else:
+    from ..RotaryPositionEmbeddingUtils import packed_positions, packed_rotary, rotate_pairs
+
 
 class RotaryPositionEmbedding(torch.autograd.Function):
     @staticmethod
@@ -8,7 +18,8 @@ class RotaryPositionEmbedding(torch.autograd.Function):
                 max_seqlen: torch.Value, rotary_dim: int = 0,
                 theta: float = 10000.0, bypass_key: bool = False,
                 max_position_embeddings: int = 2048,
-                scaling_type: str = '', scaling_factor: float = 1.0):
+                scaling_type: str = '', scaling_factor: float = 1.0,
+                metadata: Optional["BatchMetadata"] = None):
         # g: GraphContext, defined in onnx/_internal/jit_utils.py
         rotated_query, rotated_key = g.op('opmx.dynamic_batching::RotaryPositionEmbedding',
             query, key, seqstarts, start_pos, max_seqlen,
@@ -28,53 +39,25 @@ class RotaryPositionEmbedding(torch.autograd.Function):
                 max_seqlen: torch.Tensor, rotary_dim: int = 0,
                 theta: float = 10000.0, bypass_key: bool = False,
                 max_position_embeddings: int = 2048,
-                scaling_type: str = '', scaling_factor: float = 1.0):
+                scaling_type: str = '', scaling_factor: float = 1.0,
+                metadata: Optional["BatchMetadata"] = None):
         if torch.onnx.is_in_onnx_export():
             return query, key
 
         # shape of query, key: [seqstarts[batch], num_heads, head_dim]
         dim = query.shape[2] if rotary_dim == 0 else rotary_dim
 
-        def do_rotate(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
-            x_rot = x[..., :dim]
-            x_pass = x[..., dim:]
-            x_rot = x_rot.view(*x_rot.shape[:-1], -1, 2).transpose(-2, -1).contiguous().flatten(-2)
-            x_a = x_rot[..., :x_rot.shape[-1] // 2]
-            x_b = x_rot[..., x_rot.shape[-1] // 2:]
-            x_a_embed = x_a * cos - x_b * sin
-            x_b_embed = x_b * cos + x_a * sin
-            x_embed = torch.cat((x_a_embed, x_b_embed), dim=-1)
-
-            x_embed = x_embed.view(*x_embed.shape[:-1], 2, -1).transpose(-2, -1).contiguous().flatten(-2)
-
-            x_embed = torch.cat((x_embed, x_pass), dim=-1)
-            return x_embed
-
-        rotated_query = torch.zeros_like(query)
-        rotated_key = torch.zeros_like(key)
-
-        # freqs = (1.0 / (theta ** (torch.arange(0, dim, 2, dtype=torch.float, device=query.device)[: (dim // 2)] / dim)))
-        seqlens = seqstarts[1:] - seqstarts[:-1]
-        for b, seqlen in enumerate(seqlens):
-            position = start_pos[b]
-            seqbeg = seqstarts[b]
-            seqend = seqstarts[b+1]
-            _theta = theta
-            # generate cos cache, sin cache
-            t = torch.arange(position, position + seqlen, dtype=torch.float, device=query.device)
-            if scaling_type == 'linear':
-                t = t / scaling_factor
-            if scaling_type == 'dynamic' and position + seqlen > max_position_embeddings:
-                _theta = theta * (
-                    (scaling_factor * (position + seqlen) / max_position_embeddings) - (scaling_factor - 1)
-                ) ** (dim / (dim - 2))
-            freqs = (1.0 / (_theta ** (torch.arange(0, dim, 2, dtype=torch.float, device=query.device)[: (dim // 2)] / dim)))
-            freqs_cis = torch.outer(t, freqs)
-
-            cos, sin = freqs_cis.cos().unsqueeze(1), freqs_cis.sin().unsqueeze(1)  # (seqlen, 1, dim / 2)
-
-            rotated_query[seqbeg:seqend] = do_rotate(query[seqbeg:seqend].float(), cos, sin).type_as(query)
-            rotated_key[seqbeg:seqend] = key[seqbeg:seqend] if bypass_key else do_rotate(key[seqbeg:seqend].float(), cos, sin).type_as(key)
+        # one gather of the cos cache, sin cache shared by every layer and step for the whole batch
+        if metadata is not None:
+            cos, sin = metadata.rotary(dim, theta, max_position_embeddings, scaling_type, scaling_factor)
+        else:
+            positions = packed_positions(seqstarts, start_pos, query.shape[0])
+            cos, sin = packed_rotary(seqstarts, start_pos, positions, dim, theta,
+                                     max_position_embeddings, scaling_type, scaling_factor)
+        cos, sin = cos.unsqueeze(1), sin.unsqueeze(1)  # (seqstarts[batch], 1, dim / 2)
+
+        rotated_query = rotate_pairs(query, cos, sin, dim)
+        rotated_key = key if bypass_key else rotate_pairs(key, cos, sin, dim)
 
         return rotated_query, rotated_key
 
@@ -84,9 +67,10 @@ def rotary_position_embedding(query: torch.Tensor, key: torch.Tensor,
                 max_seqlen: torch.Tensor, rotary_dim: int = 0,
                 theta: float = 10000.0, bypass_key: bool = False,
                 max_position_embeddings: int = 2048, scaling_type: str = '',
-                scaling_factor: float = 1.0) -> torch.Tensor:
+                scaling_factor: float = 1.0,
+                metadata: Optional["BatchMetadata"] = None) -> torch.Tensor:
     return RotaryPositionEmbedding.apply(query, key, seqstarts, start_pos, max_seqlen, rotary_dim, theta, bypass_key,
-                                         max_position_embeddings, scaling_type, scaling_factor)
+                                         max_position_embeddings, scaling_type, scaling_factor, metadata)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 from .ALiBiMask import alibi_mask
 
+from .BatchMetadata import BatchMetadata
+
 from .InsertEmbedding import insert_embedding
 
 from .KeyValueCache import key_value_cache
@@ -8,4 +10,5 @@ from .MultiHeadAttention import multi_head_attention
 from .MultiHeadCacheAttention import multi_head_cache_attention
 
 from .RotaryPositionEmbedding import rotary_position_embedding
+from .RotaryKeyValueCache import rotary_key_value_cache
 from .PositionIndex import position_index